@@ -20,14 +20,32 @@ import os
 import threading
 import typing
 
+# First, so the startup phases are timed from here.
+from . import startup
+
 if typing.TYPE_CHECKING:
     from . import model
 
 
 class ModelThread(threading.Thread):
-    def __init__(self, discord_bot_token: str) -> None:
+    def __init__(
+        self,
+        discord_bot_token: str,
+        realtime_pipeline: bool = False,
+        paced_send_buffer_frames: typing.Optional[int] = None,
+        drift_compensation: bool = False,
+        frame_ms: int = 20,
+        metrics_port: typing.Optional[int] = None,
+        audio_dir: typing.Optional[str] = None,
+    ) -> None:
         super().__init__()
         self.discord_bot_token = discord_bot_token
+        self.realtime_pipeline = realtime_pipeline
+        self.paced_send_buffer_frames = paced_send_buffer_frames
+        self.drift_compensation = drift_compensation
+        self.frame_ms = frame_ms
+        self.metrics_port = metrics_port
+        self.audio_dir = audio_dir
         self.init_finished: concurrent.futures.Future['model.Model'] = concurrent.futures.Future()
 
     def run(self) -> None:
@@ -45,43 +63,110 @@ class ModelThread(threading.Thread):
     async def _run(self, loop: asyncio.AbstractEventLoop) -> None:
         from . import model
 
-        m = model.Model(self.discord_bot_token, loop)
+        startup.timeline.mark('model imported')
+        m = model.Model(
+            self.discord_bot_token,
+            loop,
+            self.realtime_pipeline,
+            self.paced_send_buffer_frames,
+            self.drift_compensation,
+            self.frame_ms,
+            self.metrics_port,
+            self.audio_dir,
+        )
         self.init_finished.set_result(m)
         await m.run()
 
 
 class UIThread:
-    def __init__(self, m: 'model.Model') -> None:
+    def __init__(self, m: 'model.Model', debug: bool = False) -> None:
         self.m = m
+        self.debug = debug
 
     def run(self) -> None:
+        from . import view
+
+        # The view runs this loop itself, in slices between Tk events.
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
         try:
-            loop.run_until_complete(self._run(loop))
+            v = view.View(self.m, loop, self.debug)
+            v.run()
         finally:
             loop.close()
 
-    async def _run(self, loop: asyncio.AbstractEventLoop) -> None:
-        from . import view
 
-        v = view.View(self.m, loop)
-        await v.run()
-
-
-def main() -> None:
+# Reads the settings shared by the GUI and the headless mode from the environment.
+# Prints the problem and returns None if a setting is invalid.
+def model_thread_from_environment() -> typing.Optional[ModelThread]:
     discord_bot_token = os.environ.get('DISCORD_BOT_TOKEN', '').strip()
     if not discord_bot_token:
         print('Unable to find a Discord bot token.')
         print('Please set the DISCORD_BOT_TOKEN environment variable.')
-        return
+        return None
+
+    realtime_pipeline = os.environ.get('DISCORD_MIC_BOT_REALTIME_PIPELINE', '').strip() not in ('', '0')
 
-    model_thread = ModelThread(discord_bot_token)
+    paced_send_buffer_frames: typing.Optional[int] = None
+    paced_send = os.environ.get('DISCORD_MIC_BOT_PACED_SEND_BUFFER_FRAMES', '').strip()
+    if paced_send:
+        try:
+            paced_send_buffer_frames = int(paced_send)
+        except ValueError:
+            print('DISCORD_MIC_BOT_PACED_SEND_BUFFER_FRAMES must be a number of frames.')
+            return None
+
+    drift_compensation = os.environ.get('DISCORD_MIC_BOT_DRIFT_COMPENSATION', '').strip() not in ('', '0')
+
+    frame_ms = 20
+    frame_duration = os.environ.get('DISCORD_MIC_BOT_FRAME_MS', '').strip()
+    if frame_duration:
+        try:
+            frame_ms = int(frame_duration)
+        except ValueError:
+            frame_ms = 0
+        if frame_ms not in (5, 10, 20, 40, 60):
+            print('DISCORD_MIC_BOT_FRAME_MS must be one of 5, 10, 20, 40 or 60.')
+            return None
+
+    metrics_port: typing.Optional[int] = None
+    metrics = os.environ.get('DISCORD_MIC_BOT_METRICS_PORT', '').strip()
+    if metrics:
+        try:
+            metrics_port = int(metrics)
+        except ValueError:
+            metrics_port = -1
+        if not 0 < metrics_port < 65536:
+            print('DISCORD_MIC_BOT_METRICS_PORT must be a TCP port number.')
+            return None
+
+    audio_dir: typing.Optional[str] = os.environ.get('DISCORD_MIC_BOT_AUDIO_DIR', '').strip() or None
+    if audio_dir is not None and not os.path.isdir(audio_dir):
+        print('DISCORD_MIC_BOT_AUDIO_DIR must be a directory.')
+        return None
+
+    return ModelThread(
+        discord_bot_token,
+        realtime_pipeline,
+        paced_send_buffer_frames,
+        drift_compensation,
+        frame_ms,
+        metrics_port,
+        audio_dir,
+    )
+
+
+def main() -> None:
+    model_thread = model_thread_from_environment()
+    if model_thread is None:
+        return
     model_thread.start()
     m = model_thread.init_finished.result()
 
+    debug = os.environ.get('DISCORD_MIC_BOT_DEBUG', '').strip() not in ('', '0')
+
     try:
-        ui_thread = UIThread(m)
+        ui_thread = UIThread(m, debug)
         ui_thread.run()
     finally:
         shutdown_finished = m.stop()
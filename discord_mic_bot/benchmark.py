@@ -0,0 +1,529 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# Offline benchmark of the encode path: synthetic audio goes through the real Model, from the frame ring to
+# fake voice clients that record their packets instead of sending them. No sound device is opened and
+# nothing connects to Discord.
+#
+# Run with: python -m discord_mic_bot.benchmark --output results.json
+# and compare two runs with: python -m discord_mic_bot.benchmark --compare old.json new.json
+# With --jitter, frames arrive in real time instead and the event loop mode is compared with the realtime pipeline.
+
+import argparse
+import array
+import asyncio
+import concurrent.futures
+import datetime
+import gc
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import typing
+
+import discord
+import numpy
+import numpy.typing
+
+from . import encoder, latency, model, stats
+
+Float32Array: typing.TypeAlias = numpy.typing.NDArray[numpy.float32]
+
+
+class FakeChannel:
+    __slots__ = ['id', 'name', 'guild']
+
+    def __init__(self, channel_id: int, name: str, guild: typing.Any) -> None:
+        self.id = channel_id
+        self.name = name
+        self.guild = guild
+
+
+class FakeGuild:
+    __slots__ = ['id', 'name']
+
+    def __init__(self, guild_id: int, name: str) -> None:
+        self.id = guild_id
+        self.name = name
+
+
+class FakeVoiceWebSocket:
+    __slots__ = ['speaking_changes']
+
+    def __init__(self) -> None:
+        self.speaking_changes = 0
+
+    async def speak(self, state: discord.SpeakingState) -> None:
+        self.speaking_changes += 1
+
+
+class FakeVoiceClient(discord.VoiceClient):
+    # A real VoiceClient, so the RTP header and the encryption are the real ones, that records its packets.
+    def __init__(self, client: discord.Client, channel: FakeChannel, ssrc: int) -> None:
+        super().__init__(client, typing.cast(discord.abc.Connectable, channel))
+        connection = getattr(self, '_connection')
+        connection.mode = 'aead_xchacha20_poly1305_rtpsize'
+        connection.secret_key = list(os.urandom(32))
+        connection.ssrc = ssrc
+        setattr(connection, 'send_packet', self._record_packet)
+        self.socket = True
+        self.packets: typing.List[bytes] = []
+        self.sent_ns: typing.List[int] = []
+        self.fake_ws = FakeVoiceWebSocket()
+
+    @property
+    def ws(self) -> typing.Any:
+        return self.fake_ws
+
+    def is_connected(self) -> bool:
+        return True
+
+    def _record_packet(self, packet: bytes) -> None:
+        self.packets.append(packet)
+        self.sent_ns.append(time.monotonic_ns())
+
+
+class BenchmarkModel(model.Model):
+    # A Model with fake voice clients in fake guilds.
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        realtime_pipeline: bool,
+        clients: int,
+        frame_ms: int,
+        profile: encoder.EncoderProfile,
+    ) -> None:
+        super().__init__('', loop, realtime_pipeline=realtime_pipeline, frame_ms=frame_ms)
+        self.logger.setLevel('WARNING')
+        self._set_default_encoder_profile(profile)
+        state = getattr(self.discord_client, '_connection')
+        self.voice_clients: typing.List[FakeVoiceClient] = []
+        for i in range(clients):
+            guild = FakeGuild(1000 + i, 'Guild {}'.format(i))
+            channel = FakeChannel(2000 + i, 'Voice {}'.format(i), guild)
+            voice_client = FakeVoiceClient(self.discord_client, channel, i + 1)
+            state._add_voice_client(guild.id, voice_client)
+            self.voice_clients.append(voice_client)
+
+
+# Stereo float32 test signals at 48kHz, each returned as a list of frames.
+def make_signal(kind: str, frames: int, frame_size: int, seed: int = 0) -> typing.List['array.array[float]']:
+    rng = numpy.random.default_rng(seed)
+    t = numpy.arange(frames * frame_size, dtype=numpy.float64) / 48000
+    if kind == 'sine':
+        # -12 dBFS, a different tone on each side.
+        x = 0.25 * numpy.stack((numpy.sin(2 * math.pi * 440 * t), numpy.sin(2 * math.pi * 660 * t)), axis=1)
+    elif kind == 'noise':
+        # -20 dBFS RMS white noise.
+        x = 0.1 * rng.standard_normal((len(t), 2))
+    elif kind == 'silence':
+        x = numpy.zeros((len(t), 2))
+    elif kind == 'music':
+        # Chords changing every half second, a hi-hat every quarter, and a second of rest every 5 seconds,
+        # so the gate opens and closes too.
+        chord = numpy.floor(t * 2).astype(numpy.int64) % 4
+        roots = numpy.array((220.0, 174.61, 261.63, 196.0))[chord]
+        tone = sum(numpy.sin(2 * math.pi * roots * ratio * t) for ratio in (1.0, 1.26, 1.5)) / 3
+        hihat = rng.standard_normal(len(t)) * numpy.exp(-(t % 0.25) * 60)
+        envelope = numpy.where(t % 5 < 4, 0.3 * (1 + 0.2 * numpy.sin(2 * math.pi * 3 * t)), 0.0)
+        mono = (tone + 0.3 * hihat) * envelope
+        x = numpy.stack((mono, numpy.roll(mono, 24)), axis=1)
+    else:
+        raise ValueError('Unknown signal: {}'.format(kind))
+    samples = typing.cast(Float32Array, x.astype(numpy.float32))
+    return [array.array('f', samples[i * frame_size : (i + 1) * frame_size].tobytes()) for i in range(frames)]
+
+
+def _mean_ms(histogram: stats.RollingLatency) -> float:
+    return histogram.total_ns / histogram.count / 1000000 if histogram.count != 0 else 0.0
+
+
+# Runs the frames through the ring, _prepare_frame, the LU meter and _encode_and_fan_out, like the realtime
+# pipeline does, but as fast as possible. Returns the measurements of this signal.
+def run_signal(
+    m: model.Model,
+    clients: typing.List[FakeVoiceClient],
+    frames: typing.List['array.array[float]'],
+    trace_frames: int,
+) -> typing.Dict[str, float]:
+    lu_meter = m.dsp_loaded.result()
+    m.frame_latency = latency.FrameLatency(len(frames))
+    for voice_client in clients:
+        voice_client.packets.clear()
+        voice_client.sent_ns.clear()
+    m.voice_gate.take_suppressed_frames()
+    m.fan_out_time.take()
+
+    gate_ns = 0
+    fan_out_ns = 0
+    lu_meter_ns = 0
+    gc.collect()
+    blocks_before = sys.getallocatedblocks()
+    wall_start_ns = time.perf_counter_ns()
+    cpu_start_ns = time.process_time_ns()
+    for frame in frames:
+        capture_ns = time.monotonic_ns()
+        m.audio_ring.write(memoryview(frame).cast('B'), capture_ns, capture_ns)
+        captured_buffer = m.audio_ring.peek()
+        assert captured_buffer is not None
+
+        # process_time counts every thread, e.g. the workers encrypting for many clients.
+        start_ns = time.process_time_ns()
+        buffer = m._prepare_frame(captured_buffer, capture_ns, capture_ns)  # pyright: ignore[reportPrivateUsage]
+        prepared_ns = time.process_time_ns()
+        gate_ns += prepared_ns - start_ns
+        if m.voice_gate.transmitting:
+            m._encode_and_fan_out(buffer)  # pyright: ignore[reportPrivateUsage]
+        encoded_ns = time.process_time_ns()
+        fan_out_ns += encoded_ns - prepared_ns
+        lu_meter._push(buffer)  # pyright: ignore[reportPrivateUsage]
+        lu_meter_ns += time.process_time_ns() - encoded_ns
+
+        m.timestamp_frames = (m.timestamp_frames + len(buffer) // 2) & 0xFFFFFFFF
+        m.audio_ring.release()
+    cpu_ns = time.process_time_ns() - cpu_start_ns
+    wall_ns = time.perf_counter_ns() - wall_start_ns
+    # What the view and the metrics endpoint pay for each loudness reading.
+    start_ns = time.process_time_ns()
+    for _ in range(1000):
+        lu_meter.momentary_lufs()
+    lu_meter_read_ns = time.process_time_ns() - start_ns
+    # The K-weighting filter alone, over the same frames. Its state is put back afterwards.
+    filter_state = lu_meter.z
+    k_weight = lu_meter._k_weight  # pyright: ignore[reportPrivateUsage]
+    start_ns = time.process_time_ns()
+    for frame in frames:
+        k_weight(numpy.frombuffer(frame, dtype=numpy.float32).reshape((-1, 2)))
+    k_weighting_ns = time.process_time_ns() - start_ns
+    lu_meter.z = filter_state
+
+    count = len(frames)
+    packets = [packet for voice_client in clients for packet in voice_client.packets]
+    packet_count = len(packets)
+    packet_bytes = sum(len(packet) for packet in packets)
+    # Only what the pipeline keeps counts, not the recorded packets or garbage waiting for the collector.
+    del packets
+    for voice_client in clients:
+        voice_client.packets.clear()
+        voice_client.sent_ns.clear()
+    gc.collect()
+    blocks_after = sys.getallocatedblocks()
+    frame_latency = m.frame_latency
+    result = {
+        'frames': count,
+        'frames_per_second': count * 1000000000 / wall_ns,
+        'cpu_us_per_frame': cpu_ns / count / 1000,
+        'gate_cpu_us_per_frame': gate_ns / count / 1000,
+        'encode_and_fan_out_cpu_us_per_frame': fan_out_ns / count / 1000,
+        'lu_meter_push_cpu_us_per_frame': lu_meter_ns / count / 1000,
+        'lu_meter_read_cpu_us': lu_meter_read_ns / 1000 / 1000,
+        'k_weighting_cpu_us_per_frame': k_weighting_ns / count / 1000,
+        # Wall time of the steps inside _encode_and_fan_out, per frame that went through them.
+        'opus_encode_us': _mean_ms(frame_latency.encode) * 1000,
+        'packet_build_us': _mean_ms(frame_latency.packet) * 1000,
+        'send_us': _mean_ms(frame_latency.send) * 1000,
+        'fan_out_us': m.fan_out_time.take()[1] * 1000,
+        'transmitted_frames': frame_latency.encode.count,
+        'gate_suppressed_frames': m.voice_gate.take_suppressed_frames(),
+        'packets': packet_count,
+        'mean_packet_bytes': packet_bytes / packet_count if packet_count != 0 else 0.0,
+        'retained_blocks_per_frame': (blocks_after - blocks_before) / count,
+    }
+
+    # Python has no allocation counter, tracemalloc tells how many bytes each frame allocates at its peak.
+    # It slows everything down a lot, so it only runs over a few extra frames.
+    if trace_frames == 0:
+        return result
+    peak_bytes = 0
+    tracemalloc.start()
+    for frame in frames[:trace_frames]:
+        m.audio_ring.write(memoryview(frame).cast('B'), 0, 0)
+        captured_buffer = m.audio_ring.peek()
+        assert captured_buffer is not None
+        tracemalloc.reset_peak()
+        current_bytes, _ = tracemalloc.get_traced_memory()
+        buffer = m._prepare_frame(captured_buffer, 0, 0)  # pyright: ignore[reportPrivateUsage]
+        if m.voice_gate.transmitting:
+            m._encode_and_fan_out(buffer)  # pyright: ignore[reportPrivateUsage]
+        lu_meter._push(buffer)  # pyright: ignore[reportPrivateUsage]
+        m.audio_ring.release()
+        peak_bytes += tracemalloc.get_traced_memory()[1] - current_bytes
+    tracemalloc.stop()
+    result['allocation_peak_bytes_per_frame'] = peak_bytes / trace_frames if trace_frames != 0 else 0.0
+    return result
+
+
+def _git_commit() -> str:
+    try:
+        result = subprocess.run(
+            ('git', 'rev-parse', '--short', 'HEAD'),
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+    except OSError:
+        return ''
+    return result.stdout.strip() if result.returncode == 0 else ''
+
+
+def benchmark(
+    signals: typing.Sequence[str],
+    clients: int,
+    frames: int,
+    frame_ms: int,
+    profile: encoder.EncoderProfile,
+    trace_frames: int = 50,
+) -> typing.Dict[str, typing.Any]:
+    loop = asyncio.new_event_loop()
+    # Speaking state changes are sent from the event loop, like in the real thing.
+    loop_thread = threading.Thread(target=loop.run_forever, name='discord-mic-bot-benchmark-loop', daemon=True)
+    loop_thread.start()
+    m = BenchmarkModel(loop, False, clients, frame_ms, profile)
+    try:
+        results: typing.Dict[str, typing.Dict[str, float]] = {}
+        for kind in signals:
+            signal = make_signal(kind, frames, m.frame_size)
+            # A few frames to warm up the encoder and the caches, not measured.
+            run_signal(m, m.voice_clients, signal[:20], 0)
+            results[kind] = run_signal(m, m.voice_clients, signal, trace_frames)
+    finally:
+        _close_model(m)
+        loop.call_soon_threadsafe(loop.stop)
+        loop_thread.join()
+        loop.close()
+
+    return _results(clients, frames, frame_ms, profile, results)
+
+
+def _close_model(m: model.Model) -> None:
+    m.running = False
+    m.opus_encoder_executor.shutdown()
+    m.worker_executor.shutdown()
+    if m.lu_meter is not None:
+        m.lu_meter.close()
+
+
+# Busy work on the event loop, standing in for discord.py decoding gateway events, e.g. a big GUILD_CREATE.
+async def _gateway_load(m: model.Model, busy_ms: float, interval_ms: float) -> None:
+    while m.running:
+        await asyncio.sleep(interval_ms / 1000)
+        deadline_ns = time.perf_counter_ns() + int(busy_ms * 1000000)
+        while time.perf_counter_ns() < deadline_ns:
+            pass
+
+
+# Feeds the frames in real time, like the audio callback would, through the real pipeline of the mode:
+# the event loop with the encoder executor, or the realtime pipeline thread. Returns how regularly the
+# packets left and how long they took from capture to send.
+def run_jitter(
+    loop: asyncio.AbstractEventLoop,
+    realtime_pipeline: bool,
+    clients: int,
+    frames: typing.List['array.array[float]'],
+    frame_ms: int,
+    profile: encoder.EncoderProfile,
+    loop_busy_ms: float,
+) -> typing.Dict[str, float]:
+    m = BenchmarkModel(loop, realtime_pipeline, clients, frame_ms, profile)
+    load_future: typing.Optional[concurrent.futures.Future[None]] = None
+    try:
+        m.dsp_loaded.result()
+        m.frame_latency = latency.FrameLatency(len(frames))
+        loop.call_soon_threadsafe(m._start_pipeline)  # pyright: ignore[reportPrivateUsage]
+        if loop_busy_ms > 0:
+            load_future = asyncio.run_coroutine_threadsafe(_gateway_load(m, loop_busy_ms, 50), loop)
+
+        frame_ns = frame_ms * 1000000
+        start_ns = time.monotonic_ns() + frame_ns
+        for i, frame in enumerate(frames):
+            delay_ns = start_ns + i * frame_ns - time.monotonic_ns()
+            if delay_ns > 0:
+                time.sleep(delay_ns / 1000000000)
+            capture_ns = time.monotonic_ns()
+            m._write_frame(memoryview(frame).cast('B'), capture_ns, capture_ns)  # pyright: ignore[reportPrivateUsage]
+        # Give the last frame time to go out.
+        time.sleep(0.2)
+    finally:
+        m.running = False
+        loop.call_soon_threadsafe(m.audio_ready.set)
+        m.audio_ready_threading.set()
+        if m.pipeline_thread is not None:
+            m.pipeline_thread.join()
+        elif m.encode_voice_task is not None:
+            asyncio.run_coroutine_threadsafe(asyncio.wait({m.encode_voice_task}), loop).result()
+        if load_future is not None:
+            load_future.result()
+        _close_model(m)
+
+    # Every frame is sent, sine never closes the gate, so each interval should be exactly one frame.
+    sent_ns = m.voice_clients[0].sent_ns
+    send_jitter = stats.RollingLatency(max(1, len(sent_ns)))
+    for a, b in zip(sent_ns, sent_ns[1:]):
+        send_jitter.add(abs(b - a - frame_ns))
+    _, _, jitter_p99_ms, jitter_max_ms = send_jitter.percentiles()
+    _, p50_ms, p99_ms, max_ms = m.frame_latency.total.percentiles()
+    return {
+        'frames': len(frames),
+        'packets': len(sent_ns),
+        'send_jitter_mean_ms': _mean_ms(send_jitter),
+        'send_jitter_p99_ms': jitter_p99_ms,
+        'send_jitter_max_ms': jitter_max_ms,
+        'capture_to_send_p50_ms': p50_ms,
+        'capture_to_send_p99_ms': p99_ms,
+        'capture_to_send_max_ms': max_ms,
+        'ring_overflows': m.ring_overflows,
+    }
+
+
+# Per-frame jitter of the event loop mode against the realtime pipeline, with the same busy event loop.
+def benchmark_jitter(
+    clients: int,
+    frames: int,
+    frame_ms: int,
+    profile: encoder.EncoderProfile,
+    loop_busy_ms: float,
+) -> typing.Dict[str, typing.Any]:
+    loop = asyncio.new_event_loop()
+    loop_thread = threading.Thread(target=loop.run_forever, name='discord-mic-bot-benchmark-loop', daemon=True)
+    loop_thread.start()
+    try:
+        signal = make_signal('sine', frames, 48000 * frame_ms // 1000)
+        results: typing.Dict[str, typing.Dict[str, float]] = {}
+        for mode, realtime_pipeline in (('event loop', False), ('realtime thread', True)):
+            results['jitter ({})'.format(mode)] = run_jitter(
+                loop, realtime_pipeline, clients, signal, frame_ms, profile, loop_busy_ms
+            )
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        loop_thread.join()
+        loop.close()
+
+    return _results(clients, frames, frame_ms, profile, results, loop_busy_ms=loop_busy_ms)
+
+
+def _results(
+    clients: int,
+    frames: int,
+    frame_ms: int,
+    profile: encoder.EncoderProfile,
+    results: typing.Dict[str, typing.Dict[str, float]],
+    **settings: typing.Any,
+) -> typing.Dict[str, typing.Any]:
+    return {
+        'commit': _git_commit(),
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'settings': {
+            'clients': clients,
+            'frames': frames,
+            'frame_ms': frame_ms,
+            'bitrate_kbps': profile.bitrate_kbps,
+            'fec': profile.fec_enabled,
+            'dtx': profile.dtx_enabled,
+            **settings,
+        },
+        'signals': results,
+    }
+
+
+def print_results(results: typing.Dict[str, typing.Any]) -> None:
+    print(
+        'commit {}, {} clients, {} ms frames'.format(
+            results['commit'] or 'unknown', results['settings']['clients'], results['settings']['frame_ms']
+        )
+    )
+    for kind, result in results['signals'].items():
+        print('{}:'.format(kind))
+        for key, value in result.items():
+            print('  {:<38} {:12.2f}'.format(key, value))
+
+
+# Prints how each measurement changed from one run to another.
+def compare(old: typing.Dict[str, typing.Any], new: typing.Dict[str, typing.Any]) -> None:
+    print('{} -> {}'.format(old['commit'] or 'old', new['commit'] or 'new'))
+    for kind, new_result in new['signals'].items():
+        old_result = old['signals'].get(kind)
+        if old_result is None:
+            continue
+        print('{}:'.format(kind))
+        for key, new_value in new_result.items():
+            old_value = old_result.get(key)
+            if old_value is None:
+                continue
+            change = '{:+.1f}%'.format((new_value - old_value) / old_value * 100) if old_value != 0 else ''
+            print('  {:<38} {:12.2f} {:12.2f} {:>9}'.format(key, old_value, new_value, change))
+
+
+def main(argv: typing.Optional[typing.Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog='python -m discord_mic_bot.benchmark', description='Benchmark the encode path with fake voice clients.'
+    )
+    parser.add_argument('--signals', default='sine,noise,silence,music', help='comma separated signals to run')
+    parser.add_argument('--clients', type=int, default=1, help='number of fake voice clients')
+    parser.add_argument('--frames', type=int, default=1500, help='frames per signal')
+    parser.add_argument('--frame-ms', type=int, default=20, choices=model.Model.frame_durations_ms)
+    parser.add_argument('--bitrate', type=int, default=128, help='Opus bitrate in Kbps')
+    parser.add_argument('--fec', action='store_true', help='enable forward error correction')
+    parser.add_argument('--dtx', action='store_true', help='enable discontinuous transmission')
+    parser.add_argument(
+        '--jitter', action='store_true', help='compare the send jitter of the event loop and the realtime pipeline'
+    )
+    parser.add_argument(
+        '--loop-busy-ms',
+        type=float,
+        default=5.0,
+        help='with --jitter, keep the event loop busy this long every 50 ms, like gateway traffic',
+    )
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files and exit')
+    args = parser.parse_args(argv)
+
+    if args.compare is not None:
+        with open(args.compare[0], encoding='utf-8') as f:
+            old = json.load(f)
+        with open(args.compare[1], encoding='utf-8') as f:
+            new = json.load(f)
+        compare(old, new)
+        return
+
+    profile = encoder.EncoderProfile(min(512, max(12, args.bitrate)), args.fec, args.dtx)
+    if args.jitter:
+        results = benchmark_jitter(max(1, args.clients), max(1, args.frames), args.frame_ms, profile, args.loop_busy_ms)
+    else:
+        results = benchmark(
+            [kind.strip() for kind in args.signals.split(',') if kind.strip()],
+            max(1, args.clients),
+            max(1, args.frames),
+            args.frame_ms,
+            profile,
+        )
+    print_results(results)
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
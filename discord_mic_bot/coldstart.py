@@ -0,0 +1,62 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import subprocess
+import sys
+import typing
+
+
+# Cold import time of each module, every sample in a fresh interpreter, so nothing is cached in memory
+# except by the operating system.
+def benchmark(repeat: int = 5) -> None:
+    modules = (
+        'discord',
+        'numpy',
+        'scipy.signal',
+        'sounddevice',
+        'tkinter.ttk',
+        'discord_mic_bot.model',
+        'discord_mic_bot.lumeter',
+        'discord_mic_bot.dsp',
+    )
+    for module in modules:
+        samples: typing.List[float] = []
+        for _ in range(repeat):
+            result = subprocess.run(
+                (
+                    sys.executable,
+                    '-c',
+                    'import time; start = time.perf_counter(); import {}; print(time.perf_counter() - start)'.format(
+                        module
+                    ),
+                ),
+                capture_output=True,
+                text=True,
+            )
+            if result.returncode != 0:
+                break
+            samples.append(float(result.stdout) * 1000)
+        if not samples:
+            print('{:<24} failed to import'.format(module))
+            continue
+        samples.sort()
+        print('{:<24} median {:7.1f} ms, min {:7.1f} ms'.format(module, samples[len(samples) // 2], samples[0]))
+
+
+# Run with: python -m discord_mic_bot.coldstart
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,138 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import os
+import time
+import typing
+
+import sounddevice  # pyright: ignore[reportMissingTypeStubs]
+
+from . import filesource, oggopus
+
+# The host API listing the audio files of the audio directory.
+FILES_HOSTAPI = 'Audio files'
+
+
+# sounddevice has no public way to restart PortAudio, so this is the only place that uses its private functions.
+# Returns False, without touching PortAudio, if this version of sounddevice does not have them.
+def _restart_portaudio() -> bool:
+    terminate = getattr(sounddevice, '_terminate', None)
+    initialize = getattr(sounddevice, '_initialize', None)
+    if not callable(terminate) or not callable(initialize):
+        return False
+    try:
+        terminate()
+    finally:
+        # Whatever happened, leave PortAudio initialized, or every later call would fail.
+        initialize()
+    return True
+
+
+class SoundDevice:
+    __slots__ = ['name', 'is_default', 'index', 'sample_rate', 'path']
+
+    def __init__(
+        self,
+        name: str,
+        is_default: bool,
+        index: int = -1,
+        sample_rate: int = 48000,
+        path: typing.Optional[str] = None,
+    ) -> None:
+        self.name = name
+        self.is_default = is_default
+        # PortAudio's device number, only valid until the next rescan.
+        self.index = index
+        self.sample_rate = sample_rate
+        # Set for audio files, which are played instead of recorded from.
+        self.path = path
+
+    def __repr__(self) -> str:
+        if self.is_default:
+            return '* {}'.format(self.name)
+        return '  {}'.format(self.name)
+
+
+class DeviceIndex:
+    # Enumerating devices can take hundreds of milliseconds with many ASIO / WASAPI / JACK endpoints,
+    # so it is done once here, and again only on rescan().
+    __slots__ = ['hostapis', 'input_devices', 'by_name', 'scan_ns', 'audio_dir']
+
+    def __init__(self, audio_dir: typing.Optional[str] = None) -> None:
+        self.audio_dir = audio_dir
+        self.hostapis: typing.List[str] = []
+        self.input_devices: typing.Dict[str, typing.List[SoundDevice]] = {}
+        self.by_name: typing.Dict[typing.Tuple[str, str], SoundDevice] = {}
+        self.scan_ns = 0
+        self._scan()
+
+    def lookup(self, hostapi: str, name: str) -> typing.Optional[SoundDevice]:
+        return self.by_name.get((hostapi, name))
+
+    # PortAudio only enumerates the devices when it initializes, so this restarts PortAudio to see hot-plugged
+    # devices. All streams must be closed first.
+    # Returns False if PortAudio could not be restarted, then only the audio files are rescanned.
+    def rescan(self) -> bool:
+        restarted = _restart_portaudio()
+        self._scan()
+        return restarted
+
+    def _scan(self) -> None:
+        start_ns = time.perf_counter_ns()
+        hostapis = typing.cast(typing.Tuple[typing.Dict[str, typing.Any], ...], sounddevice.query_hostapis())
+        devices = typing.cast(typing.Iterable[typing.Dict[str, typing.Any]], sounddevice.query_devices())
+
+        # Built aside and published at the end, so the UI thread never sees half-filled lists during a rescan.
+        hostapi_names = [typing.cast(str, api['name']) for api in hostapis]
+        input_devices: typing.Dict[str, typing.List[SoundDevice]] = {name: [] for name in hostapi_names}
+        by_name: typing.Dict[typing.Tuple[str, str], SoundDevice] = {}
+        for idx, dev in enumerate(devices):
+            hostapi_id = typing.cast(int, dev['hostapi'])
+            if dev['max_input_channels'] <= 0 or hostapi_id >= len(hostapis):
+                continue
+            hostapi = hostapi_names[hostapi_id]
+            sound_device = SoundDevice(
+                typing.cast(str, dev['name']),
+                idx == hostapis[hostapi_id]['default_input_device'],
+                idx,
+                int(round(typing.cast(float, dev['default_samplerate']))),
+            )
+            input_devices[hostapi].append(sound_device)
+            # Like before, the first of several devices with the same name wins.
+            by_name.setdefault((hostapi, sound_device.name), sound_device)
+        if self.audio_dir is not None:
+            hostapi_names.append(FILES_HOSTAPI)
+            input_devices[FILES_HOSTAPI] = self._scan_audio_dir(self.audio_dir)
+            for sound_device in input_devices[FILES_HOSTAPI]:
+                by_name[(FILES_HOSTAPI, sound_device.name)] = sound_device
+        self.by_name = by_name
+        self.input_devices = input_devices
+        self.hostapis = hostapi_names
+        self.scan_ns = time.perf_counter_ns() - start_ns
+
+    @staticmethod
+    def _scan_audio_dir(audio_dir: str) -> typing.List[SoundDevice]:
+        try:
+            names = sorted(
+                entry.name
+                for entry in os.scandir(audio_dir)
+                if entry.is_file()
+                and os.path.splitext(entry.name)[1].lower() in filesource.EXTENSIONS + oggopus.EXTENSIONS
+            )
+        except OSError:
+            names = []
+        return [SoundDevice(name, False, path=os.path.join(audio_dir, name)) for name in names]
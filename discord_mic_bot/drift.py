@@ -0,0 +1,111 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import typing
+
+import numpy
+import numpy.typing
+
+
+class DriftEstimator:
+    # Estimates the actual sample rate of the sound card against time.monotonic,
+    # by a least-squares fit of the number of captured samples against the capture time of each block.
+    # The fit runs over the last minute, which averages out the scheduling jitter of the callbacks.
+    # The estimate needs at least 10 seconds of blocks, and is updated once per second.
+    #
+    # The audio callback only stores when each block was captured into preallocated arrays with add(),
+    # the fit runs on the consumer side with update(). Like framering.FrameRing, each side only writes
+    # its own indices, so neither takes a lock.
+    __slots__ = [
+        'nominal_rate',
+        'min_blocks',
+        'update_blocks',
+        'capacity',
+        'times',
+        'positions',
+        'samples',
+        'count',
+        'first',
+        'skip',
+        'fitted_count',
+        'rate',
+    ]
+
+    def __init__(self, nominal_rate: float, block_ms: int = 20) -> None:
+        self.nominal_rate = nominal_rate
+        self.min_blocks = 10000 // block_ms
+        self.update_blocks = 1000 // block_ms
+        self.capacity = 60000 // block_ms
+        # Capture time in nanoseconds and number of samples before each block, the slot is the block modulo capacity.
+        self.times: numpy.typing.NDArray[numpy.int64] = numpy.zeros(self.capacity, dtype=numpy.int64)
+        self.positions: numpy.typing.NDArray[numpy.int64] = numpy.zeros(self.capacity, dtype=numpy.int64)
+        # Written by the producer only.
+        self.samples = 0
+        self.count = 0
+        # The first block after the last lost samples.
+        self.first = 0
+        # Written by the consumer only: the first block after the last nonsense fit, and the count at the last fit.
+        self.skip = 0
+        self.fitted_count = 0
+        # None until there are enough blocks for a meaningful estimate.
+        self.rate: typing.Optional[float] = None
+
+    # Producer side, called from the audio callback. capture_ns is when the first sample of the block was captured,
+    # from the PortAudio time info, which is a better capture time than when the callback got to run.
+    def add(self, frames: int, capture_ns: int) -> None:
+        count = self.count
+        slot = count % self.capacity
+        self.times[slot] = capture_ns
+        self.positions[slot] = self.samples
+        self.samples += frames
+        self.count = count + 1
+
+    # Producer side. Call when samples were lost, e.g. after an input overflow.
+    def reset(self) -> None:
+        self.first = self.count
+
+    # Consumer side, cheap unless a second of blocks has been added since the last fit.
+    # Returns True when the estimate has been updated.
+    def update(self) -> bool:
+        count = self.count
+        if count - self.fitted_count < self.update_blocks:
+            return False
+        self.fitted_count = count
+        start = max(self.first, self.skip, count - self.capacity)
+        slots = numpy.arange(start, count) % self.capacity
+        times = self.times[slots]
+        positions = self.positions[slots]
+        # The producer keeps going meanwhile, drop the oldest blocks if their slots were overwritten during the copy.
+        overwritten = max(0, self.count - self.capacity - start)
+        times = times[overwritten:]
+        positions = positions[overwritten:]
+        if times.shape[0] < self.min_blocks:
+            return False
+        centered_times = (times - times.mean()) / 1000000000
+        centered_positions = positions - positions.mean()
+        rate = float(numpy.dot(centered_times, centered_positions) / numpy.dot(centered_times, centered_times))
+        # Ignore nonsense from a stalled or restarted stream.
+        if abs(rate / self.nominal_rate - 1) > 0.01:
+            self.skip = count
+            return False
+        self.rate = rate
+        return True
+
+    @property
+    def ppm(self) -> typing.Optional[float]:
+        if self.rate is None:
+            return None
+        return (self.rate / self.nominal_rate - 1) * 1000000
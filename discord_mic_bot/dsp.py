@@ -0,0 +1,207 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import abc
+import array
+import math
+import time
+import typing
+
+import numpy
+import numpy.typing
+import scipy.ndimage
+import scipy.signal
+
+from . import stats
+
+Float32Array: typing.TypeAlias = numpy.typing.NDArray[numpy.float32]
+Float64Array: typing.TypeAlias = numpy.typing.NDArray[numpy.float64]
+
+
+class Stage(abc.ABC):
+    # A block processor working in place on one frame, shaped (samples, 2 channels).
+    # Its time budget is a fraction of the frame duration, so shorter frames get shorter budgets.
+    __slots__ = ['name', 'budget_fraction', 'budget_ns', 'process_time', 'overruns']
+
+    def __init__(self, name: str, budget_fraction: float) -> None:
+        self.name = name
+        self.budget_fraction = budget_fraction
+        self.budget_ns = 0
+        self.set_frame_ms(20)
+        self.process_time = stats.DurationMeter()
+        self.overruns = 0
+
+    def set_frame_ms(self, frame_ms: float) -> None:
+        self.budget_ns = int(self.budget_fraction * frame_ms * 1000000)
+
+    # Delay added to the signal, in samples.
+    @property
+    def latency_samples(self) -> int:
+        return 0
+
+    @abc.abstractmethod
+    def process(self, x: Float32Array) -> None: ...
+
+
+class Gain(Stage):
+    __slots__ = ['factor']
+
+    def __init__(self, gain_db: float, budget_fraction: float = 0.05) -> None:
+        super().__init__('gain {:+.1f} dB'.format(gain_db), budget_fraction)
+        self.factor = numpy.float32(10 ** (gain_db / 20))
+
+    def process(self, x: Float32Array) -> None:
+        numpy.multiply(x, self.factor, out=x)
+
+
+class Biquad(Stage):
+    # Filters from Robert Bristow-Johnson's Audio EQ Cookbook.
+    __slots__ = ['b', 'a', 'z']
+
+    def __init__(
+        self,
+        kind: typing.Literal['lowpass', 'highpass', 'peaking', 'lowshelf', 'highshelf'],
+        frequency: float,
+        q: float = math.sqrt(0.5),
+        gain_db: float = 0.0,
+        sample_rate: int = 48000,
+        budget_fraction: float = 0.05,
+    ) -> None:
+        super().__init__('{} {:g} Hz'.format(kind, frequency), budget_fraction)
+        w0 = 2 * math.pi * frequency / sample_rate
+        cos_w0 = math.cos(w0)
+        alpha = math.sin(w0) / (2 * q)
+        a = 10 ** (gain_db / 40)
+        sqrt_a_alpha = 2 * math.sqrt(a) * alpha
+        if kind == 'lowpass':
+            b = ((1 - cos_w0) / 2, 1 - cos_w0, (1 - cos_w0) / 2)
+            den = (1 + alpha, -2 * cos_w0, 1 - alpha)
+        elif kind == 'highpass':
+            b = ((1 + cos_w0) / 2, -(1 + cos_w0), (1 + cos_w0) / 2)
+            den = (1 + alpha, -2 * cos_w0, 1 - alpha)
+        elif kind == 'peaking':
+            b = (1 + alpha * a, -2 * cos_w0, 1 - alpha * a)
+            den = (1 + alpha / a, -2 * cos_w0, 1 - alpha / a)
+        elif kind == 'lowshelf':
+            b = (
+                a * ((a + 1) - (a - 1) * cos_w0 + sqrt_a_alpha),
+                2 * a * ((a - 1) - (a + 1) * cos_w0),
+                a * ((a + 1) - (a - 1) * cos_w0 - sqrt_a_alpha),
+            )
+            den = (
+                (a + 1) + (a - 1) * cos_w0 + sqrt_a_alpha,
+                -2 * ((a - 1) + (a + 1) * cos_w0),
+                (a + 1) + (a - 1) * cos_w0 - sqrt_a_alpha,
+            )
+        else:
+            b = (
+                a * ((a + 1) + (a - 1) * cos_w0 + sqrt_a_alpha),
+                -2 * a * ((a - 1) + (a + 1) * cos_w0),
+                a * ((a + 1) + (a - 1) * cos_w0 - sqrt_a_alpha),
+            )
+            den = (
+                (a + 1) - (a - 1) * cos_w0 + sqrt_a_alpha,
+                2 * ((a - 1) - (a + 1) * cos_w0),
+                (a + 1) - (a - 1) * cos_w0 - sqrt_a_alpha,
+            )
+        self.b: Float64Array = numpy.array(b) / den[0]
+        self.a: Float64Array = numpy.array(den) / den[0]
+        # Filter state of both channels, one column per channel.
+        self.z: Float64Array = numpy.zeros((2, 2), dtype=numpy.float64)
+
+    def process(self, x: Float32Array) -> None:
+        y, self.z = scipy.signal.lfilter(self.b, self.a, x, axis=0, zi=self.z)
+        x[:] = y
+
+
+class LookAheadLimiter(Stage):
+    # A brickwall limiter: the signal is delayed by the look-ahead time, so the gain can already be
+    # lowered when a peak above the ceiling arrives.
+    # The gain is the minimum required gain over the look-ahead window (plus hold time),
+    # smoothed by a moving average over the look-ahead window. Every sample inside the average
+    # is already at or below the gain required by the outgoing sample, so the ceiling is never exceeded.
+    __slots__ = ['ceiling', 'lookahead', 'min_window', 'delay_line', 'required_history', 'min_history']
+
+    def __init__(
+        self,
+        ceiling_db: float = -1.0,
+        lookahead_ms: float = 5.0,
+        hold_ms: float = 0.0,
+        sample_rate: int = 48000,
+        budget_fraction: float = 0.1,
+    ) -> None:
+        super().__init__('limiter {:+.1f} dBFS'.format(ceiling_db), budget_fraction)
+        self.ceiling = 10 ** (ceiling_db / 20)
+        self.lookahead = max(1, round(lookahead_ms * sample_rate / 1000))
+        self.min_window = self.lookahead + 1 + max(0, round(hold_ms * sample_rate / 1000))
+        self.delay_line: Float32Array = numpy.zeros((self.lookahead, 2), dtype=numpy.float32)
+        self.required_history: Float64Array = numpy.ones(self.min_window - 1, dtype=numpy.float64)
+        self.min_history: Float64Array = numpy.ones(self.lookahead, dtype=numpy.float64)
+
+    @property
+    def latency_samples(self) -> int:
+        return self.lookahead
+
+    def process(self, x: Float32Array) -> None:
+        frame_size = x.shape[0]
+        peak = numpy.max(numpy.abs(x), axis=1).astype(numpy.float64)
+        required = numpy.minimum(1.0, self.ceiling / numpy.maximum(peak, 1e-12))
+
+        # Trailing minimum over min_window samples.
+        extended = numpy.concatenate((self.required_history, required))
+        self.required_history = extended[-(self.min_window - 1) :].copy() if self.min_window > 1 else extended[:0]
+        minimum = scipy.ndimage.minimum_filter1d(extended, self.min_window, origin=(self.min_window - 1) // 2)
+        minimum = minimum[-frame_size:]
+
+        # Trailing moving average over lookahead + 1 samples.
+        extended = numpy.concatenate((self.min_history, minimum))
+        self.min_history = extended[-self.lookahead :].copy()
+        cumulative = numpy.concatenate(((0.0,), numpy.cumsum(extended)))
+        gain = (cumulative[self.lookahead + 1 :] - cumulative[: -self.lookahead - 1]) / (self.lookahead + 1)
+
+        delayed = numpy.concatenate((self.delay_line, x))
+        self.delay_line = delayed[-self.lookahead :].copy()
+        numpy.multiply(delayed[:frame_size], gain[:, numpy.newaxis], out=x, casting='unsafe')
+
+
+class DSPChain:
+    # Runs the stages in order on each captured frame, in place, timing each of them.
+    __slots__ = ['stages']
+
+    def __init__(self, stages: typing.Sequence[Stage] = (), frame_ms: float = 20) -> None:
+        self.stages = list(stages)
+        for stage in self.stages:
+            stage.set_frame_ms(frame_ms)
+
+    @property
+    def latency_samples(self) -> int:
+        return sum(stage.latency_samples for stage in self.stages)
+
+    # Returns the stages that took longer than their budget on this frame.
+    def process(self, buffer: 'array.array[float]') -> typing.List[typing.Tuple[Stage, int]]:
+        overruns: typing.List[typing.Tuple[Stage, int]] = []
+        if not self.stages:
+            return overruns
+        x: Float32Array = numpy.frombuffer(buffer, dtype=numpy.float32).reshape((-1, 2))
+        for stage in self.stages:
+            start_ns = time.perf_counter_ns()
+            stage.process(x)
+            elapsed_ns = time.perf_counter_ns() - start_ns
+            stage.process_time.add(elapsed_ns)
+            if elapsed_ns > stage.budget_ns:
+                stage.overruns += 1
+                overruns.append((stage, elapsed_ns))
+        return overruns
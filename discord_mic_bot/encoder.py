@@ -0,0 +1,89 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import array
+import ctypes
+import threading
+import time
+import typing
+
+import discord
+
+from . import stats
+
+
+class EncoderProfile(typing.NamedTuple):
+    bitrate_kbps: int = 128
+    # FEC only works for voice, not music, and from my experience it hurts music quality severely.
+    fec_enabled: bool = False
+    # Discontinuous transmission: libopus emits a tiny packet for near-silent frames, which we do not send.
+    dtx_enabled: bool = False
+
+    def __str__(self) -> str:
+        return '{} Kbps, FEC {}, DTX {}'.format(
+            self.bitrate_kbps, 'on' if self.fec_enabled else 'off', 'on' if self.dtx_enabled else 'off'
+        )
+
+
+class ProfileEncoder:
+    # One Opus encoder per distinct EncoderProfile, shared by every voice channel using that profile.
+    __slots__ = ['profile', 'opus_encoder', 'opus_encoder_private', 'lock', 'encode_time']
+
+    def __init__(self, profile: EncoderProfile) -> None:
+        self.opus_encoder = discord.opus.Encoder()
+        # Use the private function just to satisfy my paranoid of 1 Kbps == 1000 bps.
+        # getattr is used to bypass the linter
+        self.opus_encoder_private = getattr(discord.opus, '_lib')
+        # Control calls come from the event loop while encoding happens on a worker thread.
+        self.lock = threading.Lock()
+        self.encode_time = stats.DurationMeter()
+        self.profile = profile
+        self.apply(profile)
+
+    def apply(self, profile: EncoderProfile) -> None:
+        bitrate_kbps = min(512, max(12, profile.bitrate_kbps))
+        with self.lock:
+            self.profile = profile
+            self.opus_encoder_private.opus_encoder_ctl(
+                getattr(self.opus_encoder, '_state'), discord.opus.CTL_SET_BITRATE, bitrate_kbps * 1000
+            )
+            if profile.fec_enabled:
+                self.opus_encoder.set_fec(True)
+                self.opus_encoder.set_expected_packet_loss_percent(0.15)
+            else:
+                self.opus_encoder.set_fec(False)
+                self.opus_encoder.set_expected_packet_loss_percent(0)
+            CTL_SET_DTX = 4016
+            self.opus_encoder_private.opus_encoder_ctl(
+                getattr(self.opus_encoder, '_state'), CTL_SET_DTX, 1 if profile.dtx_enabled else 0
+            )
+
+    def reset(self) -> None:
+        CTL_RESET_STATE = 4028
+        with self.lock:
+            self.opus_encoder_private.opus_encoder_ctl(getattr(self.opus_encoder, '_state'), CTL_RESET_STATE)
+
+    def encode(self, buffer: 'array.array[float]') -> bytes:
+        start_ns = time.perf_counter_ns()
+        c_buffer = ctypes.cast(buffer.buffer_info()[0], ctypes.POINTER(ctypes.c_float))
+        max_data_bytes = len(buffer) * 4
+        output = (ctypes.c_char * max_data_bytes)()
+        with self.lock:
+            output_len = self.opus_encoder_private.opus_encode_float(
+                getattr(self.opus_encoder, '_state'), c_buffer, len(buffer) // 2, output, max_data_bytes
+            )
+        self.encode_time.add(time.perf_counter_ns() - start_ns)
+        return bytes(output[:output_len])
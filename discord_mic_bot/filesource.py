@@ -0,0 +1,272 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import abc
+import mmap
+import os
+import struct
+import threading
+import time
+import typing
+
+import numpy
+import numpy.typing
+
+Float32Array: typing.TypeAlias = numpy.typing.NDArray[numpy.float32]
+
+# Raw files have no header. They are stereo, 48kHz and little-endian, and told apart by their extension.
+RAW_FORMATS = {'.f32': '<f4', '.s16': '<i2'}
+EXTENSIONS = ('.wav', *RAW_FORMATS)
+
+# (format tag, bits per sample) of the WAV sample formats we can play.
+WAVE_FORMATS = {(1, 16): '<i2', (3, 32): '<f4'}
+
+
+def _parse_wav(mapping: mmap.mmap) -> typing.Tuple[str, int, int, int, int]:
+    # Returns (dtype, channels, sample rate, offset of the samples, size of the samples in bytes).
+    if mapping[0:4] not in (b'RIFF', b'RF64') or mapping[8:12] != b'WAVE':
+        raise ValueError('Not a WAV file.')
+    offset = 12
+    sample_format: typing.Optional[typing.Tuple[str, int, int]] = None
+    # RF64 files over 4 GiB keep the real size of the data chunk in the ds64 chunk.
+    ds64_data_size: typing.Optional[int] = None
+    while offset + 8 <= len(mapping):
+        chunk_id = mapping[offset : offset + 4]
+        chunk_size: int = struct.unpack_from('<I', mapping, offset + 4)[0]
+        body = offset + 8
+        if chunk_id == b'ds64' and chunk_size >= 16:
+            ds64_data_size = struct.unpack_from('<Q', mapping, body + 8)[0]
+        elif chunk_id == b'fmt ' and chunk_size >= 16:
+            format_tag, channels, sample_rate = struct.unpack_from('<HHI', mapping, body)
+            bits: int = struct.unpack_from('<H', mapping, body + 14)[0]
+            # WAVE_FORMAT_EXTENSIBLE, the real format tag starts the sub-format GUID.
+            if format_tag == 0xFFFE and chunk_size >= 40:
+                format_tag = struct.unpack_from('<H', mapping, body + 24)[0]
+            dtype = WAVE_FORMATS.get((format_tag, bits))
+            if dtype is None:
+                raise ValueError('Only 16-bit integer and 32-bit float WAV files are supported.')
+            if channels == 0 or sample_rate == 0:
+                raise ValueError('Invalid WAV format.')
+            sample_format = dtype, channels, sample_rate
+        elif chunk_id == b'data':
+            if sample_format is None:
+                raise ValueError('WAV file without a format.')
+            if chunk_size == 0xFFFFFFFF and ds64_data_size is not None:
+                chunk_size = ds64_data_size
+            # A recording that was cut off may have its size left at 0 or past the end of the file.
+            available = len(mapping) - body
+            data_size = available if chunk_size == 0 else min(chunk_size, available)
+            return sample_format[0], sample_format[1], sample_format[2], body, data_size
+        offset = body + chunk_size + (chunk_size & 1)
+    raise ValueError('WAV file without samples.')
+
+
+class AudioFile(abc.ABC):
+    # A file FileSource can play, read as stereo float32 blocks.
+    __slots__ = ['path', 'sample_rate', 'channels', 'frames']
+
+    def __init__(self, path: str, sample_rate: int, channels: int, frames: int) -> None:
+        self.path = path
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.frames = frames
+
+    @property
+    def duration_s(self) -> float:
+        return self.frames / self.sample_rate
+
+    # Returns up to count frames from position on, shaped (frames, 2 channels). Fewer at the end of the file.
+    @abc.abstractmethod
+    def read(self, position: int, count: int) -> Float32Array: ...
+
+    def close(self) -> None:
+        pass
+
+
+class PCMFile(AudioFile):
+    # A WAV or raw PCM file, memory-mapped: only the pages being played are read, however large the file is.
+    __slots__ = ['file', 'mapping', 'samples']
+
+    def __init__(self, path: str) -> None:
+        self.file = open(path, 'rb')
+        try:
+            if os.fstat(self.file.fileno()).st_size == 0:
+                raise ValueError('The file is empty.')
+            self.mapping = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            raw_dtype = RAW_FORMATS.get(os.path.splitext(path)[1].lower())
+            if raw_dtype is not None:
+                dtype, channels, sample_rate, offset, size = raw_dtype, 2, 48000, 0, len(self.mapping)
+            else:
+                dtype, channels, sample_rate, offset, size = _parse_wav(self.mapping)
+            frames = size // (numpy.dtype(dtype).itemsize * channels)
+            super().__init__(path, sample_rate, channels, frames)
+            # A view of the mapping, nothing is read until a block is played.
+            self.samples = numpy.frombuffer(self.mapping, dtype=dtype, count=frames * channels, offset=offset).reshape(
+                (frames, channels)
+            )
+        except BaseException:
+            self.file.close()
+            raise
+
+    def read(self, position: int, count: int) -> Float32Array:
+        block = self.samples[position : position + count]
+        if block.dtype == numpy.int16:
+            x = block.astype(numpy.float32)
+            x *= 1 / 32768
+        else:
+            x = typing.cast(Float32Array, block)
+        if self.channels == 1:
+            return numpy.repeat(x, 2, axis=1)
+        if self.channels > 2:
+            return numpy.ascontiguousarray(x[:, :2])
+        return x
+
+    def close(self) -> None:
+        self.samples = numpy.zeros((0, self.channels), dtype=numpy.float32)
+        try:
+            self.mapping.close()
+        except BufferError:
+            # A block is still being used somewhere, the mapping is closed once that is gone.
+            pass
+        self.file.close()
+
+
+class PacedSource(abc.ABC):
+    # Hands on the audio of a file on its own thread, each piece when it is due by the system clock, as a sound
+    # card would deliver it.
+    __slots__ = ['sample_rate', 'loop', 'position', 'seek_position', 'seek_lock', 'stopped', 'thread']
+
+    def __init__(self, sample_rate: int, loop: bool = False) -> None:
+        self.sample_rate = sample_rate
+        self.loop = loop
+        # Only changed by the playing thread, other threads ask for a seek through seek_position.
+        self.position = 0
+        self.seek_position: typing.Optional[int] = None
+        # Taking a seek reads and clears seek_position in one step, so a seek asked for in between is not lost.
+        self.seek_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='discord-mic-bot-file-source', daemon=True)
+
+    @property
+    @abc.abstractmethod
+    def duration_s(self) -> float: ...
+
+    @property
+    def position_s(self) -> float:
+        with self.seek_lock:
+            seek_position = self.seek_position
+        position = self.position if seek_position is None else seek_position
+        return min(max(0, position) / self.sample_rate, self.duration_s)
+
+    def seek(self, seconds: float) -> None:
+        seek_position = min(round(self.duration_s * self.sample_rate), max(0, round(seconds * self.sample_rate)))
+        with self.seek_lock:
+            self.seek_position = seek_position
+
+    # Called by the playing thread. Returns the position of the last seek asked for, if any, and clears it.
+    def _take_seek(self) -> typing.Optional[int]:
+        with self.seek_lock:
+            seek_position = self.seek_position
+            self.seek_position = None
+        return seek_position
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.close()
+
+    def close(self) -> None:
+        pass
+
+    def _run(self) -> None:
+        sample_rate = self.sample_rate
+        start_ns = time.monotonic_ns()
+        played = 0
+        last_samples = 0
+        while True:
+            due_ns = start_ns + played * 1000000000 // sample_rate
+            delay_ns = due_ns - time.monotonic_ns()
+            if delay_ns > 0:
+                if self.stopped.wait(delay_ns / 1000000000):
+                    return
+            elif self.stopped.is_set():
+                return
+            elif delay_ns < -5 * last_samples * 1000000000 // sample_rate:
+                # Way behind, e.g. after the computer slept. Carry on from here instead of catching up in a burst.
+                start_ns = time.monotonic_ns()
+                played = 0
+                due_ns = start_ns
+            last_samples = self._play_next(due_ns)
+            played += last_samples
+
+    # Hands on the next piece of audio, returns how many samples it lasts.
+    @abc.abstractmethod
+    def _play_next(self, due_ns: int) -> int: ...
+
+
+class FileSource(PacedSource):
+    # Plays an AudioFile a block per frame duration. Past the end of the file it plays silence, unless it loops.
+    __slots__ = ['audio_file', 'block_size', 'callback']
+
+    def __init__(
+        self,
+        audio_file: AudioFile,
+        frame_ms: int,
+        callback: typing.Callable[[Float32Array, int], None],
+        loop: bool = False,
+    ) -> None:
+        super().__init__(audio_file.sample_rate, loop)
+        self.audio_file = audio_file
+        self.block_size = audio_file.sample_rate * frame_ms // 1000
+        # Called with each block, shaped (block size, 2 channels), and the time it was due.
+        self.callback = callback
+
+    @property
+    def duration_s(self) -> float:
+        return self.audio_file.duration_s
+
+    def close(self) -> None:
+        self.audio_file.close()
+
+    def _play_next(self, due_ns: int) -> int:
+        self.callback(self._read_block(), due_ns)
+        return self.block_size
+
+    def _read_block(self) -> Float32Array:
+        audio_file = self.audio_file
+        seek_position = self._take_seek()
+        if seek_position is not None:
+            self.position = seek_position
+        position = self.position
+        if position >= audio_file.frames:
+            if not self.loop or audio_file.frames == 0:
+                return numpy.zeros((self.block_size, 2), dtype=numpy.float32)
+            position = 0
+        block = audio_file.read(position, self.block_size)
+        position += len(block)
+        if len(block) < self.block_size:
+            rest = self.block_size - len(block)
+            if self.loop:
+                wrapped = audio_file.read(0, rest)
+                position = len(wrapped)
+                block = numpy.concatenate((block, wrapped))
+            block = numpy.concatenate((block, numpy.zeros((self.block_size - len(block), 2), dtype=numpy.float32)))
+        self.position = position
+        return block
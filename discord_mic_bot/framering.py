@@ -0,0 +1,103 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import array
+import typing
+
+
+class FrameRing:
+    # Single-producer single-consumer ring buffer of audio frames.
+    # The producer is the PortAudio callback, the consumer is the encoder.
+    # Neither side takes a lock or waits for the other: each index is only ever written by one side,
+    # and a plain attribute store is atomic under the GIL.
+    #
+    # The slots are preallocated float32 buffers and double as a frame pool:
+    # the producer copies into a free slot, the consumer borrows it with peek() and
+    # gives it back with release() once everything reading the frame is done.
+    # Steady-state capture therefore allocates nothing.
+    __slots__ = [
+        'capacity',
+        'frame_bytes',
+        'slots',
+        'slot_views',
+        'capture_ns',
+        'write_ns',
+        'sizes',
+        'read_index',
+        'write_index',
+    ]
+
+    def __init__(self, capacity: int, frame_samples: int) -> None:
+        self.capacity = capacity
+        self.frame_bytes = frame_samples * 4
+        self.slots: typing.List['array.array[float]'] = [
+            array.array('f', bytes(self.frame_bytes)) for _ in range(capacity)
+        ]
+        self.slot_views = [memoryview(slot).cast('B') for slot in self.slots]
+        # When each frame was captured by the sound card and when it was written, for latency measurements.
+        self.capture_ns = array.array('q', bytes(8 * capacity))
+        self.write_ns = array.array('q', bytes(8 * capacity))
+        # How many bytes of each slot were written, before padding.
+        self.sizes = array.array('q', bytes(8 * capacity))
+        # Both indices increase monotonically, the slot is the index modulo capacity.
+        self.read_index = 0
+        self.write_index = 0
+
+    def __len__(self) -> int:
+        return self.write_index - self.read_index
+
+    # Producer side. Returns False if the ring is full and the frame is dropped.
+    # A short frame is padded with silence, a long one is truncated.
+    def write(self, data: typing.Any, capture_ns: int = 0, write_ns: int = 0) -> bool:
+        write_index = self.write_index
+        if write_index - self.read_index >= self.capacity:
+            return False
+        slot = write_index % self.capacity
+        self.capture_ns[slot] = capture_ns
+        self.write_ns[slot] = write_ns
+        view = self.slot_views[slot]
+        data_bytes = len(data)
+        if data_bytes == self.frame_bytes:
+            view[:] = data
+        elif data_bytes > self.frame_bytes:
+            view[:] = memoryview(data)[: self.frame_bytes]
+            data_bytes = self.frame_bytes
+        else:
+            view[:data_bytes] = data
+            view[data_bytes:] = bytes(self.frame_bytes - data_bytes)
+        self.sizes[slot] = data_bytes
+        self.write_index = write_index + 1
+        return True
+
+    # Consumer side. Returns None if the ring is empty.
+    # The returned buffer stays valid until release() is called.
+    def peek(self) -> typing.Optional['array.array[float]']:
+        read_index = self.read_index
+        if read_index == self.write_index:
+            return None
+        return self.slots[read_index % self.capacity]
+
+    # Returns (capture time, write time) of the frame returned by peek().
+    def peek_stamps(self) -> typing.Tuple[int, int]:
+        slot = self.read_index % self.capacity
+        return self.capture_ns[slot], self.write_ns[slot]
+
+    # Returns how many bytes of the frame returned by peek() were written, the rest is padding.
+    def peek_size(self) -> int:
+        return self.sizes[self.read_index % self.capacity]
+
+    def release(self) -> None:
+        self.read_index += 1
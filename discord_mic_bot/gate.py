@@ -0,0 +1,144 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import array
+import math
+import typing
+
+import numpy
+import numpy.typing
+
+# For unknown reason, VoiceMeeter on Windows generates constant
+# noise in range [-1/32768, +1/32768] even I set the soundcard
+# to 48kHz 24-bit mode.
+# Okay, I know 24-bit is too good for human's ear, but it is
+# your fault to reduce the quality to 15-bit.
+DEFAULT_THRESHOLD_DBFS = 20 * math.log10(3 / 65536)
+
+
+class VoiceActivityGate:
+    # Peak-level gate deciding whether a frame carries sound.
+    # The gate opens after the peak stays at or above the threshold for the attack time,
+    # and closes after the peak stays below (threshold - hysteresis) for the hold time.
+    __slots__ = [
+        'open_threshold',
+        'close_threshold',
+        'attack_frames',
+        'hold_frames',
+        'close_tail_frames',
+        'is_open',
+        'loud_frames',
+        'quiet_frames',
+        'closed_frames',
+        'suppressed_frames',
+        'views',
+    ]
+
+    # When there's a break in the sent data, the packet transmission shouldn't simply stop. Instead, send five frames of silence (0xF8, 0xFF, 0xFE) before stopping to avoid unintended Opus interpolation with subsequent transmissions.
+    # -- Discord SDK
+    tail_frames = 5
+    # The capture buffers are a few ring slots reused over and over, their views are kept up to this many.
+    max_views = 16
+
+    def __init__(
+        self,
+        threshold_dbfs: float = DEFAULT_THRESHOLD_DBFS,
+        hysteresis_db: float = 0.0,
+        attack_ms: float = 0.0,
+        hold_ms: float = 20.0,
+        frame_ms: float = 20.0,
+    ) -> None:
+        # Compare peaks in linear scale, so no logarithm is computed per frame.
+        self.open_threshold = 10 ** (threshold_dbfs / 20)
+        self.close_threshold = 10 ** ((threshold_dbfs - max(0.0, hysteresis_db)) / 20)
+        self.attack_frames = max(1, math.ceil(attack_ms / frame_ms))
+        self.hold_frames = max(0, math.ceil(hold_ms / frame_ms))
+        # The quiet frames held before closing are part of the tail, so the tail is five frames in all.
+        self.close_tail_frames = max(0, self.tail_frames - self.hold_frames)
+        self.is_open = False
+        self.loud_frames = 0
+        self.quiet_frames = 0
+        self.closed_frames = self.tail_frames + 1
+        # Frames that are neither encoded nor sent because the gate is closed.
+        self.suppressed_frames = 0
+        # id of the buffer -> (buffer, float32 view of it). The buffer is kept so its id is not reused.
+        self.views: typing.Dict[int, typing.Tuple['array.array[float]', numpy.typing.NDArray[numpy.float32]]] = {}
+
+    def process(self, buffer: 'array.array[float]') -> bool:
+        # A zero-copy view of the capture buffer, made once per buffer.
+        # numpy.max and numpy.min do not allocate a temporary array like numpy.abs would.
+        view = self.views.get(id(buffer))
+        if view is None:
+            if len(self.views) >= self.max_views:
+                # The ring was replaced, e.g. by another source, forget the views of the old one.
+                self.views.clear()
+            view = (buffer, numpy.frombuffer(buffer, dtype=numpy.float32))
+            self.views[id(buffer)] = view
+        samples = view[1]
+        peak = max(float(numpy.max(samples)), -float(numpy.min(samples))) if len(samples) != 0 else 0.0
+
+        if self.is_open:
+            if peak >= self.close_threshold:
+                self.quiet_frames = 0
+            else:
+                self._quiet()
+        elif peak >= self.open_threshold:
+            self.loud_frames += 1
+            if self.loud_frames >= self.attack_frames:
+                self.is_open = True
+                self.quiet_frames = 0
+        else:
+            self.loud_frames = 0
+        return self._update()
+
+    # Treats the frame as silent without looking at it, e.g. when muted.
+    def process_silence(self) -> bool:
+        self.loud_frames = 0
+        if self.is_open:
+            self._quiet()
+        return self._update()
+
+    # Treats the frame as carrying sound without looking at it, e.g. for Opus packets sent as they are.
+    def process_sound(self) -> bool:
+        self.is_open = True
+        self.loud_frames = 0
+        self.quiet_frames = 0
+        return self._update()
+
+    def _quiet(self) -> None:
+        self.quiet_frames += 1
+        if self.quiet_frames > self.hold_frames:
+            self.is_open = False
+            self.loud_frames = 0
+
+    def _update(self) -> bool:
+        if self.is_open:
+            self.closed_frames = 0
+        else:
+            self.closed_frames += 1
+            if not self.transmitting:
+                self.suppressed_frames += 1
+        return self.is_open
+
+    # Whether the current frame should be encoded and sent, including the silent tail after the gate closes.
+    @property
+    def transmitting(self) -> bool:
+        return self.closed_frames <= self.close_tail_frames
+
+    def take_suppressed_frames(self) -> int:
+        suppressed_frames = self.suppressed_frames
+        self.suppressed_frames = 0
+        return suppressed_frames
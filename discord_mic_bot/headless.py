@@ -0,0 +1,291 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Runs the bot without the Tk window, e.g. on a server without a display.
+# Nothing here imports tkinter, so the machine spends its CPU on audio only.
+
+import argparse
+import asyncio
+import concurrent.futures
+import signal
+import threading
+import tomllib
+import traceback
+import typing
+
+import discord
+
+from . import gate, model_thread_from_environment
+
+if typing.TYPE_CHECKING:
+    from . import model
+
+
+class JoinTarget(typing.NamedTuple):
+    guild_id: typing.Optional[int]
+    channel_id: int
+
+
+class HeadlessConfig:
+    __slots__ = [
+        'hostapi',
+        'device',
+        'loop',
+        'start_s',
+        'bitrate_kbps',
+        'fec_enabled',
+        'dtx_enabled',
+        'joins',
+        'channel_profiles',
+        'gate',
+    ]
+
+    def __init__(self) -> None:
+        self.hostapi: typing.Optional[str] = None
+        self.device: typing.Optional[str] = None
+        # Only used when the device is an audio file.
+        self.loop: typing.Optional[bool] = None
+        self.start_s: typing.Optional[float] = None
+        self.bitrate_kbps: typing.Optional[int] = None
+        self.fec_enabled: typing.Optional[bool] = None
+        self.dtx_enabled: typing.Optional[bool] = None
+        self.joins: typing.List[JoinTarget] = []
+        # EncoderProfile fields set for single channels, the others follow the default profile.
+        self.channel_profiles: typing.Dict[int, typing.Dict[str, typing.Any]] = {}
+        # Keyword arguments of Model.set_voice_gate.
+        self.gate: typing.Dict[str, float] = {}
+
+
+# Accepts either a channel ID, or a guild ID and a channel ID separated by a slash.
+def parse_join_target(value: str) -> JoinTarget:
+    guild, _, channel = value.strip().rpartition('/')
+    try:
+        return JoinTarget(int(guild) if guild else None, int(channel))
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected CHANNEL_ID or GUILD_ID/CHANNEL_ID, got {!r}'.format(value))
+
+
+def parse_arguments(argv: typing.Optional[typing.Sequence[str]] = None) -> HeadlessConfig:
+    parser = argparse.ArgumentParser(
+        prog='discord-mic-bot-headless', description='Discord bot to connect to your microphone, without a window.'
+    )
+    parser.add_argument('-c', '--config', help='TOML config file, command line flags override it')
+    parser.add_argument('--hostapi', help='audio host API, the first one if omitted')
+    parser.add_argument('--device', help='input device, the default one of the host API if omitted')
+    parser.add_argument('--loop', action=argparse.BooleanOptionalAction, help='loop the audio file being played')
+    parser.add_argument('--start', type=float, metavar='SECONDS', help='start the audio file being played from here')
+    parser.add_argument('--bitrate', type=int, help='Opus bitrate in Kbps')
+    parser.add_argument('--fec', action=argparse.BooleanOptionalAction, help='Opus forward error correction')
+    parser.add_argument('--dtx', action=argparse.BooleanOptionalAction, help='skip near-silent packets')
+    parser.add_argument(
+        '--join',
+        action='append',
+        default=[],
+        type=parse_join_target,
+        metavar='[GUILD_ID/]CHANNEL_ID',
+        help='voice channel to join once logged in, may be repeated',
+    )
+    args = parser.parse_args(argv)
+
+    config = HeadlessConfig()
+    if args.config is not None:
+        try:
+            with open(args.config, 'rb') as f:
+                load_config_file(config, tomllib.load(f))
+        except (OSError, tomllib.TOMLDecodeError, TypeError, ValueError) as exc:
+            parser.error('unable to load {}: {}'.format(args.config, exc))
+    if args.hostapi is not None:
+        config.hostapi = args.hostapi
+    if args.device is not None:
+        config.device = args.device
+    if args.loop is not None:
+        config.loop = args.loop
+    if args.start is not None:
+        config.start_s = args.start
+    if args.bitrate is not None:
+        config.bitrate_kbps = args.bitrate
+    if args.fec is not None:
+        config.fec_enabled = args.fec
+    if args.dtx is not None:
+        config.dtx_enabled = args.dtx
+    config.joins.extend(typing.cast(typing.List[JoinTarget], args.join))
+    return config
+
+
+# The config file looks like:
+#
+#   hostapi = "ALSA"
+#   device = "default"
+#   loop = false
+#   start = 0.0
+#   bitrate = 128
+#   fec = false
+#   dtx = false
+#   join = ["123456789012345678", "123456789012345678/234567890123456789"]
+#
+#   [gate]
+#   threshold_dbfs = -60.0
+#   hysteresis_db = 6.0
+#   attack_ms = 0.0
+#   hold_ms = 200.0
+#
+#   [channels.234567890123456789]
+#   bitrate = 64
+#   fec = true
+def load_config_file(config: HeadlessConfig, document: typing.Dict[str, typing.Any]) -> None:
+    if 'hostapi' in document:
+        config.hostapi = str(document['hostapi'])
+    if 'device' in document:
+        config.device = str(document['device'])
+    if 'loop' in document:
+        config.loop = bool(document['loop'])
+    if 'start' in document:
+        config.start_s = float(document['start'])
+    if 'bitrate' in document:
+        config.bitrate_kbps = int(document['bitrate'])
+    if 'fec' in document:
+        config.fec_enabled = bool(document['fec'])
+    if 'dtx' in document:
+        config.dtx_enabled = bool(document['dtx'])
+    for value in typing.cast(typing.List[typing.Any], document.get('join', [])):
+        try:
+            config.joins.append(parse_join_target(str(value)))
+        except argparse.ArgumentTypeError as exc:
+            raise ValueError(str(exc))
+    gate_table = typing.cast(typing.Dict[str, typing.Any], document.get('gate', {}))
+    for key in ('threshold_dbfs', 'hysteresis_db', 'attack_ms', 'hold_ms'):
+        if key in gate_table:
+            config.gate[key] = float(gate_table[key])
+    channels_table = typing.cast(typing.Dict[str, typing.Dict[str, typing.Any]], document.get('channels', {}))
+    for channel_id, channel_table in channels_table.items():
+        overrides: typing.Dict[str, typing.Any] = {}
+        if 'bitrate' in channel_table:
+            overrides['bitrate_kbps'] = int(channel_table['bitrate'])
+        if 'fec' in channel_table:
+            overrides['fec_enabled'] = bool(channel_table['fec'])
+        if 'dtx' in channel_table:
+            overrides['dtx_enabled'] = bool(channel_table['dtx'])
+        config.channel_profiles[int(channel_id)] = overrides
+
+
+async def configure(m: 'model.Model', config: HeadlessConfig) -> None:
+    hostapis = m.list_sound_hostapis()
+    hostapi = config.hostapi
+    if hostapi is None and len(hostapis) != 0:
+        hostapi = hostapis[0]
+    if hostapi not in hostapis:
+        m.logger.error('Unknown host API: {}. Available: {}'.format(hostapi, ', '.join(hostapis)))
+    else:
+        devices = m.list_sound_input_devices(hostapi)
+        device = config.device
+        if device is None:
+            device = next((i.name for i in devices if i.is_default), None)
+        if device is None or m.sound_devices.lookup(hostapi, device) is None:
+            m.logger.error(
+                'Unknown input device: {}. Available on {}: {}'.format(
+                    device, hostapi, ', '.join(i.name for i in devices)
+                )
+            )
+        else:
+            m.logger.info('Recording from: {} / {}'.format(hostapi, device))
+            if config.loop is not None:
+                m.set_file_loop(config.loop)
+            m.start_recording(hostapi, device)
+            if config.start_s is not None:
+                m.seek_file(config.start_s)
+
+    if config.bitrate_kbps is not None:
+        await m.set_bitrate(config.bitrate_kbps)
+    if config.fec_enabled is not None:
+        await m.set_fec_enabled(config.fec_enabled)
+    if config.dtx_enabled is not None:
+        await m.set_dtx_enabled(config.dtx_enabled)
+    if config.gate:
+        m.set_voice_gate(
+            config.gate.get('threshold_dbfs', gate.DEFAULT_THRESHOLD_DBFS),
+            config.gate.get('hysteresis_db', 0.0),
+            config.gate.get('attack_ms', 0.0),
+            config.gate.get('hold_ms', 20.0),
+        )
+
+    # Model.run may still be starting the metrics server, wait_until_ready only works once it has logged in.
+    await m.logged_in.wait()
+    await m.discord_client.wait_until_ready()
+    for target in config.joins:
+        channel = m.discord_client.get_channel(target.channel_id)
+        if not isinstance(channel, discord.VoiceChannel) or (
+            target.guild_id is not None and channel.guild.id != target.guild_id
+        ):
+            m.logger.error('Voice channel not found: {}'.format(target.channel_id))
+            continue
+        overrides = config.channel_profiles.get(channel.id)
+        if overrides is not None:
+            # On top of the default profile as configured above, not the built-in one.
+            m.set_channel_encoder_profile(channel, m.default_encoder_profile._replace(**overrides))
+        m.logger.info('Joining: {} / {}'.format(channel.guild.name, channel.name))
+        await m.join_voice(channel)
+
+
+def main(argv: typing.Optional[typing.Sequence[str]] = None) -> None:
+    config = parse_arguments(argv)
+
+    model_thread = model_thread_from_environment()
+    if model_thread is None:
+        return
+    model_thread.start()
+    m = model_thread.init_finished.result()
+
+    stop_requested = threading.Event()
+
+    def on_signal(signum: int, frame: typing.Any) -> None:
+        stop_requested.set()
+
+    signal.signal(signal.SIGINT, on_signal)
+    signal.signal(signal.SIGTERM, on_signal)
+    # kill -USR1 dumps the per-stage latency to the log.
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: m.loop.call_soon_threadsafe(m.log_latency))
+
+    def on_configured(future: 'concurrent.futures.Future[None]') -> None:
+        if not future.cancelled() and future.exception() is not None:
+            traceback.print_exception(future.exception())
+
+    try:
+        asyncio.run_coroutine_threadsafe(configure(m, config), m.loop).add_done_callback(on_configured)
+        # Wake up now and then, so the model thread ending on its own (e.g. a login failure) also ends the daemon.
+        while model_thread.is_alive() and not stop_requested.wait(1.0):
+            pass
+    finally:
+        # The model thread may have ended on its own and closed its loop, then there is nothing left to stop.
+        if model_thread.is_alive() and not m.loop.is_closed():
+            try:
+                shutdown_finished = m.stop()
+            except RuntimeError:
+                # The loop closed between the check and scheduling the shutdown.
+                pass
+            else:
+                # If the loop stops before running the shutdown, the thread ending is all there is to wait for.
+                while model_thread.is_alive():
+                    try:
+                        shutdown_finished.result(1.0)
+                    except concurrent.futures.TimeoutError:
+                        continue
+                    break
+        model_thread.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import typing
+
+from . import stats
+
+
+class FrameLatency:
+    # Where each captured frame spends its time on the way from the sound card to the network.
+    # Every stage is measured from the stamp of the stage before it, total is from the ADC to the last send.
+    __slots__ = ['input', 'queue', 'prepare', 'encode_wait', 'encode', 'packet', 'send', 'total']
+
+    descriptions = (
+        ('input', 'sound card to callback'),
+        ('queue', 'waiting in the frame ring'),
+        ('prepare', 'DSP, gate and speaking state'),
+        ('encode_wait', 'hop to the encoder'),
+        ('encode', 'Opus encoding'),
+        ('packet', 'building and encrypting packets'),
+        ('send', 'pacing and socket send'),
+        ('total', 'sound card to network'),
+    )
+
+    def __init__(self, window_frames: int) -> None:
+        self.input = stats.RollingLatency(window_frames)
+        self.queue = stats.RollingLatency(window_frames)
+        self.prepare = stats.RollingLatency(window_frames)
+        self.encode_wait = stats.RollingLatency(window_frames)
+        self.encode = stats.RollingLatency(window_frames)
+        self.packet = stats.RollingLatency(window_frames)
+        self.send = stats.RollingLatency(window_frames)
+        self.total = stats.RollingLatency(window_frames)
+
+    # Returns (stage, description, count, p50 in ms, p99 in ms, max in ms) of each stage, in frame order.
+    def report(self) -> typing.List[typing.Tuple[str, str, int, float, float, float]]:
+        result: typing.List[typing.Tuple[str, str, int, float, float, float]] = []
+        for stage, description in self.descriptions:
+            histogram = typing.cast(stats.RollingLatency, getattr(self, stage))
+            result.append((stage, description, *histogram.percentiles()))
+        return result
@@ -17,67 +17,273 @@
 import array
 import asyncio
 import concurrent.futures
+import math
 import threading
+import time
 import typing
 
 import numpy
 import numpy.typing
 import scipy.signal
 
+from . import stats
+
 Float32Array: typing.TypeAlias = numpy.typing.NDArray[numpy.float32]
 Float64Array: typing.TypeAlias = numpy.typing.NDArray[numpy.float64]
 
 
 class LUMeter:
-    __slots__ = ['loop', 'buffer', 'zl', 'zr', 'lock', 'executor']
+    __slots__ = [
+        'loop',
+        'buffer',
+        'position',
+        'sums',
+        'z',
+        'block_sums',
+        'block_position',
+        'blocks',
+        'block_count',
+        'gating_histogram',
+        'short_term_histogram',
+        'short_term_energy',
+        'true_peak_history',
+        'true_peak',
+        'lock',
+        'executor',
+        'push_time',
+    ]
+    # 400ms at 48kHz sample rate
+    window_size = 19200
+    # EBU R 128 measures in 100ms steps: gating blocks are 4 steps, short-term windows are 30 steps.
+    block_size = 4800
+    gating_blocks = 4
+    short_term_blocks = 30
+    # Block loudness histograms from -70 LUFS (the absolute gate) upward in 0.1 LU bins,
+    # so the gated measurements need constant memory however long the session is.
+    histogram_floor = -70.0
+    histogram_resolution = 0.1
+    histogram_bins = 800
     # ITU-R BS.1770 coefficients at 48kHz sample rate
     # If you are looking for a set of sample-rate-irrelevant version, check out https://github.com/BrechtDeMan/loudness.py
     coeff_b: Float64Array = numpy.array(
         [1.53512485958697, -5.76194590858032, 8.11691004925258, -5.08848181111208, 1.19839281085285]
     )
     coeff_a: Float64Array = numpy.array([1, -3.68070674801639, 5.08704524797113, -3.13154635144673, 0.72520888847787])
+    # 4x oversampling interpolation filter for true-peak, split into 4 polyphase branches of 12 taps each,
+    # in the spirit of ITU-R BS.1770-4 Annex 2.
+    # Stored as a (12 taps, 4 phases) matrix with the taps reversed, so one matrix product of the sliding
+    # windows of the input yields all 4 phases. An FIR has no feedback, so float32 is precise enough.
+    true_peak_taps: Float32Array = numpy.ascontiguousarray(
+        (typing.cast(Float64Array, scipy.signal.firwin(48, 0.25, window=('kaiser', 5.0))) * 4)
+        .reshape((12, 4))[::-1]
+        .astype(numpy.float32)
+    )
 
     def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
         self.loop = loop
-        self.buffer: Float32Array = numpy.zeros((2, 19200), dtype=numpy.float32)
-        self.zl = typing.cast(Float64Array, scipy.signal.lfilter_zi(self.coeff_b, self.coeff_a))
-        self.zr = self.zl.copy()
+        # A circular buffer of the squared K-weighted samples, with running per-channel sums,
+        # so a push costs O(frame) and a read costs O(1).
+        self.buffer: Float64Array = numpy.zeros((self.window_size, 2), dtype=numpy.float64)
+        self.position = 0
+        self.sums: Float64Array = numpy.zeros(2, dtype=numpy.float64)
+        # Filter state of both channels, one column per channel.
+        # Kept in float64: the K-weighting filter has poles close to the unit circle and loses
+        # several dB at low frequencies if run in float32.
+        self.z = self._initial_filter_state()
+        # Energy of the current 100ms step, per channel.
+        self.block_sums: Float64Array = numpy.zeros(2, dtype=numpy.float64)
+        self.block_position = 0
+        # Mean square of the last 30 steps, per channel, as a circular buffer.
+        self.blocks: Float64Array = numpy.zeros((self.short_term_blocks, 2), dtype=numpy.float64)
+        self.block_count = 0
+        # Each histogram holds the number of blocks and the sum of their energies per bin.
+        self.gating_histogram: Float64Array = numpy.zeros((2, self.histogram_bins), dtype=numpy.float64)
+        self.short_term_histogram: Float64Array = numpy.zeros((2, self.histogram_bins), dtype=numpy.float64)
+        self.short_term_energy = 0.0
+        # The last 11 input samples of each channel, needed by the 12-tap interpolation filter.
+        self.true_peak_history: Float32Array = numpy.zeros((11, 2), dtype=numpy.float32)
+        self.true_peak = 0.0
         self.lock = threading.Lock()
         self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        # The last 3000 frames, 1 minute at 20ms.
+        self.push_time = stats.RollingLatency(3000)
 
     async def push(self, buffer: 'array.array[float]') -> None:
         if len(buffer) == 0:
             return
-        if len(buffer) > 38400:
-            buffer = buffer[-38400:]
+        if len(buffer) > self.window_size * 2:
+            buffer = buffer[-self.window_size * 2 :]
         await self.loop.run_in_executor(self.executor, self._push, buffer)
 
+    # Same as push, but usable from threads outside the event loop.
+    def submit(self, buffer: 'array.array[float]') -> concurrent.futures.Future[None]:
+        if len(buffer) > self.window_size * 2:
+            buffer = buffer[-self.window_size * 2 :]
+        return self.executor.submit(self._push, buffer)
+
+    # Silence before the first sample. lfilter_zi would be the state after a full-scale DC input, whose transient
+    # reads several LU too loud in the first gating blocks of a quiet signal.
+    def _initial_filter_state(self) -> Float64Array:
+        return numpy.zeros((max(len(self.coeff_a), len(self.coeff_b)) - 1, 2), dtype=numpy.float64)
+
     def _push(self, buffer: 'array.array[float]') -> None:
-        frame_size = len(buffer) // 2
-        x: Float64Array = numpy.array(buffer).reshape((2, -1), order='F')
-        numpy.nan_to_num(x, copy=False)
-        if not numpy.all(numpy.isfinite(self.zl)):
-            self.zl = typing.cast(Float64Array, scipy.signal.lfilter_zi(self.coeff_b, self.coeff_a))
-        if not numpy.all(numpy.isfinite(self.zr)):
-            self.zr = typing.cast(Float64Array, scipy.signal.lfilter_zi(self.coeff_b, self.coeff_a))
-        yl, self.zl = typing.cast(
-            tuple[Float64Array, Float64Array], scipy.signal.lfilter(self.coeff_b, self.coeff_a, x[0], zi=self.zl)
-        )
-        yr, self.zr = typing.cast(
-            tuple[Float64Array, Float64Array], scipy.signal.lfilter(self.coeff_b, self.coeff_a, x[1], zi=self.zr)
-        )
+        start_ns = time.perf_counter_ns()
+        # A zero-copy view of the interleaved capture buffer, one column per channel.
+        x: Float32Array = numpy.frombuffer(buffer, dtype=numpy.float32).reshape((-1, 2))
+        frame_size = x.shape[0]
+        y = self._k_weight(x)
+        squares = numpy.square(y, out=y)
+        energy: Float64Array = squares.sum(axis=0)
+        true_peak = self._true_peak(x)
+        # Instead of checking the filter state, check the two sums we need anyway:
+        # a NaN or infinity anywhere in the input ends up there.
+        if not (math.isfinite(energy[0]) and math.isfinite(energy[1])):
+            self.z = self._initial_filter_state()
+            self.true_peak_history[:] = 0.0
+            squares[:] = 0.0
+            energy[:] = 0.0
+            true_peak = 0.0
+
         with self.lock:
-            self.buffer[:, :-frame_size] = self.buffer[:, frame_size:]
-            numpy.square(yl, out=self.buffer[0, -frame_size:])
-            numpy.square(yr, out=self.buffer[1, -frame_size:])
-            numpy.nan_to_num(self.buffer[-frame_size:], copy=False)
+            end = self.position + frame_size
+            if end <= self.window_size:
+                self._replace(self.position, end, squares, energy)
+            else:
+                split = self.window_size - self.position
+                self._replace(self.position, self.window_size, squares[:split], squares[:split].sum(axis=0))
+                self._replace(0, end - self.window_size, squares[split:], squares[split:].sum(axis=0))
+            if end >= self.window_size:
+                # Once per window, recompute the sums from scratch so rounding errors never accumulate.
+                self.buffer.sum(axis=0, out=self.sums)
+            self.position = end % self.window_size
+
+            if true_peak > self.true_peak:
+                self.true_peak = true_peak
+            start = 0
+            while start < frame_size:
+                length = min(frame_size - start, self.block_size - self.block_position)
+                if length == frame_size:
+                    self.block_sums += energy
+                else:
+                    self.block_sums += squares[start : start + length].sum(axis=0)
+                self.block_position += length
+                start += length
+                if self.block_position == self.block_size:
+                    self._finish_block()
+        self.push_time.add(time.perf_counter_ns() - start_ns)
+
+    # Both channels are filtered in one call along the time axis.
+    def _k_weight(self, x: Float32Array) -> Float64Array:
+        y, self.z = scipy.signal.lfilter(self.coeff_b, self.coeff_a, x, axis=0, zi=self.z)
+        return y
+
+    # Must be called with lock held.
+    def _finish_block(self) -> None:
+        self.blocks[self.block_count % self.short_term_blocks] = self.block_sums / self.block_size
+        self.block_count += 1
+        self.block_sums[:] = 0.0
+        self.block_position = 0
+
+        if self.block_count >= self.gating_blocks:
+            indices = [(self.block_count - i) % self.short_term_blocks for i in range(1, self.gating_blocks + 1)]
+            self._add_to_histogram(self.gating_histogram, float(self.blocks[indices].sum()) / self.gating_blocks)
+        if self.block_count >= self.short_term_blocks:
+            self.short_term_energy = float(self.blocks.sum()) / self.short_term_blocks
+            self._add_to_histogram(self.short_term_histogram, self.short_term_energy)
+
+    def _add_to_histogram(self, histogram: Float64Array, energy: float) -> None:
+        loudness = self._energy_to_lufs(energy)
+        if loudness < self.histogram_floor:
+            return
+        index = min(int((loudness - self.histogram_floor) / self.histogram_resolution), self.histogram_bins - 1)
+        histogram[0, index] += 1
+        histogram[1, index] += energy
+
+    def _true_peak(self, x: Float32Array) -> float:
+        if x.shape[0] == 0:
+            return 0.0
+        extended = numpy.concatenate((self.true_peak_history, x)).T
+        self.true_peak_history = numpy.ascontiguousarray(extended[:, -11:].T)
+        # Rows are the 12-sample windows ending at each input sample, for both channels.
+        windows = numpy.lib.stride_tricks.sliding_window_view(extended, 12, axis=1).reshape((-1, 12))
+        y = windows @ self.true_peak_taps
+        # The filter has an even length, so its delay is half a sample and none of the 4 phases is the input
+        # itself. The sample peak is folded in, so a transient never reads below it.
+        return max(float(numpy.max(y)), -float(numpy.min(y)), float(numpy.max(x)), -float(numpy.min(x)))
+
+    @staticmethod
+    def _energy_to_lufs(energy: float) -> float:
+        if energy <= 0:
+            return -math.inf
+        return math.log10(energy) * 10.0 - 0.691
+
+    # Returns the bin index of the relative gate, given the absolute-gated mean energy.
+    def _relative_gate_bin(self, histogram: Float64Array, relative_gate_lu: float) -> typing.Optional[int]:
+        count = float(histogram[0].sum())
+        if count == 0:
+            return None
+        threshold = self._energy_to_lufs(float(histogram[1].sum()) / count) + relative_gate_lu
+        return max(0, math.ceil((threshold - self.histogram_floor) / self.histogram_resolution))
+
+    # Must be called with lock held.
+    def _replace(self, start: int, end: int, squares: Float64Array, energy: Float64Array) -> None:
+        self.sums -= self.buffer[start:end].sum(axis=0)
+        self.sums += energy
+        self.buffer[start:end] = squares
 
     def momentary_lufs(self) -> typing.Tuple[float, float]:
         with self.lock:
-            mean = numpy.mean(self.buffer, axis=1, dtype=numpy.float64)
+            mean = numpy.maximum(self.sums, 0.0) / self.window_size
         with numpy.errstate(divide='ignore'):
             lufs = numpy.log10(mean) * 10.0 - 0.691
         return lufs[0], lufs[1]
 
+    # Loudness of both channels together over the last 3 seconds.
+    def short_term_lufs(self) -> float:
+        with self.lock:
+            return self._energy_to_lufs(self.short_term_energy)
+
+    # Gated loudness since the last reset_statistics().
+    def integrated_lufs(self) -> float:
+        with self.lock:
+            histogram = self.gating_histogram.copy()
+        gate_bin = self._relative_gate_bin(histogram, -10.0)
+        if gate_bin is None:
+            return -math.inf
+        count = float(histogram[0, gate_bin:].sum())
+        if count == 0:
+            return -math.inf
+        return self._energy_to_lufs(float(histogram[1, gate_bin:].sum()) / count)
+
+    # Loudness range (EBU Tech 3342) since the last reset_statistics(), in LU.
+    def loudness_range_lu(self) -> float:
+        with self.lock:
+            histogram = self.short_term_histogram.copy()
+        gate_bin = self._relative_gate_bin(histogram, -20.0)
+        if gate_bin is None:
+            return 0.0
+        cumulative: Float64Array = numpy.cumsum(histogram[0, gate_bin:])
+        if len(cumulative) == 0 or cumulative[-1] == 0:
+            return 0.0
+        total = float(cumulative[-1])
+        low = int(numpy.searchsorted(cumulative, total * 0.10))
+        high = int(numpy.searchsorted(cumulative, total * 0.95))
+        return (high - low) * self.histogram_resolution
+
+    # Maximum true-peak level since the last reset_statistics(), in dBTP.
+    def true_peak_dbtp(self) -> float:
+        with self.lock:
+            true_peak = self.true_peak
+        if true_peak <= 0:
+            return -math.inf
+        return math.log10(true_peak) * 20.0
+
+    # Starts a new measurement for the integrated loudness, loudness range, and true-peak.
+    def reset_statistics(self) -> None:
+        with self.lock:
+            self.gating_histogram[:] = 0.0
+            self.short_term_histogram[:] = 0.0
+            self.true_peak = 0.0
+
     def close(self) -> None:
         self.executor.shutdown()
@@ -0,0 +1,160 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import asyncio
+import traceback
+import typing
+
+from . import stats
+
+if typing.TYPE_CHECKING:
+    from . import model
+
+
+class ChannelCounters:
+    # Packets of one voice channel. Only counted by whoever sends the channel's packets, one thread at a time.
+    __slots__ = ['channel_id', 'channel_name', 'guild_name', 'packets_sent', 'packets_dropped']
+
+    def __init__(self, channel_id: int, channel_name: str, guild_name: str) -> None:
+        self.channel_id = channel_id
+        self.channel_name = channel_name
+        self.guild_name = guild_name
+        self.packets_sent = 0
+        self.packets_dropped = 0
+
+
+class MetricsServer:
+    # A tiny HTTP server on the model's event loop, serving the pipeline counters in the OpenMetrics text format
+    # for Prometheus. Only listens on the loopback interface.
+    __slots__ = ['m', 'host', 'port', 'server']
+
+    def __init__(self, m: 'model.Model', port: int, host: str = '127.0.0.1') -> None:
+        self.m = m
+        self.host = host
+        self.port = port
+        self.server: typing.Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        try:
+            self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        except OSError as exc:
+            # Not worth stopping the bot for.
+            self.m.logger.warning('Unable to serve metrics on {}:{}: {}'.format(self.host, self.port, exc))
+            return
+        self.m.logger.info('Serving metrics on http://{}:{}/metrics'.format(self.host, self.port))
+
+    async def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+            request_line = request.split(b'\r\n', 1)[0].split()
+            if len(request_line) < 2 or request_line[0] not in (b'GET', b'HEAD'):
+                writer.write(b'HTTP/1.1 405 Method Not Allowed\r\nAllow: GET, HEAD\r\nContent-Length: 0\r\n\r\n')
+            elif request_line[1].split(b'?', 1)[0] not in (b'/', b'/metrics'):
+                writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+            else:
+                # Sorting the latency windows takes a few milliseconds, keep it off the event loop.
+                body = (await asyncio.get_running_loop().run_in_executor(None, render, self.m)).encode('utf-8')
+                writer.write(
+                    'HTTP/1.1 200 OK\r\n'
+                    'Content-Type: application/openmetrics-text; version=1.0.0; charset=utf-8\r\n'
+                    'Content-Length: {}\r\n'
+                    'Connection: close\r\n\r\n'.format(len(body)).encode('ascii')
+                )
+                if request_line[0] == b'GET':
+                    writer.write(body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception:
+            traceback.print_exc()
+        finally:
+            writer.close()
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render(m: 'model.Model') -> str:
+    lines: typing.List[str] = []
+
+    def family(name: str, kind: str, help: str, unit: str = '') -> None:
+        lines.append('# TYPE discord_mic_bot_{} {}'.format(name, kind))
+        if unit:
+            lines.append('# UNIT discord_mic_bot_{} {}'.format(name, unit))
+        lines.append('# HELP discord_mic_bot_{} {}'.format(name, help))
+
+    def sample(name: str, value: float, labels: str = '') -> None:
+        lines.append('discord_mic_bot_{}{} {}'.format(name, '{' + labels + '}' if labels else '', value))
+
+    def summary(name: str, help: str, latency: stats.RollingLatency) -> None:
+        # OpenMetrics wants the unit at the end of the name.
+        name += '_seconds'
+        family(name, 'summary', help, 'seconds')
+        count, p50_ms, p99_ms, _ = latency.percentiles()
+        if count != 0:
+            sample(name, p50_ms / 1000, 'quantile="0.5"')
+            sample(name, p99_ms / 1000, 'quantile="0.99"')
+        sample(name + '_sum', latency.total_ns / 1000000000)
+        sample(name + '_count', latency.count)
+
+    for name, help, value in (
+        ('input_underflows', 'Times the operating system could not supply audio in time.', m.input_underflows),
+        ('input_overflows', 'Times the recording thread was too slow and audio was lost.', m.input_overflows),
+        ('frame_size_mismatches', 'Audio callbacks with an unexpected number of samples.', m.frame_size_mismatches),
+        ('ring_overflows', 'Frames dropped because the encoder fell behind.', m.ring_overflows),
+        ('speaking_state_changes', 'Speaking state updates sent to voice channels.', m.speaking_state_changes),
+    ):
+        family(name, 'counter', help)
+        sample(name + '_total', value)
+
+    family('ring_frames', 'gauge', 'Captured frames waiting for the encoder.')
+    sample('ring_frames', len(m.audio_ring))
+    family('ring_capacity_frames', 'gauge', 'Size of the captured frame ring.')
+    sample('ring_capacity_frames', m.audio_ring.capacity)
+    family('voice_channels', 'gauge', 'Connected voice channels.')
+    sample('voice_channels', len(m.list_joined()))
+
+    channels = list(m.channel_counters.values())
+    family('packets_sent', 'counter', 'Voice packets sent, per voice channel.')
+    for counters in channels:
+        sample('packets_sent_total', counters.packets_sent, _channel_labels(counters))
+    family('packets_dropped', 'counter', 'Voice packets the network could not take, per voice channel.')
+    for counters in channels:
+        sample('packets_dropped_total', counters.packets_dropped, _channel_labels(counters))
+
+    for stage, description in m.frame_latency.descriptions:
+        summary(
+            'frame_{}_latency'.format(stage), 'Frame latency: {}.'.format(description), getattr(m.frame_latency, stage)
+        )
+    if m.lu_meter is not None:
+        summary('lu_meter_push', 'Time the loudness meter takes for a frame.', m.lu_meter.push_time)
+
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+def _channel_labels(counters: ChannelCounters) -> str:
+    return 'channel_id="{}",channel="{}",guild="{}"'.format(
+        counters.channel_id, _escape(counters.channel_name), _escape(counters.guild_name)
+    )
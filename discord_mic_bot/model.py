@@ -16,13 +16,14 @@
 
 import array
 import asyncio
-import asyncio.queues
+import collections
 import concurrent.futures
 import ctypes
 import ctypes.util
 import logging
 import os
 import platform
+import threading
 import time
 import traceback
 import typing
@@ -30,23 +31,25 @@ import typing
 import discord
 import sounddevice  # pyright: ignore[reportMissingTypeStubs]
 
-from . import lumeter
+from . import (
+    devices,
+    drift,
+    encoder,
+    filesource,
+    framering,
+    gate,
+    latency,
+    metrics,
+    oggopus,
+    pacer,
+    resampler,
+    startup,
+    stats,
+)
 
 if typing.TYPE_CHECKING:
-    from . import view
-
-
-class SoundDevice:
-    __slots__ = ['name', 'is_default']
-
-    def __init__(self, name: str, is_default: bool) -> None:
-        self.name = name
-        self.is_default = is_default
-
-    def __repr__(self) -> str:
-        if self.is_default:
-            return '* {}'.format(self.name)
-        return '  {}'.format(self.name)
+    # Loaded in the background by _load_dsp, scipy takes over a second to import.
+    from . import dsp, lumeter, view
 
 
 class Model:
@@ -57,22 +60,83 @@ class Model:
         'logger',
         'discord_bot_token',
         'discord_client',
+        'voice_client_class',
         'login_status',
+        'logged_in',
         'current_viewing_guild',
         'input_stream',
+        'file_source',
+        'file_loop',
+        'sound_devices',
+        'sound_devices_lock',
+        'recording_device',
+        'last_device_rescan',
         'audio_warning_count',
-        'audio_queue',
+        'input_underflows',
+        'input_overflows',
+        'frame_size_mismatches',
+        'ring_overflows',
+        'speaking_state_changes',
+        'channel_counters',
+        'metrics_server',
+        'frame_ms',
+        'frame_size',
+        'muted_frame',
+        'audio_ring',
+        'opus_packets',
+        'drift_estimator',
+        'drift_compensation',
+        'capture_resampler',
+        'resampled_frame',
+        'resampled_frame_bytes',
+        'capture_blocksize',
+        'audio_ready',
+        'audio_ready_threading',
+        'realtime_pipeline',
+        'pipeline_thread',
+        'packet_pacer',
+        'dsp_chain',
+        'voice_gate',
+        'dtx_suppressed_packets',
+        'frames_since_statistics',
+        'packets_sent',
+        'statistics_start_ns',
+        'statistics_start_cpu_ns',
+        'timestamp_frames',
+        'frame_jitter',
+        'worker_executor',
+        'fan_out_time',
+        'fan_out_clients',
         'muted',
-        'opus_encoder',
-        'opus_encoder_private',
+        'default_encoder_profile',
+        'channel_encoder_profiles',
+        'encoders',
+        'encoders_lock',
         'opus_encoder_executor',
         'encode_voice_task',
         'stop_future',
         'lu_meter',
+        'dsp_loaded',
+        'frame_latency',
+        'frame_capture_ns',
+        'frame_prepared_ns',
     ]
-    muted_frame = array.array('f', [0.0] * (48000 * 20 // 1000 * 2))
-
-    def __init__(self, discord_bot_token: str, loop: asyncio.AbstractEventLoop) -> None:
+    # Opus supports these frame durations at 48kHz, apart from 2.5ms.
+    frame_durations_ms = (5, 10, 20, 40, 60)
+
+    def __init__(
+        self,
+        discord_bot_token: str,
+        loop: asyncio.AbstractEventLoop,
+        realtime_pipeline: bool = False,
+        paced_send_buffer_frames: typing.Optional[int] = None,
+        drift_compensation: bool = False,
+        frame_ms: int = 20,
+        metrics_port: typing.Optional[int] = None,
+        audio_dir: typing.Optional[str] = None,
+    ) -> None:
+        if frame_ms not in self.frame_durations_ms:
+            raise ValueError('Unsupported frame duration: {} ms'.format(frame_ms))
         self.v: typing.Optional['view.View'] = None
         self.loop = loop
         self.running = True
@@ -91,33 +155,130 @@ class Model:
         self.discord_client = discord.Client(
             intents=intents, max_messages=None, assume_unsync_clock=True, proxy=os.getenv('https_proxy')
         )
+        # What channels are joined with, the stand-in voice server swaps in its own.
+        self.voice_client_class: typing.Callable[[discord.Client, discord.abc.Connectable], discord.VoiceClient] = (
+            discord.VoiceClient
+        )
         self.login_status = 'Starting up…'
+        # Set once login() has returned, discord.Client.wait_until_ready raises before that.
+        self.logged_in = asyncio.Event()
         self.current_viewing_guild: typing.Optional[discord.Guild] = None
 
         self.input_stream: typing.Optional[sounddevice.RawInputStream] = None
+        # Plays the audio file chosen instead of a sound device, if any.
+        self.file_source: typing.Optional[filesource.PacedSource] = None
+        self.file_loop = False
+        self.sound_devices = devices.DeviceIndex(audio_dir)
+        startup.timeline.mark('devices scanned')
+        self.logger.info(
+            'Found {} input devices in {:.1f} ms.'.format(
+                len(self.sound_devices.by_name), self.sound_devices.scan_ns / 1000000
+            )
+        )
+        # The UI thread and the event loop both open and close the input stream.
+        self.sound_devices_lock = threading.RLock()
+        self.recording_device: typing.Optional[typing.Tuple[str, str]] = None
+        self.last_device_rescan = 0.0
         self.audio_warning_count = 0
+        # The same warnings counted apart, for the metrics endpoint.
+        self.input_underflows = 0
+        self.input_overflows = 0
+        self.frame_size_mismatches = 0
+        self.ring_overflows = 0
+        self.speaking_state_changes = 0
+        self.channel_counters: typing.Dict[int, metrics.ChannelCounters] = {}
+        self.metrics_server: typing.Optional[metrics.MetricsServer] = None
+        if metrics_port is not None:
+            self.metrics_server = metrics.MetricsServer(self, metrics_port)
+        # Shorter frames lower the latency, longer frames mean fewer packets and less CPU.
+        self.frame_ms = frame_ms
+        self.frame_size = 48000 * frame_ms // 1000
+        self.muted_frame = array.array('f', bytes(self.frame_size * 2 * 4))
+        # Where the consumer puts each resampled frame, see _captured_frames.
+        self.resampled_frame = array.array('f', bytes(self.frame_size * 2 * 4))
+        self.resampled_frame_bytes = memoryview(self.resampled_frame).cast('B')
         # 2048 / 960 == 3, should work even with bad-designed audio systems (e.g. Windows MME)
-        self.audio_queue: asyncio.Queue[typing.Optional['array.array[float]']] = asyncio.Queue(3)
+        # Keep at least 60ms of room for shorter frames.
+        # One more slot is held by the encoder while the frame is being consumed.
+        self.audio_ring = framering.FrameRing(max(3, 60 // frame_ms) + 1, self.frame_size * 2)
+        # Packets of an Ogg Opus file sent as they are, with the samples they last and when they were due.
+        # The pipeline takes them whenever the ring is empty.
+        self.opus_packets: collections.deque[typing.Tuple[bytes, int, int]] = collections.deque()
+        # The sound card's clock is never exactly 48kHz. With compensation on, the captured audio is resampled
+        # to the measured rate, so the frames follow time.monotonic instead of the sound card's crystal.
+        # None unless compensation is on and a sound device is recording.
+        self.drift_estimator: typing.Optional[drift.DriftEstimator] = None
+        self.drift_compensation = drift_compensation
+        self.capture_resampler: typing.Optional[resampler.FrameResampler] = None
+        self.capture_blocksize = self.frame_size
+        # Set by the recording thread without waiting for the event loop to run anything.
+        self.audio_ready = asyncio.Event()
+        self.audio_ready_threading = threading.Event()
+        # Encode and send on a dedicated thread instead of hopping through the event loop.
+        self.realtime_pipeline = realtime_pipeline
+        self.pipeline_thread: typing.Optional[threading.Thread] = None
+        # Latency of each stage over the last minute of frames, cheap enough to be always on.
+        self.frame_latency = latency.FrameLatency(60000 // frame_ms)
+        # Stamps of the frame being consumed, the consumer only has one frame at a time.
+        self.frame_capture_ns = 0
+        self.frame_prepared_ns = 0
+        # Send packets on a steady schedule, one frame duration apart, instead of as soon as they are encoded.
+        self.packet_pacer: typing.Optional[pacer.PacketPacer] = None
+        if paced_send_buffer_frames is not None:
+            self.packet_pacer = pacer.PacketPacer(paced_send_buffer_frames, frame_ms * 1000000, self.frame_latency)
+        # None until the DSP stack is loaded, then empty by default, so the captured audio is sent untouched.
+        self.dsp_chain: typing.Optional['dsp.DSPChain'] = None
+        self.voice_gate = gate.VoiceActivityGate(frame_ms=frame_ms)
+        self.dtx_suppressed_packets = 0
+        self.frames_since_statistics = 0
+        # Packets per second and CPU use are measured over each statistics window.
+        self.packets_sent = 0
+        self.statistics_start_ns = time.monotonic_ns()
+        self.statistics_start_cpu_ns = time.process_time_ns()
+        self.timestamp_frames = 0
+        self.frame_jitter = stats.JitterMeter(frame_ms * 1000000)
+        # Encodes distinct encoder profiles, then encrypts and sends each packet to many voice clients, in parallel.
+        self.worker_executor = concurrent.futures.ThreadPoolExecutor(os.cpu_count())
+        self.fan_out_time = stats.DurationMeter()
+        self.fan_out_clients = 0
         self.muted = False
 
         self._load_opus()
-        self.opus_encoder = discord.opus.Encoder()
-        # Use the private function just to satisfy my paranoid of 1 Kbps == 1000 bps.
-        # getattr is used to bypass the linter
-        self.opus_encoder_private = getattr(discord.opus, '_lib')
-        self.opus_encoder_private.opus_encoder_ctl(
-            getattr(self.opus_encoder, '_state'), discord.opus.CTL_SET_BITRATE, 128000
-        )
-        # FEC only works for voice, not music, and from my experience it hurts music quality severely.
-        self.opus_encoder.set_fec(False)
-        self.opus_encoder.set_expected_packet_loss_percent(0.15)
+        startup.timeline.mark('opus loaded')
+        # Channels without their own profile follow the default one, which is what the UI controls.
+        self.default_encoder_profile = encoder.EncoderProfile()
+        self.channel_encoder_profiles: typing.Dict[int, encoder.EncoderProfile] = {}
+        # Each distinct profile is encoded exactly once per frame, channels sharing a profile share its packets.
+        self.encoders: typing.Dict[encoder.EncoderProfile, encoder.ProfileEncoder] = {
+            self.default_encoder_profile: encoder.ProfileEncoder(self.default_encoder_profile)
+        }
+        # The encoder table is changed by the event loop and read by the encoding thread.
+        self.encoders_lock = threading.Lock()
         self.opus_encoder_executor = concurrent.futures.ThreadPoolExecutor(1)
         self.encode_voice_task: typing.Optional[asyncio.Task[None]] = None
         self.stop_future: typing.Optional[concurrent.futures.Future[None]] = None
 
-        self.lu_meter = lumeter.LUMeter(self.loop)
+        # Logging in and showing the window don't need the DSP stack, so it is loaded meanwhile.
+        # Frames are only consumed once it is ready.
+        self.lu_meter: typing.Optional['lumeter.LUMeter'] = None
+        self.dsp_loaded: concurrent.futures.Future['lumeter.LUMeter'] = concurrent.futures.Future()
+        threading.Thread(target=self._load_dsp, name='discord-mic-bot-dsp-loader', daemon=True).start()
 
         self._set_up_events()
+        startup.timeline.mark('model ready')
+
+    def _load_dsp(self) -> None:
+        try:
+            from . import dsp, lumeter
+
+            if self.dsp_chain is None:
+                self.dsp_chain = dsp.DSPChain(frame_ms=self.frame_ms)
+            self.lu_meter = lumeter.LUMeter(self.loop)
+        except BaseException as exc:
+            self.dsp_loaded.set_exception(exc)
+            raise
+        startup.timeline.mark('DSP stack loaded')
+        self.dsp_loaded.set_result(self.lu_meter)
 
     @staticmethod
     def _opus_library_candidates() -> typing.Iterator[str]:
@@ -191,6 +352,8 @@ class Model:
             username = user.name if user is not None else ''
             self.login_status = 'Logged in as: {}'.format(username)
             self.logger.info(self.login_status)
+            if startup.timeline.mark('ready'):
+                self.logger.info('Startup: {}.'.format(startup.timeline.format()))
             if self.v is not None:
                 self.v.loop.call_soon_threadsafe(self.v.login_status_updated)
                 self.v.loop.call_soon_threadsafe(self.v.guilds_updated)
@@ -294,30 +457,36 @@ class Model:
         return [i.channel for i in self._voice_clients() if isinstance(i.channel, discord.VoiceChannel)]
 
     def list_sound_hostapis(self) -> typing.List[str]:
-        hostapis = typing.cast(typing.Tuple[typing.Dict[str, typing.Any], ...], sounddevice.query_hostapis())
-        return [i['name'] for i in hostapis]
+        return self.sound_devices.hostapis
 
-    def list_sound_input_devices(self, hostapi: str) -> typing.List[SoundDevice]:
-        hostapis = typing.cast(typing.Tuple[typing.Dict[str, typing.Any], ...], sounddevice.query_hostapis())
-        devices = typing.cast(sounddevice.DeviceList, sounddevice.query_devices())
+    def list_sound_input_devices(self, hostapi: str) -> typing.List[devices.SoundDevice]:
+        return self.sound_devices.input_devices.get(hostapi, [])
 
-        default_input_id, _ = typing.cast(
-            typing.Tuple[typing.Optional[int], typing.Optional[int]], sounddevice.default.device
-        )
-        for api in hostapis:
-            if api['name'] == hostapi:
-                default_input_id = api['default_input_device']
-                break
-        else:
-            return []
+    # Re-enumerates the devices to pick up hot-plugged ones, then reopens the current device if it still exists.
+    def rescan_sound_devices(self) -> None:
+        with self.sound_devices_lock:
+            if not self.running:
+                return
+            self.last_device_rescan = time.monotonic()
+            recording_device = self.recording_device
+            # An audio file being played carries on from where it was.
+            file_position = self.file_position()
+            self._close_input_stream()
+            if not self.sound_devices.rescan():
+                self.logger.warning('Unable to restart PortAudio, hot-plugged sound devices are not found.')
+            self.logger.info(
+                'Rescanned sound devices, found {} input devices in {:.1f} ms.'.format(
+                    len(self.sound_devices.by_name), self.sound_devices.scan_ns / 1000000
+                )
+            )
+            if recording_device is not None:
+                self.start_recording(*recording_device)
+                if file_position is not None:
+                    self.seek_file(file_position[0])
 
-        return [
-            SoundDevice(typing.cast(str, dev['name']), idx == default_input_id)
-            for idx, dev in enumerate(typing.cast(typing.Iterable[typing.Dict[str, typing.Any]], devices))
-            if dev['max_input_channels'] > 0
-            and dev['hostapi'] < len(hostapis)
-            and hostapis[typing.cast(int, dev['hostapi'])]['name'] == hostapi
-        ]
+    # Same as rescan_sound_devices, in the default executor, as enumerating the devices can be slow.
+    async def rescan_sound_devices_async(self) -> None:
+        await self.loop.run_in_executor(None, self.rescan_sound_devices)
 
     def view_guild(self, guild: typing.Optional[discord.Guild]) -> None:
         self.current_viewing_guild = guild
@@ -327,19 +496,48 @@ class Model:
 
     async def join_voice(self, channel: discord.VoiceChannel) -> None:
         try:
-            await channel.connect()
+            await channel.connect(cls=self.voice_client_class)
         except Exception:
             traceback.print_exc()
             return
 
-        await self.loop.run_in_executor(self.opus_encoder_executor, self._reset_opus_encoder)
+        await self.loop.run_in_executor(
+            self.opus_encoder_executor, self._encoder_for(self._encoder_profile_for(channel)).reset
+        )
+        startup.timeline.mark('voice connected')
 
         if self.v is not None:
             self.v.loop.call_soon_threadsafe(self.v.joined_updated)
 
-    def _reset_opus_encoder(self) -> None:
-        CTL_RESET_STATE = 4028
-        self.opus_encoder_private.opus_encoder_ctl(getattr(self.opus_encoder, '_state'), CTL_RESET_STATE)
+    def _encoder_profile_for(self, channel: discord.abc.Connectable) -> encoder.EncoderProfile:
+        if isinstance(channel, discord.VoiceChannel):
+            return self.channel_encoder_profiles.get(channel.id, self.default_encoder_profile)
+        return self.default_encoder_profile
+
+    def _encoder_for(self, profile: encoder.EncoderProfile) -> encoder.ProfileEncoder:
+        with self.encoders_lock:
+            profile_encoder = self.encoders.get(profile)
+            if profile_encoder is None:
+                profile_encoder = encoder.ProfileEncoder(profile)
+                self.encoders[profile] = profile_encoder
+            return profile_encoder
+
+    # Must be called with encoders_lock held.
+    def _prune_encoders(self) -> None:
+        in_use = set(self.channel_encoder_profiles.values())
+        in_use.add(self.default_encoder_profile)
+        for profile in list(self.encoders):
+            if profile not in in_use:
+                del self.encoders[profile]
+
+    def list_encoder_profiles(self) -> typing.List[typing.Tuple[encoder.EncoderProfile, int]]:
+        with self.encoders_lock:
+            profiles = list(self.encoders)
+        channels = self.list_joined()
+        return [
+            (profile, sum(1 for channel in channels if self._encoder_profile_for(channel) == profile))
+            for profile in profiles
+        ]
 
     async def leave_voice(self, channel: discord.VoiceChannel) -> None:
         futures = [
@@ -355,34 +553,42 @@ class Model:
             self.v.loop.call_soon_threadsafe(self.v.joined_updated)
 
     def start_recording(self, hostapi: str, device: str) -> None:
-        if self.input_stream is not None:
-            self.input_stream.stop()
-            self.input_stream.close()
-            self.input_stream = None
+        with self.sound_devices_lock:
+            self._start_recording(hostapi, device)
 
-        hostapis = typing.cast(typing.Tuple[typing.Dict[str, typing.Any], ...], sounddevice.query_hostapis())
-        devices = typing.cast(sounddevice.DeviceList, sounddevice.query_devices())
+    def _start_recording(self, hostapi: str, device: str) -> None:
+        self._close_input_stream()
+        self.recording_device = hostapi, device
 
-        for idx, dev in enumerate(typing.cast(typing.Iterable[typing.Dict[str, typing.Any]], devices)):
-            if (
-                dev['name'] == device
-                and dev['max_input_channels'] > 0
-                and dev['hostapi'] < len(hostapis)
-                and hostapis[typing.cast(int, dev['hostapi'])]['name'] == hostapi
-            ):
-                device_id = idx
-                break
-        else:
+        sound_device = self.sound_devices.lookup(hostapi, device)
+        if sound_device is None:
             return
-
+        if sound_device.path is not None:
+            self._start_file_source(sound_device.path)
+            return
+        sample_rate = sound_device.sample_rate
+
+        # Open the device at its native rate and resample it ourselves, instead of leaving it to the host API
+        # with unknown quality and latency, or failing to open at all.
+        if sample_rate <= 0:
+            sample_rate = 48000
+        self.drift_estimator = drift.DriftEstimator(sample_rate, self.frame_ms) if self.drift_compensation else None
+        self._set_capture_rate(sample_rate, sample_rate != 48000 or self.drift_compensation)
+        if self.capture_resampler is not None:
+            self.logger.info(
+                'Recording at {} Hz, resampling to 48000 Hz adds {:.3f} ms of latency.'.format(
+                    sample_rate, self.capture_resampler.resampler.latency_samples / 48
+                )
+            )
         self.input_stream = sounddevice.RawInputStream(
-            samplerate=48000,
-            blocksize=48000 * 20 // 1000,
-            device=device_id,
+            samplerate=sample_rate,
+            blocksize=self.capture_blocksize,
+            device=sound_device.index,
             channels=2,
             dtype='float32',
             latency='low',
             callback=self._recording_callback,
+            finished_callback=self._recording_finished,
             clip_off=True,
             dither_off=True,
             never_drop_input=False,
@@ -391,36 +597,196 @@ class Model:
             self.input_stream.start()
         except Exception:
             traceback.print_exc()
-            self.input_stream.close()
-            self.input_stream = None
+            self._close_input_stream()
 
-    async def set_bitrate(self, kbps: int) -> None:
-        await self.loop.run_in_executor(self.opus_encoder_executor, self._set_bitrate, kbps)
+    def _start_file_source(self, path: str) -> None:
+        if os.path.splitext(path)[1].lower() in oggopus.EXTENSIONS:
+            self._start_opus_file_source(path)
+            return
+        try:
+            audio_file = filesource.PCMFile(path)
+        except (OSError, ValueError) as exc:
+            self.logger.error('Unable to play {}: {}'.format(path, exc))
+            return
+        # The file is paced by the system clock, so there is no drift to follow, only the sample rate to convert.
+        self.drift_estimator = None
+        self._set_capture_rate(audio_file.sample_rate, audio_file.sample_rate != 48000)
+        self.logger.info(
+            'Playing {}: {} Hz, {} channels, {:.1f} s.'.format(
+                path, audio_file.sample_rate, audio_file.channels, audio_file.duration_s
+            )
+        )
+        self.file_source = filesource.FileSource(audio_file, self.frame_ms, self._file_callback, self.file_loop)
+        self.file_source.start()
+
+    def _start_opus_file_source(self, path: str) -> None:
+        try:
+            ogg_file = oggopus.OggOpusFile(path)
+        except (OSError, ValueError) as exc:
+            self.logger.error('Unable to play {}: {}'.format(path, exc))
+            return
+        self.drift_estimator = None
+        self._set_capture_rate(48000, False)
+        problem = ogg_file.passthrough_problem(self.frame_size)
+        if problem is None:
+            self.logger.info(
+                'Playing {}: Opus, {} channels, {:.1f} s, sent without re-encoding.'.format(
+                    path, ogg_file.channels, ogg_file.duration_s
+                )
+            )
+            self.file_source = oggopus.OpusPassthroughSource(
+                ogg_file, self.frame_size, self._opus_packet_callback, self.file_loop
+            )
+        else:
+            try:
+                audio_file = oggopus.DecodedOpusFile(ogg_file)
+            except ValueError as exc:
+                ogg_file.close()
+                self.logger.error('Unable to play {}: {}'.format(path, exc))
+                return
+            self.logger.info(
+                'Playing {}: Opus, {} channels, {:.1f} s, re-encoded because of its {}.'.format(
+                    path, ogg_file.channels, ogg_file.duration_s, problem
+                )
+            )
+            self.file_source = filesource.FileSource(audio_file, self.frame_ms, self._file_callback, self.file_loop)
+        self.file_source.start()
+
+    # The ring holds blocks at the rate of the source, which the consumer resamples to 48kHz frames if needed.
+    # Must be called with the previous source stopped.
+    def _set_capture_rate(self, sample_rate: int, resample: bool) -> None:
+        self.capture_blocksize = sample_rate * self.frame_ms // 1000
+        if resample:
+            self.capture_resampler = resampler.FrameResampler(sample_rate, self.frame_size)
+        else:
+            self.capture_resampler = None
+        # The consumer picks up the new ring at its next block, what is left in the old one is dropped.
+        if self.audio_ring.frame_bytes != self.capture_blocksize * 8:
+            self.audio_ring = framering.FrameRing(self.audio_ring.capacity, self.capture_blocksize * 2)
+
+    # Clears input_stream before stopping it, so _recording_finished knows that we stopped it on purpose.
+    def _close_input_stream(self) -> None:
+        input_stream = self.input_stream
+        self.input_stream = None
+        if input_stream is not None:
+            input_stream.stop()
+            input_stream.close()
+        file_source = self.file_source
+        self.file_source = None
+        if file_source is not None:
+            file_source.stop()
+        self.opus_packets.clear()
+
+    # (position, duration) in seconds of the audio file being played, None when recording from a sound device.
+    def file_position(self) -> typing.Optional[typing.Tuple[float, float]]:
+        file_source = self.file_source
+        if file_source is None:
+            return None
+        return file_source.position_s, file_source.duration_s
+
+    def seek_file(self, seconds: float) -> None:
+        file_source = self.file_source
+        if file_source is not None:
+            file_source.seek(seconds)
+
+    def set_file_loop(self, loop: bool) -> None:
+        self.file_loop = loop
+        file_source = self.file_source
+        if file_source is not None:
+            file_source.loop = loop
+
+    # Called by PortAudio when the stream stops. If we did not stop it, the device is probably unplugged.
+    def _recording_finished(self) -> None:
+        if self.input_stream is None or not self.running:
+            return
+        self.logger.warning('Recording stopped unexpectedly, the sound device may have been unplugged.')
+        # Rescanning restarts PortAudio, which cannot be done from its own thread.
+        self.loop.call_soon_threadsafe(self._rescan_after_unplug)
+
+    def _rescan_after_unplug(self) -> None:
+        # Don't keep restarting PortAudio if the device fails again right away.
+        if time.monotonic() - self.last_device_rescan < 5:
+            return
+        self.loop.create_task(self.rescan_sound_devices_async()).add_done_callback(self._device_rescanned)
 
-    def _set_bitrate(self, kbps: int) -> None:
+    def _device_rescanned(self, task: 'asyncio.Task[None]') -> None:
+        if self.v is not None:
+            self.v.loop.call_soon_threadsafe(self.v.device_updated)
+
+    async def set_bitrate(self, kbps: int) -> None:
         kbps = min(512, max(12, kbps))
-        self.opus_encoder_private.opus_encoder_ctl(
-            getattr(self.opus_encoder, '_state'), discord.opus.CTL_SET_BITRATE, kbps * 1000
-        )
+        profile = self.default_encoder_profile._replace(bitrate_kbps=kbps)
+        await self.loop.run_in_executor(self.opus_encoder_executor, self._set_default_encoder_profile, profile)
 
     async def set_fec_enabled(self, enabled: bool) -> None:
-        await self.loop.run_in_executor(self.opus_encoder_executor, self._set_fec_enabled, enabled)
+        profile = self.default_encoder_profile._replace(fec_enabled=enabled)
+        await self.loop.run_in_executor(self.opus_encoder_executor, self._set_default_encoder_profile, profile)
 
-    def _set_fec_enabled(self, enabled: bool) -> None:
-        if enabled:
-            self.opus_encoder.set_fec(True)
-            self.opus_encoder.set_expected_packet_loss_percent(0.15)
-        else:
-            self.opus_encoder.set_fec(False)
-            self.opus_encoder.set_expected_packet_loss_percent(0)
+    async def set_dtx_enabled(self, enabled: bool) -> None:
+        profile = self.default_encoder_profile._replace(dtx_enabled=enabled)
+        await self.loop.run_in_executor(self.opus_encoder_executor, self._set_default_encoder_profile, profile)
+
+    def _set_default_encoder_profile(self, profile: encoder.EncoderProfile) -> None:
+        with self.encoders_lock:
+            old_profile = self.default_encoder_profile
+            if profile == old_profile:
+                return
+            old_encoder = self.encoders.get(old_profile)
+            if (
+                old_encoder is not None
+                and profile not in self.encoders
+                and old_profile not in self.channel_encoder_profiles.values()
+            ):
+                # Nobody else uses the old profile, reconfigure its encoder in place so the stream has no glitch.
+                old_encoder.apply(profile)
+                del self.encoders[old_profile]
+                self.encoders[profile] = old_encoder
+            self.default_encoder_profile = profile
+            self._prune_encoders()
+
+    # Gives a voice channel its own encoder profile, or makes it follow the default profile again if None.
+    def set_channel_encoder_profile(
+        self, channel: discord.VoiceChannel, profile: typing.Optional[encoder.EncoderProfile]
+    ) -> None:
+        with self.encoders_lock:
+            if profile is None:
+                self.channel_encoder_profiles.pop(channel.id, None)
+            else:
+                self.channel_encoder_profiles[channel.id] = profile
+            self._prune_encoders()
 
     def set_muted(self, muted: bool) -> None:
         self.muted = muted
 
+    def set_dsp_stages(self, stages: typing.Sequence['dsp.Stage']) -> None:
+        from . import dsp
+
+        dsp_chain = dsp.DSPChain(stages, self.frame_ms)
+        # Replacing the whole chain is atomic for the encoding thread, which reads self.dsp_chain once per frame.
+        self.dsp_chain = dsp_chain
+        self.logger.info(
+            'DSP chain: [{}], adding {:.3f} ms of latency.'.format(
+                ', '.join(stage.name for stage in dsp_chain.stages), dsp_chain.latency_samples / 48
+            )
+        )
+
+    def set_voice_gate(
+        self,
+        threshold_dbfs: float = gate.DEFAULT_THRESHOLD_DBFS,
+        hysteresis_db: float = 0.0,
+        attack_ms: float = 0.0,
+        hold_ms: float = 20.0,
+    ) -> None:
+        # Replacing the whole gate is atomic for the encoding thread, which reads self.voice_gate once per frame.
+        self.voice_gate = gate.VoiceActivityGate(threshold_dbfs, hysteresis_db, attack_ms, hold_ms, self.frame_ms)
+
     def _recording_callback(
-        self, indata: typing.Any, frames: int, time: typing.Any, status: sounddevice.CallbackFlags
+        self, indata: typing.Any, frames: int, time_info: typing.Any, status: sounddevice.CallbackFlags
     ) -> None:
+        callback_ns = time.monotonic_ns()
+        drift_estimator = self.drift_estimator
         if status.input_underflow:
+            self.input_underflows += 1
             self.audio_warning_count += 1
             self.logger.warning(
                 'Audio underflow: operating system unable to supply enough audio. (count={})'.format(
@@ -428,99 +794,477 @@ class Model:
                 )
             )
         if status.input_overflow:
+            if drift_estimator is not None:
+                drift_estimator.reset()
+            self.input_overflows += 1
             self.audio_warning_count += 1
             self.logger.warning(
                 'Audio overflow: recording thread not fast enough. (count={})'.format(self.audio_warning_count)
             )
-        if frames != 48000 * 20 // 1000:
+        if frames != self.capture_blocksize:
+            self.frame_size_mismatches += 1
             self.audio_warning_count += 1
             self.logger.warning(
-                'Audio frame size mismatch: {} != {}.'.format(frames, 48000 * 20 // 1000), self.audio_warning_count
+                'Audio frame size mismatch: {} != {}. (count={})'.format(
+                    frames, self.capture_blocksize, self.audio_warning_count
+                )
             )
 
+        # Take the capture time from the PortAudio time info if the host API provides it.
+        adc_delay = 0.0
+        if time_info.currentTime > 0 and time_info.inputBufferAdcTime > 0:
+            adc_delay = min(1.0, max(0.0, time_info.currentTime - time_info.inputBufferAdcTime))
+        capture_ns = callback_ns - int(adc_delay * 1000000000)
+        # Only two stores here, the fit runs on the consumer side in _follow_drift.
+        if drift_estimator is not None:
+            drift_estimator.add(frames, capture_ns)
+
         if self.running:
-            buffer = array.array('f')
-            buffer.frombytes(bytes(indata)[: frames * 8])
-            asyncio.run_coroutine_threadsafe(self._recording_callback_main_thread(buffer), self.loop).result()
+            self._write_frame(indata, capture_ns, callback_ns)
 
-    async def _recording_callback_main_thread(self, buffer: 'array.array[float]') -> None:
-        try:
-            self.audio_queue.put_nowait(buffer)
-        except asyncio.queues.QueueFull:
-            if not self.running:
-                return
+    # Called by the file source with each block of the file, on its own thread.
+    def _file_callback(self, block: filesource.Float32Array, capture_ns: int) -> None:
+        if self.running:
+            self._write_frame(memoryview(block).cast('B'), capture_ns, capture_ns)
+
+    # Called by the Ogg Opus passthrough source with each packet, on its own thread.
+    def _opus_packet_callback(self, opus_packet: bytes, samples: int, due_ns: int) -> None:
+        if not self.running:
+            return
+        if len(self.opus_packets) >= self.audio_ring.capacity:
+            self.ring_overflows += 1
+            self.audio_warning_count += 1
+            self.logger.warning('Audio overflow: sender not fast enough. (count={})'.format(self.audio_warning_count))
+            return
+        self.opus_packets.append((opus_packet, samples, due_ns))
+        self._signal_audio_ready()
+
+    def _write_frame(self, data: typing.Any, capture_ns: int, callback_ns: int) -> None:
+        if self.audio_ring.write(data, capture_ns, callback_ns):
+            self._signal_audio_ready()
+        else:
+            self.ring_overflows += 1
             self.audio_warning_count += 1
             self.logger.warning('Audio overflow: encoder not fast enough. (count={})'.format(self.audio_warning_count))
 
-    async def _encode_voice_loop(self) -> None:
-        consecutive_silence = 0
-        timestamp_frames = 0
+    def _signal_audio_ready(self) -> None:
+        if self.realtime_pipeline:
+            self.audio_ready_threading.set()
+        else:
+            self.loop.call_soon_threadsafe(self.audio_ready.set)
+
+    # Consumer side of the ring: the 48kHz frames of the block returned by audio_ring.peek(), which is the block
+    # itself unless the source needs resampling. Resampling here keeps it out of the audio callback.
+    # Each frame must be done with before the next one is taken, they share a buffer.
+    def _captured_frames(
+        self, audio_ring: framering.FrameRing, block: 'array.array[float]'
+    ) -> typing.Iterator['array.array[float]']:
+        capture_resampler = self.capture_resampler
+        if capture_resampler is None:
+            # Skip a block left over from the previous source at another rate, right after switching.
+            if len(block) == self.frame_size * 2:
+                yield block
+            return
+        for frame in capture_resampler.process(memoryview(block).cast('B')[: audio_ring.peek_size()]):
+            self.resampled_frame_bytes[:] = memoryview(frame).cast('B')
+            yield self.resampled_frame
 
+    def _prepare_frame(self, buffer: 'array.array[float]', capture_ns: int, callback_ns: int) -> 'array.array[float]':
         try:
-            while self.running:
-                buffer = await self.audio_queue.get()
-                if buffer is None:
-                    return
-                frame_size = len(buffer) // 2
-
-                try:
-                    timestamp_ns = time.monotonic_ns()
-                except AttributeError:
-                    timestamp_ns = int(time.monotonic() * 1000000000)
-
-                if self.muted:
-                    buffer = self.muted_frame
-                    consecutive_silence += 1
-                # For unknown reason, VoiceMeeter on Windows generates constant
-                # noise in range [-1/32768, +1/32768] even I set the soundcard
-                # to 48kHz 24-bit mode.
-                # Okay, I know 24-bit is too good for human's ear, but it is
-                # your fault to reduce the quality to 15-bit.
-                elif max(buffer) * 65536 < 3 and min(buffer) * 65536 > -3:
-                    consecutive_silence += 1
-                else:
-                    consecutive_silence = 0
-
-                lu_meter_future = self.lu_meter.push(buffer)
-
-                if consecutive_silence <= 1:
-                    for voice_client in self._voice_clients():
-                        if voice_client.is_connected() and isinstance(voice_client.channel, discord.VoiceChannel):
-                            voice_client_name = voice_client.channel.name
-                            if (
-                                getattr(voice_client, '_dmb_speaking', discord.SpeakingState.none)
-                                != discord.SpeakingState.voice
-                            ):
-                                self.logger.info('Start speaking on: {}'.format(voice_client_name))
-                                self._set_speaking_state(voice_client, discord.SpeakingState.voice, timestamp_ns)
-                            elif timestamp_ns - getattr(voice_client, '_dmb_last_spoke', timestamp_ns) >= 60000000000:
-                                self.logger.info('Continue speaking on: {}'.format(voice_client_name))
-                                self._set_speaking_state(voice_client, discord.SpeakingState.voice, timestamp_ns)
-                else:
-                    for voice_client in self._voice_clients():
-                        if voice_client.is_connected() and isinstance(voice_client.channel, discord.VoiceChannel):
-                            voice_client_name = voice_client.channel.name
-                            if (
-                                getattr(voice_client, '_dmb_speaking', discord.SpeakingState.none)
-                                != discord.SpeakingState.none
-                            ):
-                                self.logger.info('Stop speaking on: {}'.format(voice_client_name))
-                                self._set_speaking_state(voice_client, discord.SpeakingState.none, timestamp_ns)
-
-                # When there's a break in the sent data, the packet transmission shouldn't simply stop. Instead, send five frames of silence (0xF8, 0xFF, 0xFE) before stopping to avoid unintended Opus interpolation with subsequent transmissions.
-                # -- Discord SDK
-                if consecutive_silence <= 5:
-                    opus_packet = await self.loop.run_in_executor(
-                        self.opus_encoder_executor, self._encode_voice, buffer
+            timestamp_ns = time.monotonic_ns()
+        except AttributeError:
+            timestamp_ns = int(time.monotonic() * 1000000000)
+        self.frame_capture_ns = capture_ns
+        frame_latency = self.frame_latency
+        frame_latency.input.add(callback_ns - capture_ns)
+        frame_latency.queue.add(timestamp_ns - callback_ns)
+
+        voice_gate = self.voice_gate
+        if self.muted:
+            buffer = self.muted_frame
+            speaking = voice_gate.process_silence()
+        else:
+            # Processed in place: the frame is ours until it is released back to the ring.
+            dsp_chain = self.dsp_chain
+            overruns = dsp_chain.process(buffer) if dsp_chain is not None else []
+            for stage, elapsed_ns in overruns:
+                # Flag the first overrun of each stage, the total count is in the statistics.
+                if stage.overruns == 1:
+                    self.logger.warning(
+                        'DSP stage ({}) took {:.3f} ms, over its {:.3f} ms budget.'.format(
+                            stage.name, elapsed_ns / 1000000, stage.budget_ns / 1000000
+                        )
                     )
-                    for voice_client in self._voice_clients():
-                        if voice_client.is_connected():
-                            send_func = self._send_audio_packet(voice_client, opus_packet, timestamp_frames)
-                            self.loop.call_soon(send_func)
-                            # self.loop.call_later(0.01, send_func)
+            speaking = voice_gate.process(buffer)
+        self._update_speaking_state(speaking, timestamp_ns)
+
+        self.frame_prepared_ns = time.monotonic_ns()
+        frame_latency.prepare.add(self.frame_prepared_ns - timestamp_ns)
+        return buffer
+
+    # Like _prepare_frame, for a packet of an Ogg Opus file. The packet counts as sound, an empty one as silence.
+    # Returns the packet to send, or None if the frame is part of the silent tail.
+    def _prepare_packet(self, opus_packet: bytes, capture_ns: int) -> typing.Optional[bytes]:
+        timestamp_ns = time.monotonic_ns()
+        self.frame_capture_ns = capture_ns
+        frame_latency = self.frame_latency
+        frame_latency.queue.add(timestamp_ns - capture_ns)
+
+        voice_gate = self.voice_gate
+        if self.muted or not opus_packet:
+            speaking = voice_gate.process_silence()
+        else:
+            speaking = voice_gate.process_sound()
+        self._update_speaking_state(speaking, timestamp_ns)
+
+        self.frame_prepared_ns = time.monotonic_ns()
+        frame_latency.prepare.add(self.frame_prepared_ns - timestamp_ns)
+        if speaking and opus_packet and not self.muted:
+            return opus_packet
+        return None
+
+    def _update_speaking_state(self, speaking: bool, timestamp_ns: int) -> None:
+        if speaking:
+            for voice_client in self._voice_clients():
+                if voice_client.is_connected() and isinstance(voice_client.channel, discord.VoiceChannel):
+                    voice_client_name = voice_client.channel.name
+                    if (
+                        getattr(voice_client, '_dmb_speaking', discord.SpeakingState.none)
+                        != discord.SpeakingState.voice
+                    ):
+                        self.logger.info('Start speaking on: {}'.format(voice_client_name))
+                        self._set_speaking_state(voice_client, discord.SpeakingState.voice, timestamp_ns)
+                    elif timestamp_ns - getattr(voice_client, '_dmb_last_spoke', timestamp_ns) >= 60000000000:
+                        self.logger.info('Continue speaking on: {}'.format(voice_client_name))
+                        self._set_speaking_state(voice_client, discord.SpeakingState.voice, timestamp_ns)
+        else:
+            for voice_client in self._voice_clients():
+                if voice_client.is_connected() and isinstance(voice_client.channel, discord.VoiceChannel):
+                    voice_client_name = voice_client.channel.name
+                    if getattr(voice_client, '_dmb_speaking', discord.SpeakingState.none) != discord.SpeakingState.none:
+                        self.logger.info('Stop speaking on: {}'.format(voice_client_name))
+                        self._set_speaking_state(voice_client, discord.SpeakingState.none, timestamp_ns)
+
+    def _encode_and_fan_out(self, buffer: 'array.array[float]') -> None:
+        frame_latency = self.frame_latency
+        encode_start_ns = time.monotonic_ns()
+        frame_latency.encode_wait.add(encode_start_ns - self.frame_prepared_ns)
+        voice_clients_by_profile: typing.Dict[encoder.EncoderProfile, typing.List[discord.VoiceClient]] = {}
+        for voice_client in self._voice_clients():
+            if voice_client.is_connected():
+                profile = self._encoder_profile_for(voice_client.channel)
+                voice_clients_by_profile.setdefault(profile, []).append(voice_client)
+        profile_encoders = [self._encoder_for(profile) for profile in voice_clients_by_profile]
+
+        # libopus is called through ctypes, which releases the GIL, so distinct profiles encode on separate cores.
+        if len(profile_encoders) == 1:
+            opus_packets = [profile_encoders[0].encode(buffer)]
+        else:
+            opus_packets = [
+                future.result()
+                for future in [
+                    self.worker_executor.submit(profile_encoder.encode, buffer) for profile_encoder in profile_encoders
+                ]
+            ]
+        encoded_ns = time.monotonic_ns()
+        if profile_encoders:
+            frame_latency.encode.add(encoded_ns - encode_start_ns)
+
+        sends: typing.List[typing.Tuple[discord.VoiceClient, bytes]] = []
+        for (profile, voice_clients), opus_packet in zip(voice_clients_by_profile.items(), opus_packets):
+            # With DTX, libopus returns a packet of 1 or 2 bytes when there is nothing worth sending.
+            if profile.dtx_enabled and len(opus_packet) <= 2:
+                self.dtx_suppressed_packets += len(voice_clients)
+                continue
+            sends.extend((voice_client, opus_packet) for voice_client in voice_clients)
+        self._fan_out(sends, encoded_ns)
+
+    # Sends a packet of an Ogg Opus file to every voice client as it is, or encodes the silent tail.
+    def _send_passthrough(self, opus_packet: typing.Optional[bytes]) -> None:
+        if opus_packet is None:
+            self._encode_and_fan_out(self.muted_frame)
+            return
+        encoded_ns = time.monotonic_ns()
+        self.frame_latency.encode_wait.add(encoded_ns - self.frame_prepared_ns)
+        self._fan_out(
+            [(voice_client, opus_packet) for voice_client in self._voice_clients() if voice_client.is_connected()],
+            encoded_ns,
+        )
 
-                timestamp_frames = (timestamp_frames + frame_size) & 0xFFFFFFFF
-                await lu_meter_future
+    def _fan_out(self, sends: typing.List[typing.Tuple[discord.VoiceClient, bytes]], encoded_ns: int) -> None:
+        frame_latency = self.frame_latency
+        start_ns = time.perf_counter_ns()
+        if len(sends) > 1 and self.packet_pacer is None:
+            # PyNaCl releases the GIL while encrypting, so each voice client gets its own worker, which builds
+            # and sends its packet, and no client waits for the others to be encrypted. Every voice client
+            # appears once in sends, so it is only touched by one worker per frame, and we wait for all of them
+            # before the next frame, so sequence numbers stay in order.
+            stamps = [
+                future.result()
+                for future in [
+                    self.worker_executor.submit(
+                        self._build_and_send_audio_packet, voice_client, opus_packet, self.timestamp_frames
+                    )
+                    for voice_client, opus_packet in sends
+                ]
+            ]
+            built_ns = max(built_ns for built_ns, _ in stamps)
+            sent_ns = max(sent_ns for _, sent_ns in stamps)
+            frame_latency.packet.add(built_ns - encoded_ns)
+            frame_latency.send.add(max(0, sent_ns - built_ns))
+            frame_latency.total.add(sent_ns - self.frame_capture_ns)
+            self._fan_out_done(len(sends), start_ns)
+            return
+
+        # Packets are built and encrypted first, then sent, so the two can be timed separately.
+        if len(sends) <= 1:
+            batch = [
+                self._send_audio_packet(voice_client, opus_packet, self.timestamp_frames)
+                for voice_client, opus_packet in sends
+            ]
+        else:
+            # The pacer sends them later, the workers only build them, one voice client each as above.
+            batch = [
+                future.result()
+                for future in [
+                    self.worker_executor.submit(
+                        self._send_audio_packet, voice_client, opus_packet, self.timestamp_frames
+                    )
+                    for voice_client, opus_packet in sends
+                ]
+            ]
+        built_ns = time.monotonic_ns()
+        if batch:
+            frame_latency.packet.add(built_ns - encoded_ns)
+        if self.packet_pacer is not None:
+            # The pacer only sends them. An empty batch still takes its place in the schedule.
+            self.packet_pacer.put(batch, self.frame_capture_ns, built_ns)
+        elif batch:
+            for send in batch:
+                send()
+            sent_ns = time.monotonic_ns()
+            frame_latency.send.add(sent_ns - built_ns)
+            frame_latency.total.add(sent_ns - self.frame_capture_ns)
+        self._fan_out_done(len(sends), start_ns)
+
+    def _fan_out_done(self, clients: int, start_ns: int) -> None:
+        self.fan_out_time.add(time.perf_counter_ns() - start_ns)
+        self.fan_out_clients = clients
+        if self.packets_sent == 0 and clients != 0 and startup.timeline.mark('first audio packet'):
+            self.logger.info('Startup: {}.'.format(startup.timeline.format()))
+        self.packets_sent += clients
+
+    # Runs on a fan-out worker. Returns when the packet was built and when it was sent.
+    def _build_and_send_audio_packet(
+        self, voice_client: discord.VoiceClient, opus_packet: bytes, timestamp_frames: int
+    ) -> typing.Tuple[int, int]:
+        send = self._send_audio_packet(voice_client, opus_packet, timestamp_frames)
+        built_ns = time.monotonic_ns()
+        send()
+        return built_ns, time.monotonic_ns()
+
+    def _frame_done(self, sent: bool) -> None:
+        self._follow_drift()
+        if self.timestamp_frames == 0:
+            startup.timeline.mark('first audio frame')
+        if sent:
+            self.frame_jitter.mark()
+        else:
+            self.frame_jitter.skip()
+        self.frames_since_statistics += 1
+        # About once per minute.
+        if self.frames_since_statistics >= 60000 // self.frame_ms:
+            self.frames_since_statistics = 0
+            self._log_statistics()
+
+    # Fits the sound card's clock about once per second, on the consumer side, and resamples to it.
+    def _follow_drift(self) -> None:
+        drift_estimator = self.drift_estimator
+        if drift_estimator is None or not drift_estimator.update():
+            return
+        capture_resampler = self.capture_resampler
+        if capture_resampler is not None:
+            capture_resampler.set_input_rate(typing.cast(float, drift_estimator.rate))
+
+    def _log_statistics(self) -> None:
+        now_ns = time.monotonic_ns()
+        now_cpu_ns = time.process_time_ns()
+        elapsed_ns = max(1, now_ns - self.statistics_start_ns)
+        self.logger.info(
+            'Frame duration {} ms: {:.1f} packets per second, process CPU {:.1f}%.'.format(
+                self.frame_ms,
+                self.packets_sent * 1000000000 / elapsed_ns,
+                (now_cpu_ns - self.statistics_start_cpu_ns) * 100 / elapsed_ns,
+            )
+        )
+        self.packets_sent = 0
+        self.statistics_start_ns = now_ns
+        self.statistics_start_cpu_ns = now_cpu_ns
+        if self.frame_jitter.count != 0:
+            count, mean_ms, max_ms = self.frame_jitter.take()
+            self.logger.info(
+                'Send jitter over {} frames ({} mode): mean {:.3f} ms, max {:.3f} ms.'.format(
+                    count, 'realtime thread' if self.realtime_pipeline else 'event loop', mean_ms, max_ms
+                )
+            )
+        if self.fan_out_time.count != 0:
+            count, mean_ms, max_ms = self.fan_out_time.take()
+            self.logger.info(
+                'Fan-out time over {} frames to {} voice clients: mean {:.3f} ms, max {:.3f} ms.'.format(
+                    count, self.fan_out_clients, mean_ms, max_ms
+                )
+            )
+        drift_estimator = self.drift_estimator
+        if drift_estimator is not None and drift_estimator.rate is not None:
+            self.logger.info(
+                'Sound card clock drift: {:+.1f} ppm ({:.1f} Hz), compensated.'.format(
+                    typing.cast(float, drift_estimator.ppm), drift_estimator.rate
+                )
+            )
+        if self.packet_pacer is not None:
+            count, mean_ms, max_ms, restarts, catch_ups = self.packet_pacer.take_statistics()
+            self.logger.info(
+                'Paced send deviation over {} frames with {} frames of buffer: mean {:.3f} ms, max {:.3f} ms, '
+                '{} schedule restarts, {} catch-ups.'.format(
+                    count, self.packet_pacer.buffer_frames, mean_ms, max_ms, restarts, catch_ups
+                )
+            )
+        with self.encoders_lock:
+            profile_encoders = list(self.encoders.values())
+        for profile_encoder in profile_encoders:
+            if profile_encoder.encode_time.count == 0:
+                continue
+            count, mean_ms, max_ms = profile_encoder.encode_time.take()
+            self.logger.info(
+                'Encode time over {} frames for profile ({}): mean {:.3f} ms, max {:.3f} ms.'.format(
+                    count, profile_encoder.profile, mean_ms, max_ms
+                )
+            )
+        for stage in self.dsp_chain.stages if self.dsp_chain is not None else ():
+            if stage.process_time.count == 0:
+                continue
+            count, mean_ms, max_ms = stage.process_time.take()
+            self.logger.info(
+                'DSP stage ({}) time over {} frames: mean {:.3f} ms, max {:.3f} ms, {} over its {:.3f} ms budget.'.format(
+                    stage.name, count, mean_ms, max_ms, stage.overruns, stage.budget_ns / 1000000
+                )
+            )
+            stage.overruns = 0
+        suppressed_frames = self.voice_gate.take_suppressed_frames()
+        dtx_suppressed_packets = self.dtx_suppressed_packets
+        self.dtx_suppressed_packets = 0
+        self.logger.info(
+            'Voice gate suppressed {} frames, DTX suppressed {} packets.'.format(
+                suppressed_frames, dtx_suppressed_packets
+            )
+        )
+        if self.lu_meter is not None:
+            self.logger.info(
+                'Loudness: integrated {:.1f} LUFS, short-term {:.1f} LUFS, range {:.1f} LU, true peak {:.1f} dBTP.'.format(
+                    self.lu_meter.integrated_lufs(),
+                    self.lu_meter.short_term_lufs(),
+                    self.lu_meter.loudness_range_lu(),
+                    self.lu_meter.true_peak_dbtp(),
+                )
+            )
+        self.log_latency()
+
+    # Returns (stage, description, frames, p50 in ms, p99 in ms, max in ms) of each stage over the last minute.
+    def latency_report(self) -> typing.List[typing.Tuple[str, str, int, float, float, float]]:
+        return self.frame_latency.report()
+
+    def log_latency(self) -> None:
+        for stage, description, count, p50_ms, p99_ms, max_ms in self.latency_report():
+            if count == 0:
+                continue
+            self.logger.info(
+                'Latency of {} ({}) over {} frames: p50 {:.3f} ms, p99 {:.3f} ms, max {:.3f} ms.'.format(
+                    stage, description, count, p50_ms, p99_ms, max_ms
+                )
+            )
+
+    async def _encode_voice_loop(self) -> None:
+        try:
+            lu_meter = await asyncio.wrap_future(self.dsp_loaded)
+            while self.running:
+                audio_ring = self.audio_ring
+                captured_block = audio_ring.peek()
+                if captured_block is None:
+                    if self.opus_packets:
+                        opus_packet, samples, capture_ns = self.opus_packets.popleft()
+                        prepared_packet = self._prepare_packet(opus_packet, capture_ns)
+                        transmitting = self.voice_gate.transmitting
+                        if transmitting:
+                            await self.loop.run_in_executor(
+                                self.opus_encoder_executor, self._send_passthrough, prepared_packet
+                            )
+                        self._frame_done(transmitting)
+                        self.timestamp_frames = (self.timestamp_frames + samples) & 0xFFFFFFFF
+                        continue
+                    self.audio_ready.clear()
+                    await self.audio_ready.wait()
+                    continue
+                capture_ns, callback_ns = audio_ring.peek_stamps()
+                for captured_buffer in self._captured_frames(audio_ring, captured_block):
+                    buffer = self._prepare_frame(captured_buffer, capture_ns, callback_ns)
+                    frame_size = len(buffer) // 2
+
+                    lu_meter_future = lu_meter.push(buffer)
+
+                    transmitting = self.voice_gate.transmitting
+                    if transmitting:
+                        await self.loop.run_in_executor(self.opus_encoder_executor, self._encode_and_fan_out, buffer)
+                    self._frame_done(transmitting)
+
+                    self.timestamp_frames = (self.timestamp_frames + frame_size) & 0xFFFFFFFF
+                    await lu_meter_future
+                # Both the encoder and the LU meter are done with the block, recycle it.
+                audio_ring.release()
+
+        except Exception:
+            traceback.print_exc()
+        finally:
+            if self.v is not None:
+                self.v.stop()
+
+    # The realtime pipeline mode: silence check, encoding, packet building and sending all happen on
+    # this dedicated thread, so frames never hop through the event loop, which only handles control.
+    def _realtime_pipeline_loop(self) -> None:
+        try:
+            lu_meter = self.dsp_loaded.result()
+            while self.running:
+                audio_ring = self.audio_ring
+                captured_block = audio_ring.peek()
+                if captured_block is None:
+                    if self.opus_packets:
+                        opus_packet, samples, capture_ns = self.opus_packets.popleft()
+                        prepared_packet = self._prepare_packet(opus_packet, capture_ns)
+                        transmitting = self.voice_gate.transmitting
+                        if transmitting:
+                            self._send_passthrough(prepared_packet)
+                        self._frame_done(transmitting)
+                        self.timestamp_frames = (self.timestamp_frames + samples) & 0xFFFFFFFF
+                        continue
+                    self.audio_ready_threading.clear()
+                    if self.audio_ring.peek() is None and not self.opus_packets:
+                        self.audio_ready_threading.wait()
+                    continue
+                capture_ns, callback_ns = audio_ring.peek_stamps()
+                for captured_buffer in self._captured_frames(audio_ring, captured_block):
+                    buffer = self._prepare_frame(captured_buffer, capture_ns, callback_ns)
+                    frame_size = len(buffer) // 2
+
+                    lu_meter_future = lu_meter.submit(buffer)
+
+                    transmitting = self.voice_gate.transmitting
+                    if transmitting:
+                        self._encode_and_fan_out(buffer)
+                    self._frame_done(transmitting)
+
+                    self.timestamp_frames = (self.timestamp_frames + frame_size) & 0xFFFFFFFF
+                    lu_meter_future.result()
+                # Both the encoder and the LU meter are done with the block, recycle it.
+                audio_ring.release()
 
         except Exception:
             traceback.print_exc()
@@ -530,11 +1274,20 @@ class Model:
 
     # A rewrite of discord.VoiceClient.send_audio_packet.
     # The timestamp is supplied from outside so all silent frames get counted.
+    # Thread ownership: the sequence, the timestamp, the nonce counted inside _get_voice_packet and the _dmb_
+    # speaking attributes are only ever touched by the frame consumer, one frame at a time. That is the pipeline
+    # thread in realtime mode, and in event loop mode the event loop for the speaking state and the encoder
+    # executor for the packets, which the loop awaits before it touches the next frame. A fan-out worker takes
+    # one voice client and is waited for before the next frame. discord.py itself never touches them because
+    # send_audio_packet is not used; the event loop only connects and disconnects, and the gateway message of
+    # a speaking change is sent from there, see _set_speaking_state. It is the same split as discord.py's own
+    # player thread, so a packet built while a reconnect is replacing the key is lost like it would be there.
     def _send_audio_packet(
         self, voice_client: discord.VoiceClient, opus_packet: bytes, timestamp_frames: int
     ) -> typing.Callable[[], None]:
         sock = voice_client.socket
         sequence = voice_client.sequence
+        counters = self._channel_counters(voice_client)
 
         voice_client.timestamp = timestamp_frames
         udp_packet = getattr(voice_client, '_get_voice_packet')(opus_packet)
@@ -546,37 +1299,65 @@ class Model:
             try:
                 getattr(voice_client, '_connection').send_packet(udp_packet)
             except OSError:
+                counters.packets_dropped += 1
                 self.logger.warning(
                     'Network too slow, a packet is dropped. (seq={}, ts={})'.format(sequence, timestamp_frames)
                 )
+            else:
+                counters.packets_sent += 1
 
         return send
 
+    def _channel_counters(self, voice_client: discord.VoiceClient) -> metrics.ChannelCounters:
+        channel = voice_client.channel
+        counters = self.channel_counters.get(channel.id)
+        if counters is None:
+            guild = getattr(channel, 'guild', None)
+            counters = metrics.ChannelCounters(
+                channel.id, getattr(channel, 'name', str(channel.id)), guild.name if guild is not None else ''
+            )
+            self.channel_counters[channel.id] = counters
+        return counters
+
     def _set_speaking_state(
         self, voice_client: discord.VoiceClient, state: discord.SpeakingState, timestamp_ns: int
     ) -> None:
+        self.speaking_state_changes += 1
         setattr(voice_client, '_dmb_speaking', state)
         setattr(voice_client, '_dmb_last_spoke', timestamp_ns)
-        asyncio.ensure_future(voice_client.ws.speak(state), loop=self.loop)
-
-    def _encode_voice(self, buffer: 'array.array[float]') -> bytes:
-        c_buffer = ctypes.cast(buffer.buffer_info()[0], ctypes.POINTER(ctypes.c_float))
-        max_data_bytes = len(buffer) * 4
-        output = (ctypes.c_char * max_data_bytes)()
-        output_len = self.opus_encoder_private.opus_encode_float(
-            getattr(self.opus_encoder, '_state'), c_buffer, len(buffer) // 2, output, max_data_bytes
-        )
-        return bytes(output[:output_len])
+        # May be called from the realtime pipeline thread. The voice websocket belongs to the event loop, which
+        # replaces it on a reconnect, so it is only looked up there.
+        asyncio.run_coroutine_threadsafe(self._send_speaking_state(voice_client, state), self.loop)
+
+    async def _send_speaking_state(self, voice_client: discord.VoiceClient, state: discord.SpeakingState) -> None:
+        if voice_client.is_connected():
+            await voice_client.ws.speak(state)
+
+    # Starts consuming captured frames, on the event loop or on the realtime pipeline thread.
+    def _start_pipeline(self) -> None:
+        if self.packet_pacer is not None:
+            self.packet_pacer.start()
+        if self.realtime_pipeline:
+            self.pipeline_thread = threading.Thread(
+                target=self._realtime_pipeline_loop, name='discord-mic-bot-pipeline'
+            )
+            self.pipeline_thread.start()
+        else:
+            self.encode_voice_task = asyncio.ensure_future(self._encode_voice_loop(), loop=self.loop)
 
     async def run(self) -> None:
         try:
-            self.encode_voice_task = asyncio.ensure_future(self._encode_voice_loop(), loop=self.loop)
+            if self.metrics_server is not None:
+                await self.metrics_server.start()
+            self._start_pipeline()
 
             self.login_status = 'Logging in…'
             self.logger.info(self.login_status)
             if self.v is not None:
                 self.v.loop.call_soon_threadsafe(self.v.login_status_updated)
             await self.discord_client.login(self.discord_bot_token)
+            startup.timeline.mark('logged in')
+            self.logged_in.set()
 
             self.login_status = 'Connecting to Discord server…'
             self.logger.info(self.login_status)
@@ -594,10 +1375,8 @@ class Model:
         self.running = False
         self.v = None
         self.logger.info('Gracefully stopping, may take some time…')
-        if self.input_stream is not None:
-            self.input_stream.stop()
-            self.input_stream.close()
-            self.input_stream = None
+        with self.sound_devices_lock:
+            self._close_input_stream()
         if self.stop_future is None:
             self.stop_future = asyncio.run_coroutine_threadsafe(self._stop(), self.loop)
         return self.stop_future
@@ -612,8 +1391,17 @@ class Model:
         for task in done:
             task.result()
 
-        await self.audio_queue.put(None)
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
+        self.audio_ready.set()
+        self.audio_ready_threading.set()
         if self.encode_voice_task is not None:
             await self.encode_voice_task
+        if self.pipeline_thread is not None:
+            await self.loop.run_in_executor(None, self.pipeline_thread.join)
+        if self.packet_pacer is not None:
+            await self.loop.run_in_executor(None, self.packet_pacer.close)
         self.opus_encoder_executor.shutdown()
-        self.lu_meter.close()
+        self.worker_executor.shutdown()
+        if self.lu_meter is not None:
+            self.lu_meter.close()
@@ -0,0 +1,467 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Ogg Opus files (RFC 7845), played either by sending their packets as they are, or decoded when they do not fit
+# the voice stream.
+
+import ctypes
+import mmap
+import os
+import struct
+import typing
+
+import discord
+import numpy
+
+from . import filesource
+
+EXTENSIONS = ('.opus', '.ogg')
+
+# Capture pattern, version, header type, granule position, serial number, page sequence number, CRC, segments.
+_PAGE_HEADER = struct.Struct('<4sBBqIIIB')
+_CONTINUED = 1
+_END_OF_STREAM = 4
+
+# The decoder starts this many samples before a seek target, so its output has settled when the target is reached.
+SEEK_PREROLL = 3840
+MAX_PACKET_SAMPLES = 5760
+
+# Stereo downmix of the Vorbis channel orders of mapping family 1, as (left, right) weights of each channel.
+_C = 0.7071
+DOWNMIX = {
+    # L, C, R
+    3: ((1, 0), (_C, _C), (0, 1)),
+    # FL, FR, RL, RR
+    4: ((1, 0), (0, 1), (_C, 0), (0, _C)),
+    # FL, C, FR, RL, RR
+    5: ((1, 0), (_C, _C), (0, 1), (_C, 0), (0, _C)),
+    # FL, C, FR, RL, RR, LFE
+    6: ((1, 0), (_C, _C), (0, 1), (_C, 0), (0, _C), (_C, _C)),
+    # FL, C, FR, SL, SR, RC, LFE
+    7: ((1, 0), (_C, _C), (0, 1), (_C, 0), (0, _C), (0.5, 0.5), (_C, _C)),
+    # FL, C, FR, SL, SR, RL, RR, LFE
+    8: ((1, 0), (_C, _C), (0, 1), (_C, 0), (0, _C), (_C, 0), (0, _C), (_C, _C)),
+}
+
+
+# Samples at 48kHz in an Opus packet, read from its TOC byte (RFC 6716, section 3.1). 0 if malformed.
+def packet_samples(packet: bytes) -> int:
+    if len(packet) == 0:
+        return 0
+    toc = packet[0]
+    config = toc >> 3
+    if config < 12:
+        # SILK
+        frame_samples = (480, 960, 1920, 2880)[config & 3]
+    elif config < 16:
+        # Hybrid
+        frame_samples = (480, 960)[config & 1]
+    else:
+        # CELT
+        frame_samples = (120, 240, 480, 960)[config & 3]
+    code = toc & 3
+    if code == 0:
+        frames = 1
+    elif code != 3:
+        frames = 2
+    elif len(packet) >= 2:
+        frames = packet[1] & 0x3F
+    else:
+        return 0
+    return frame_samples * frames
+
+
+class OggPage(typing.NamedTuple):
+    start: int
+    header_type: int
+    granule: int
+    serial: int
+    lacing: bytes
+    body: int
+    end: int
+
+
+class OggOpusFile:
+    # Memory-mapped like filesource.PCMFile. Only the first Opus stream of the file is played.
+    __slots__ = [
+        'path',
+        'file',
+        'mapping',
+        'serial',
+        'channels',
+        'pre_skip',
+        'output_gain_db',
+        'mapping_family',
+        'streams',
+        'coupled_streams',
+        'channel_mapping',
+        'audio_offset',
+        'frames',
+    ]
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.file = open(path, 'rb')
+        try:
+            if os.fstat(self.file.fileno()).st_size == 0:
+                raise ValueError('The file is empty.')
+            self.mapping = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._parse_headers()
+            self.frames = max(0, self._last_granule() - self.pre_skip)
+        except BaseException:
+            self.file.close()
+            raise
+
+    @property
+    def duration_s(self) -> float:
+        return self.frames / 48000
+
+    def close(self) -> None:
+        self.mapping.close()
+        self.file.close()
+
+    def _page_at(self, offset: int) -> typing.Optional[OggPage]:
+        mapping = self.mapping
+        if offset + _PAGE_HEADER.size > len(mapping):
+            return None
+        capture, version, header_type, granule, serial, _, _, segments = _PAGE_HEADER.unpack_from(mapping, offset)
+        body = offset + _PAGE_HEADER.size + segments
+        if capture != b'OggS' or version != 0 or body > len(mapping):
+            return None
+        lacing = mapping[offset + _PAGE_HEADER.size : body]
+        end = body + sum(lacing)
+        if end > len(mapping):
+            return None
+        return OggPage(offset, header_type, granule, serial, lacing, body, end)
+
+    def _parse_headers(self) -> None:
+        # The first page of every stream comes first, the Opus one starts with its OpusHead packet.
+        offset = 0
+        while True:
+            page = self._page_at(offset)
+            if page is None:
+                raise ValueError('Not an Ogg Opus file.')
+            head = self.mapping[page.body : page.end]
+            if head.startswith(b'OpusHead') and len(head) >= 19:
+                break
+            offset = page.end
+        self.serial = page.serial
+        version, self.channels, self.pre_skip, _, output_gain, self.mapping_family = struct.unpack_from(
+            '<BBHIhB', head, 8
+        )
+        if version >> 4 != 0 or self.channels == 0:
+            raise ValueError('Unsupported Ogg Opus version.')
+        self.output_gain_db = output_gain / 256
+        if self.mapping_family == 0:
+            if self.channels > 2:
+                raise ValueError('Invalid Ogg Opus channel count.')
+            self.streams = 1
+            self.coupled_streams = self.channels - 1
+            self.channel_mapping = bytes(range(self.channels))
+        else:
+            if len(head) < 21 + self.channels:
+                raise ValueError('Invalid Ogg Opus channel mapping.')
+            self.streams, self.coupled_streams = head[19], head[20]
+            self.channel_mapping = head[21 : 21 + self.channels]
+
+        # Audio starts on the page after the one the OpusTags packet ends on, OpusHead is alone on its page.
+        header_packets = 1
+        offset = page.end
+        while header_packets < 2:
+            page = self._page_at(offset)
+            if page is None:
+                raise ValueError('Ogg Opus file without audio.')
+            if page.serial == self.serial:
+                header_packets += sum(1 for size in page.lacing if size < 255)
+            offset = page.end
+        self.audio_offset = offset
+
+    def _last_granule(self) -> int:
+        end = len(self.mapping)
+        while True:
+            offset = self.mapping.rfind(b'OggS', self.audio_offset, end)
+            if offset < 0:
+                return 0
+            page = self._page_at(offset)
+            if page is not None and page.serial == self.serial and page.granule >= 0:
+                return page.granule
+            end = offset
+
+    # Yields the packets of the Opus stream from the page at offset on, dropping the first skip of them.
+    def packets(self, offset: int, skip: int = 0) -> typing.Iterator[bytes]:
+        mapping = self.mapping
+        packet = bytearray()
+        # Whether packet holds a packet from its start. A page may begin with the rest of a packet we skipped.
+        have_start = False
+        while True:
+            page = self._page_at(offset)
+            if page is None:
+                # Damaged, carry on from the next page there is.
+                offset = mapping.find(b'OggS', offset + 1)
+                if offset < 0:
+                    return
+                have_start = False
+                continue
+            offset = page.end
+            if page.serial != self.serial:
+                continue
+            if not page.header_type & _CONTINUED:
+                packet.clear()
+                have_start = True
+            position = page.body
+            for size in page.lacing:
+                if have_start:
+                    packet += mapping[position : position + size]
+                position += size
+                if size < 255:
+                    if have_start:
+                        if skip == 0:
+                            yield bytes(packet)
+                        else:
+                            skip -= 1
+                    packet.clear()
+                    have_start = True
+            if page.header_type & _END_OF_STREAM:
+                return
+
+    # Returns (offset, skip, start) to play from position on: the packets to read are packets(offset, skip), and
+    # the first of them starts at start. Bisects on the granule positions, so only a few pages are read however
+    # long the file.
+    def seek_offset(self, position: int) -> typing.Tuple[int, int, int]:
+        target = position + self.pre_skip
+        result = self.audio_offset, 0, -self.pre_skip
+        low, high = self.audio_offset, len(self.mapping)
+        while low < high:
+            page = self._granule_page_after(low + (high - low) // 2)
+            if page is None or page.granule > target:
+                high = low + (high - low) // 2
+            else:
+                # The granule position is where the last packet finished on the page ends. A packet may start on
+                # the page and finish on the next one, so read from the page itself, and drop the packets it
+                # finishes, apart from one begun on an earlier page, which packets() leaves out anyway.
+                finished = sum(1 for size in page.lacing if size < 255)
+                if page.header_type & _CONTINUED:
+                    finished -= 1
+                result = page.start, finished, page.granule - self.pre_skip
+                low = page.end
+        return result
+
+    def _granule_page_after(self, offset: int) -> typing.Optional[OggPage]:
+        while True:
+            offset = self.mapping.find(b'OggS', offset)
+            if offset < 0:
+                return None
+            page = self._page_at(offset)
+            if page is not None and page.serial == self.serial and page.granule >= 0:
+                return page
+            offset += 1
+
+    # Why the packets cannot be sent as they are in a stream of frame_size samples per packet, or None if they can.
+    # Checks the first second of packets, encoders keep the same frame duration throughout.
+    def passthrough_problem(self, frame_size: int) -> typing.Optional[str]:
+        if self.streams != 1 or self.channels > 2:
+            return '{} channels'.format(self.channels)
+        for index, packet in enumerate(self.packets(self.audio_offset)):
+            samples = packet_samples(packet)
+            if samples != frame_size:
+                return '{:g} ms packets'.format(samples / 48)
+            if (index + 1) * frame_size >= 48000:
+                break
+        return None
+
+
+def _opus_lib() -> typing.Any:
+    # discord.opus only declares the functions it uses itself.
+    lib = getattr(discord.opus, '_lib')
+    lib.opus_multistream_decoder_create.argtypes = [
+        ctypes.c_int32,
+        ctypes.c_int,
+        ctypes.c_int,
+        ctypes.c_int,
+        ctypes.c_char_p,
+        ctypes.POINTER(ctypes.c_int),
+    ]
+    lib.opus_multistream_decoder_create.restype = ctypes.c_void_p
+    lib.opus_multistream_decode_float.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_char_p,
+        ctypes.c_int32,
+        ctypes.POINTER(ctypes.c_float),
+        ctypes.c_int,
+        ctypes.c_int,
+    ]
+    lib.opus_multistream_decode_float.restype = ctypes.c_int
+    lib.opus_multistream_decoder_ctl.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    lib.opus_multistream_decoder_ctl.restype = ctypes.c_int
+    lib.opus_multistream_decoder_destroy.argtypes = [ctypes.c_void_p]
+    lib.opus_multistream_decoder_destroy.restype = None
+    return lib
+
+
+class OpusDecoder:
+    # A libopus multistream decoder, which takes any channel mapping, mixed down to stereo with the output gain.
+    __slots__ = ['lib', 'state', 'output', 'downmix']
+
+    def __init__(self, ogg_file: OggOpusFile) -> None:
+        self.lib = _opus_lib()
+        error = ctypes.c_int(0)
+        self.state = self.lib.opus_multistream_decoder_create(
+            48000,
+            ogg_file.channels,
+            ogg_file.streams,
+            ogg_file.coupled_streams,
+            ogg_file.channel_mapping,
+            ctypes.byref(error),
+        )
+        if error.value != 0 or not self.state:
+            raise ValueError('Unable to decode this Opus stream (libopus error {}).'.format(error.value))
+        self.output: filesource.Float32Array = numpy.zeros((MAX_PACKET_SAMPLES, ogg_file.channels), dtype=numpy.float32)
+        if ogg_file.channels == 1:
+            downmix = ((1.0, 1.0),)
+        elif ogg_file.mapping_family == 1 and ogg_file.channels in DOWNMIX:
+            downmix = DOWNMIX[ogg_file.channels]
+        else:
+            # Unknown layouts keep their first two channels.
+            downmix = ((1.0, 0.0), (0.0, 1.0)) + ((0.0, 0.0),) * (ogg_file.channels - 2)
+        matrix = numpy.array(downmix, dtype=numpy.float32)
+        # Keep a signal at full scale in every channel at full scale.
+        matrix /= max(1.0, float(numpy.max(numpy.sum(matrix, axis=0))))
+        self.downmix: filesource.Float32Array = matrix * numpy.float32(10 ** (ogg_file.output_gain_db / 20))
+
+    def decode(self, packet: bytes) -> filesource.Float32Array:
+        count = self.lib.opus_multistream_decode_float(
+            self.state,
+            packet,
+            len(packet),
+            self.output.ctypes.data_as(ctypes.POINTER(ctypes.c_float)),
+            MAX_PACKET_SAMPLES,
+            0,
+        )
+        if count < 0:
+            # Damaged, play the silence it would have lasted.
+            return numpy.zeros((packet_samples(packet), 2), dtype=numpy.float32)
+        return self.output[:count] @ self.downmix
+
+    def reset(self) -> None:
+        CTL_RESET_STATE = 4028
+        self.lib.opus_multistream_decoder_ctl(self.state, CTL_RESET_STATE)
+
+    def close(self) -> None:
+        if self.state:
+            self.lib.opus_multistream_decoder_destroy(self.state)
+            self.state = None
+
+
+class DecodedOpusFile(filesource.AudioFile):
+    # An Ogg Opus file decoded for FileSource, for when its packets cannot be sent as they are.
+    __slots__ = ['ogg_file', 'decoder', 'packets', 'next_position', 'skip', 'pending']
+
+    def __init__(self, ogg_file: OggOpusFile) -> None:
+        super().__init__(ogg_file.path, 48000, ogg_file.channels, ogg_file.frames)
+        self.ogg_file = ogg_file
+        self.decoder = OpusDecoder(ogg_file)
+        self.packets: typing.Iterator[bytes] = iter(())
+        self.next_position = 0
+        # Decoded samples still to be dropped before next_position is reached.
+        self.skip = 0
+        self.pending = numpy.zeros((0, 2), dtype=numpy.float32)
+        self._seek(0)
+
+    def read(self, position: int, count: int) -> filesource.Float32Array:
+        if position != self.next_position:
+            self._seek(position)
+        count = max(0, min(count, self.frames - position))
+        while len(self.pending) < count:
+            packet = next(self.packets, None)
+            if packet is None:
+                break
+            decoded = self.decoder.decode(packet)
+            skip = min(self.skip, len(decoded))
+            self.skip -= skip
+            self.pending = numpy.concatenate((self.pending, decoded[skip:]))
+        block = self.pending[:count]
+        self.pending = self.pending[count:]
+        self.next_position = position + len(block)
+        return block
+
+    def _seek(self, position: int) -> None:
+        offset, skip, start = self.ogg_file.seek_offset(max(0, position - SEEK_PREROLL))
+        self.decoder.reset()
+        self.packets = self.ogg_file.packets(offset, skip)
+        self.skip = position - start
+        self.pending = numpy.zeros((0, 2), dtype=numpy.float32)
+        self.next_position = position
+
+    def close(self) -> None:
+        self.decoder.close()
+        self.ogg_file.close()
+
+
+class OpusPassthroughSource(filesource.PacedSource):
+    # Plays an Ogg Opus file without decoding it: each packet is handed on as it is, when it is due.
+    # Past the end of the file it hands on an empty packet per frame, unless it loops.
+    __slots__ = ['ogg_file', 'frame_size', 'callback', 'packets']
+
+    def __init__(
+        self,
+        ogg_file: OggOpusFile,
+        frame_size: int,
+        callback: typing.Callable[[bytes, int, int], None],
+        loop: bool = False,
+    ) -> None:
+        super().__init__(48000, loop)
+        self.ogg_file = ogg_file
+        self.frame_size = frame_size
+        # Called with each packet, the samples it lasts and the time it was due.
+        self.callback = callback
+        self.packets = ogg_file.packets(ogg_file.audio_offset)
+        # The pre-skip samples at the start of the stream are played before position 0.
+        self.position = -ogg_file.pre_skip
+
+    @property
+    def duration_s(self) -> float:
+        return self.ogg_file.duration_s
+
+    def close(self) -> None:
+        self.ogg_file.close()
+
+    def _play_next(self, due_ns: int) -> int:
+        ogg_file = self.ogg_file
+        seek_position = self._take_seek()
+        if seek_position is not None:
+            offset, skip, self.position = ogg_file.seek_offset(seek_position)
+            self.packets = ogg_file.packets(offset, skip)
+            # Pages can be a second long, skip to the packet playing at the seek position.
+            for packet in self.packets:
+                samples = packet_samples(packet)
+                if self.position + samples > seek_position:
+                    self.position += samples
+                    self.callback(packet, samples, due_ns)
+                    return samples
+                self.position += samples
+        packet = next(self.packets, None)
+        if packet is None and self.loop and ogg_file.frames > 0:
+            self.packets = ogg_file.packets(ogg_file.audio_offset)
+            self.position = -ogg_file.pre_skip
+            packet = next(self.packets, None)
+        samples = packet_samples(packet) if packet is not None else 0
+        if packet is None or samples == 0:
+            # Nothing more to play, or a damaged packet, which is dropped.
+            self.callback(b'', self.frame_size, due_ns)
+            return self.frame_size
+        self.position += samples
+        self.callback(packet, samples, due_ns)
+        return samples
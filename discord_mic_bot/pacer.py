@@ -0,0 +1,136 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import collections
+import threading
+import time
+import typing
+
+from . import latency, stats
+
+
+class PacketPacer:
+    # Sends the packets of one frame every frame interval on a steady monotonic schedule,
+    # so bursts of audio callbacks do not turn into bursts of packets.
+    # Up to buffer_frames frames are held back to absorb the bursts, adding that much latency.
+    __slots__ = [
+        'buffer_frames',
+        'frame_ns',
+        'batches',
+        'condition',
+        'running',
+        'thread',
+        'send_deviation',
+        'restarts',
+        'catch_ups',
+        'frame_latency',
+    ]
+
+    def __init__(
+        self,
+        buffer_frames: int,
+        frame_ns: int = 20000000,
+        frame_latency: typing.Optional[latency.FrameLatency] = None,
+    ) -> None:
+        self.buffer_frames = max(0, buffer_frames)
+        self.frame_ns = frame_ns
+        # Each batch holds the send functions of every voice client for one frame,
+        # with the capture time of the frame and the time the packets were built.
+        self.batches: collections.deque[typing.Tuple[typing.List[typing.Callable[[], None]], int, int]] = (
+            collections.deque()
+        )
+        self.frame_latency = frame_latency
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread: typing.Optional[threading.Thread] = None
+        # How late each batch leaves compared to its scheduled time.
+        self.send_deviation = stats.DurationMeter()
+        # Times the buffer ran dry and the schedule started over, e.g. after each phrase.
+        self.restarts = 0
+        # Times the buffer grew too long and a batch was sent ahead of the schedule.
+        self.catch_ups = 0
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self._run, name='discord-mic-bot-pacer')
+        self.thread.start()
+
+    def put(self, batch: typing.List[typing.Callable[[], None]], capture_ns: int = 0, built_ns: int = 0) -> None:
+        with self.condition:
+            self.batches.append((batch, capture_ns, built_ns))
+            self.condition.notify()
+
+    def _run(self) -> None:
+        scheduled = False
+        deadline_ns = 0
+        while True:
+            with self.condition:
+                if not scheduled:
+                    while self.running and not self.batches:
+                        self.condition.wait()
+                    # Hold the first batch back for the buffer time. Counting batches instead would not work:
+                    # a burst fills the buffer at once and leaves no time to wait for the next burst.
+                    deadline_ns = time.monotonic_ns() + self.buffer_frames * self.frame_ns
+                    while self.running:
+                        remaining_ns = deadline_ns - time.monotonic_ns()
+                        if remaining_ns <= 0:
+                            break
+                        self.condition.wait(remaining_ns / 1000000000)
+                    scheduled = True
+                else:
+                    while self.running:
+                        remaining_ns = deadline_ns - time.monotonic_ns()
+                        if remaining_ns <= 0:
+                            break
+                        self.condition.wait(remaining_ns / 1000000000)
+                if not self.running:
+                    return
+                if not self.batches:
+                    self.restarts += 1
+                    scheduled = False
+                    continue
+                batches = [self.batches.popleft()]
+                # If the input runs faster than the schedule, do not let the latency grow without bound.
+                if len(self.batches) > self.buffer_frames * 2 + 2:
+                    batches.append(self.batches.popleft())
+                    self.catch_ups += 1
+                self.send_deviation.add(max(0, time.monotonic_ns() - deadline_ns))
+            for batch, capture_ns, built_ns in batches:
+                for send in batch:
+                    send()
+                if batch and self.frame_latency is not None:
+                    sent_ns = time.monotonic_ns()
+                    self.frame_latency.send.add(sent_ns - built_ns)
+                    self.frame_latency.total.add(sent_ns - capture_ns)
+            deadline_ns += self.frame_ns
+
+    # Returns (count, mean deviation in ms, max deviation in ms, restarts, catch-ups) and starts a new window.
+    def take_statistics(self) -> typing.Tuple[int, float, float, int, int]:
+        with self.condition:
+            count, mean_ms, max_ms = self.send_deviation.take()
+            restarts = self.restarts
+            catch_ups = self.catch_ups
+            self.restarts = 0
+            self.catch_ups = 0
+        return count, mean_ms, max_ms, restarts, catch_ups
+
+    # Stops the schedule, packets still in the buffer are dropped.
+    def close(self) -> None:
+        with self.condition:
+            self.running = False
+            self.batches.clear()
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,148 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import math
+import typing
+
+import numpy
+import numpy.typing
+
+Float32Array: typing.TypeAlias = numpy.typing.NDArray[numpy.float32]
+Float64Array: typing.TypeAlias = numpy.typing.NDArray[numpy.float64]
+
+
+class StreamingResampler:
+    # Arbitrary-ratio windowed-sinc resampler for stereo blocks, shaped (samples, 2 channels).
+    # The filter coefficients are a polynomial of the fractional position of each output sample
+    # (a Farrow structure): every block runs a few fixed FIR filters over contiguous input in one matrix
+    # product, then picks the rows it needs and evaluates the polynomial. There is no per-output gather of
+    # filter windows, and the ratio can change between blocks, e.g. to follow clock drift.
+    __slots__ = ['step', 'taps', 'coefficients', 'history', 'position']
+    polynomial_order = 5
+    kaiser_beta = 8.0
+
+    def __init__(self, input_rate: float, output_rate: float = 48000, taps: int = 32) -> None:
+        self.step = input_rate / output_rate
+        self.taps = taps
+        # Cut off a bit below the lower Nyquist frequency, relative to the input Nyquist frequency.
+        cutoff = min(1.0, 1.0 / self.step) * 0.91
+        # Sample the filter for 256 fractional positions between the two center taps, then fit each tap with
+        # a polynomial of that position.
+        fractions = numpy.linspace(0.0, 1.0, 257)
+        distance = (
+            numpy.arange(taps, dtype=numpy.float64)[numpy.newaxis, :] - (taps // 2 - 1) - fractions[:, numpy.newaxis]
+        )
+        window = numpy.i0(self.kaiser_beta * numpy.sqrt(numpy.maximum(0.0, 1.0 - (distance / (taps / 2)) ** 2)))
+        table: Float64Array = numpy.sinc(cutoff * distance) * window
+        # Normalize every position to unity gain at DC, so the gain does not wobble with the position.
+        table /= table.sum(axis=1, keepdims=True)
+        powers = numpy.vander(fractions, self.polynomial_order + 1, increasing=True)
+        coefficients = numpy.linalg.lstsq(powers, table, rcond=None)[0]
+        # A (taps, order + 1) matrix, one FIR filter per power of the fractional position.
+        self.coefficients: Float32Array = numpy.ascontiguousarray(coefficients.T, dtype=numpy.float32)
+        # The input samples still needed by the next block, starting with silence.
+        self.history: Float32Array = numpy.zeros((taps - 1, 2), dtype=numpy.float32)
+        # Position of the next output sample in history, in input samples.
+        self.position = 0.0
+
+    # Delay added to the signal, in output samples.
+    @property
+    def latency_samples(self) -> float:
+        return (self.taps // 2) / self.step
+
+    def set_input_rate(self, input_rate: float, output_rate: float = 48000) -> None:
+        self.step = input_rate / output_rate
+
+    def process(self, x: Float32Array) -> Float32Array:
+        extended = numpy.concatenate((self.history, x))
+        available = extended.shape[0] - self.taps + 1
+        count = max(0, math.ceil((available - self.position) / self.step))
+        positions = self.position + numpy.arange(count, dtype=numpy.float64) * self.step
+        starts = positions.astype(numpy.intp)
+        fractions = (positions - starts).astype(numpy.float32)[:, numpy.newaxis]
+
+        y: Float32Array
+        if count == 0:
+            y = numpy.zeros((0, 2), dtype=numpy.float32)
+        else:
+            rows = int(starts[-1]) - int(starts[0]) + 1
+            windows = numpy.lib.stride_tricks.sliding_window_view(extended[int(starts[0]) :], self.taps, axis=0)
+            # Shaped (rows, 2 channels, order + 1).
+            branches = (windows[:rows].reshape((-1, self.taps)) @ self.coefficients).reshape(
+                (rows, 2, self.polynomial_order + 1)
+            )
+            selected = branches[starts - starts[0]]
+            # Horner's method, in place.
+            y = selected[:, :, self.polynomial_order].copy()
+            for order in range(self.polynomial_order - 1, -1, -1):
+                y *= fractions
+                y += selected[:, :, order]
+
+        next_position = self.position + count * self.step
+        keep = min(int(next_position), extended.shape[0])
+        self.history = extended[keep:].copy()
+        self.position = next_position - keep
+        return y
+
+
+class FrameResampler:
+    # Resamples captured blocks and cuts the result into frames of a fixed size.
+    __slots__ = ['resampler', 'frame_size', 'pending']
+
+    def __init__(self, input_rate: float, frame_size: int = 48000 * 20 // 1000, output_rate: float = 48000) -> None:
+        self.resampler = StreamingResampler(input_rate, output_rate)
+        self.frame_size = frame_size
+        self.pending: Float32Array = numpy.zeros((0, 2), dtype=numpy.float32)
+
+    def set_input_rate(self, input_rate: float, output_rate: float = 48000) -> None:
+        self.resampler.set_input_rate(input_rate, output_rate)
+
+    # Returns the complete frames, as C-contiguous arrays shaped (frame_size, 2).
+    def process(self, data: typing.Any) -> typing.List[Float32Array]:
+        x: Float32Array = numpy.frombuffer(data, dtype=numpy.float32).reshape((-1, 2))
+        y = self.resampler.process(x)
+        if self.pending.shape[0] != 0:
+            y = numpy.concatenate((self.pending, y))
+        complete = y.shape[0] // self.frame_size * self.frame_size
+        self.pending = y[complete:].copy()
+        return [y[start : start + self.frame_size] for start in range(0, complete, self.frame_size)]
+
+
+# CPU cost per 20ms frame and added latency for common rate pairs.
+# Run with: python -m discord_mic_bot.resampler
+def benchmark(frames: int = 1000) -> None:
+    import time
+
+    rng = numpy.random.default_rng(0)
+    print('{:>8} {:>8} {:>14} {:>12}'.format('from Hz', 'to Hz', 'us per frame', 'latency ms'))
+    for input_rate in (44100, 48000, 88200, 96000, 192000):
+        frame_resampler = FrameResampler(input_rate)
+        block = rng.standard_normal((input_rate * 20 // 1000, 2)).astype(numpy.float32).tobytes()
+        for _ in range(10):
+            frame_resampler.process(block)
+        start_ns = time.perf_counter_ns()
+        for _ in range(frames):
+            frame_resampler.process(block)
+        elapsed_ns = time.perf_counter_ns() - start_ns
+        print(
+            '{:>8} {:>8} {:>14.1f} {:>12.3f}'.format(
+                input_rate, 48000, elapsed_ns / frames / 1000, frame_resampler.resampler.latency_samples / 48
+            )
+        )
+
+
+if __name__ == '__main__':
+    benchmark()
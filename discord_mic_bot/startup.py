@@ -0,0 +1,62 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import threading
+import time
+import typing
+
+# Only the standard library here, this is imported before anything else to timestamp the start.
+
+
+class StartupTimeline:
+    # Marks the first time each startup phase finishes, relative to when the package was imported.
+    __slots__ = ['start_ns', 'marks', 'lock']
+
+    def __init__(self) -> None:
+        self.start_ns = time.perf_counter_ns()
+        self.marks: typing.List[typing.Tuple[str, int]] = []
+        self.lock = threading.Lock()
+
+    # Returns False if the phase was already marked, so callers can act only once.
+    def mark(self, phase: str) -> bool:
+        now_ns = time.perf_counter_ns()
+        with self.lock:
+            if any(name == phase for name, _ in self.marks):
+                return False
+            self.marks.append((phase, now_ns - self.start_ns))
+        return True
+
+    def is_marked(self, phase: str) -> bool:
+        with self.lock:
+            return any(name == phase for name, _ in self.marks)
+
+    # Phases are marked from several threads, so each one shows its own time since start, plus the gap to
+    # the phase before it in time.
+    def format(self) -> str:
+        with self.lock:
+            marks = sorted(self.marks, key=lambda mark: mark[1])
+        parts: typing.List[str] = []
+        previous_ns = 0
+        for name, elapsed_ns in marks:
+            parts.append(
+                '{} at {:.0f} ms (+{:.0f})'.format(name, elapsed_ns / 1000000, (elapsed_ns - previous_ns) / 1000000)
+            )
+            previous_ns = elapsed_ns
+        return ', '.join(parts)
+
+
+timeline = StartupTimeline()
@@ -0,0 +1,117 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import array
+import math
+import time
+import typing
+
+
+class JitterMeter:
+    # Measures how far the interval between two consecutive events deviates from the expected interval.
+    __slots__ = ['expected_ns', 'last_ns', 'count', 'total_deviation_ns', 'max_deviation_ns']
+
+    def __init__(self, expected_ns: int) -> None:
+        self.expected_ns = expected_ns
+        self.last_ns: typing.Optional[int] = None
+        self.count = 0
+        self.total_deviation_ns = 0
+        self.max_deviation_ns = 0
+
+    def mark(self) -> None:
+        now_ns = time.monotonic_ns()
+        if self.last_ns is not None:
+            deviation_ns = abs(now_ns - self.last_ns - self.expected_ns)
+            self.count += 1
+            self.total_deviation_ns += deviation_ns
+            if deviation_ns > self.max_deviation_ns:
+                self.max_deviation_ns = deviation_ns
+        self.last_ns = now_ns
+
+    # Call when an event is intentionally skipped (e.g. silence), so the gap is not counted as jitter.
+    def skip(self) -> None:
+        self.last_ns = None
+
+    # Returns (count, mean deviation in ms, max deviation in ms) and starts a new measurement window.
+    def take(self) -> typing.Tuple[int, float, float]:
+        count = self.count
+        mean_ms = self.total_deviation_ns / count / 1000000 if count != 0 else 0.0
+        max_ms = self.max_deviation_ns / 1000000
+        self.count = 0
+        self.total_deviation_ns = 0
+        self.max_deviation_ns = 0
+        return count, mean_ms, max_ms
+
+
+class DurationMeter:
+    # Accumulates how long an operation takes, e.g. the fan-out of a frame to every voice client.
+    __slots__ = ['count', 'total_ns', 'max_ns']
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def add(self, duration_ns: int) -> None:
+        self.count += 1
+        self.total_ns += duration_ns
+        if duration_ns > self.max_ns:
+            self.max_ns = duration_ns
+
+    # Returns (count, mean duration in ms, max duration in ms) and starts a new measurement window.
+    def take(self) -> typing.Tuple[int, float, float]:
+        count = self.count
+        mean_ms = self.total_ns / count / 1000000 if count != 0 else 0.0
+        max_ms = self.max_ns / 1000000
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        return count, mean_ms, max_ms
+
+
+class RollingLatency:
+    # Keeps the last `window` latencies. Adding one is a single store, the percentiles are only computed
+    # when somebody asks for them.
+    __slots__ = ['samples', 'next_index', 'count', 'total_ns']
+
+    def __init__(self, window: int) -> None:
+        self.samples = array.array('q', bytes(8 * window))
+        self.next_index = 0
+        # Totals over everything ever added, the window holds the last min(count, window) of them.
+        self.count = 0
+        self.total_ns = 0
+
+    def add(self, latency_ns: int) -> None:
+        next_index = self.next_index
+        self.samples[next_index] = latency_ns
+        next_index += 1
+        self.next_index = next_index if next_index != len(self.samples) else 0
+        self.count += 1
+        self.total_ns += latency_ns
+
+    # Returns (count in window, p50 in ms, p99 in ms, max in ms) over the window.
+    def percentiles(self) -> typing.Tuple[int, float, float, float]:
+        count = min(self.count, len(self.samples))
+        if count == 0:
+            return 0, 0.0, 0.0, 0.0
+        window = sorted(self.samples[:count])
+        return (
+            count,
+            window[(count - 1) // 2] / 1000000,
+            # Nearest rank: the smallest latency at or above 99% of the window.
+            window[max(0, math.ceil(count * 0.99) - 1)] / 1000000,
+            window[-1] / 1000000,
+        )
@@ -15,16 +15,32 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
+import difflib
 import math
+import time
 import tkinter
 import tkinter.ttk
 import typing
 
 import discord
 
+from . import startup
+
 if typing.TYPE_CHECKING:
     from . import model
 
+# Bounding box and state of a canvas item of the meter, the bounding box is None if it was never placed.
+MeterItem: typing.TypeAlias = typing.Tuple[typing.Optional[typing.Tuple[int, int, int, int]], str]
+
+
+# Formats seconds as m:ss, or h:mm:ss from an hour on.
+def format_time(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+    return '{}:{:02d}'.format(minutes, seconds)
+
 
 class View:
     __slots__ = [
@@ -40,24 +56,65 @@ class View:
         'device',
         'bitrate',
         'fec_enabled',
+        'dtx_enabled',
         'muted',
         'frame',
         'hostapi_combobox',
         'device_combobox',
+        'rescan_button',
+        'file_label',
+        'file_controls',
+        'file_position_scale',
+        'file_position',
+        'file_position_dragged',
+        'file_time',
+        'file_loop',
+        'file_shown',
         'guilds_list',
         'channels_list',
         'joined_list',
         'lu_meter',
         'lu_meter_rects',
+        'lu_meter_size',
+        'lu_meter_drawn_size',
+        'lu_meter_drawn',
+        'lu_meter_visible',
+        'debug',
+        'ticks',
+        'redraws',
+        'canvas_calls',
+        'guilds_dirty',
+        'channels_dirty',
+        'joined_dirty',
+        'list_notifications',
+        'list_refreshes',
+        'list_row_changes',
+        'statistics_start',
     ]
+    # Boundaries of the blue, green, yellow and red parts of the meter, in LU above -70 LUFS.
+    lu_meter_segments = (0.0, 38.0, 56.0, 65.0, 70.0)
+    tick_ms = 1000 // 30
 
-    def __init__(self, m: 'model.Model', loop: asyncio.AbstractEventLoop) -> None:
+    def __init__(self, m: 'model.Model', loop: asyncio.AbstractEventLoop, debug: bool = False) -> None:
         self.m = m
         self.loop = loop
         self.running = True
+        self.debug = debug
+        self.ticks = 0
+        self.redraws = 0
+        self.canvas_calls = 0
+        self.guilds_dirty = False
+        self.channels_dirty = False
+        self.joined_dirty = False
+        self.list_notifications = 0
+        self.list_refreshes = 0
+        self.list_row_changes = 0
+        self.statistics_start = time.monotonic()
 
         self.root = tkinter.Tk()
         self.root.bind('<Destroy>', self.on_destroy)
+        self.root.bind('<Map>', self.on_root_map_changed)
+        self.root.bind('<Unmap>', self.on_root_map_changed)
 
         ttk_style = tkinter.ttk.Style()
         ttk_theme_names = ttk_style.theme_names()
@@ -74,7 +131,15 @@ class View:
         self.device = tkinter.StringVar(self.root, '')
         self.bitrate = tkinter.StringVar(self.root, '128')
         self.fec_enabled = tkinter.BooleanVar(self.root, False)
+        self.dtx_enabled = tkinter.BooleanVar(self.root, False)
         self.muted = tkinter.BooleanVar(self.root, False)
+        self.file_position = tkinter.DoubleVar(self.root, 0.0)
+        # True while button 1 holds the position scale, which then seeks once on release.
+        self.file_position_dragged = False
+        self.file_time = tkinter.StringVar(self.root, '')
+        self.file_loop = tkinter.BooleanVar(self.root, False)
+        # (duration, position in tenths of a second) shown, None while the file controls are hidden.
+        self.file_shown: typing.Optional[typing.Tuple[float, int]] = None
 
         self.root.title('Discord Mic Bot')
         self.frame = tkinter.ttk.Frame(self.root)
@@ -102,6 +167,8 @@ class View:
         )
         self.device_combobox.grid(column=1, row=0, padx=(8, 0), sticky=tkinter.NSEW)
         self.device_combobox.bind('<<ComboboxSelected>>', self.on_device_changed)
+        self.rescan_button = tkinter.ttk.Button(device_controls, text='Rescan', command=self.on_rescan_pressed)
+        self.rescan_button.grid(column=2, row=0, padx=(8, 0), sticky=tkinter.NSEW)
         device_controls.grid_columnconfigure(0, weight=1)
         device_controls.grid_columnconfigure(1, weight=2)
 
@@ -128,7 +195,40 @@ class View:
             variable=self.fec_enabled,
             command=self.on_fec_changed,
         ).grid(column=2, row=0, padx=(8, 0), sticky=tkinter.W)
-        quality_controls.grid_columnconfigure(3, weight=1)
+        tkinter.ttk.Checkbutton(
+            quality_controls,
+            text='DTX (skip near-silent packets)',
+            variable=self.dtx_enabled,
+            command=self.on_dtx_changed,
+        ).grid(column=3, row=0, padx=(8, 0), sticky=tkinter.W)
+        quality_controls.grid_columnconfigure(4, weight=1)
+
+        # Only shown while an audio file is playing.
+        self.file_label = tkinter.ttk.Label(settings_panel, text='File:')
+        self.file_label.grid(column=0, row=2, padx=(16, 8), pady=(2, 4), sticky=tkinter.NSEW)
+        self.file_controls = tkinter.ttk.Frame(settings_panel)
+        self.file_controls.grid(column=1, row=2, padx=(0, 16), pady=(2, 4), sticky=tkinter.NSEW)
+        # Updated through its variable, which unlike set() does not call on_file_seek.
+        self.file_position_scale = tkinter.ttk.Scale(
+            self.file_controls,
+            orient=tkinter.HORIZONTAL,
+            from_=0.0,
+            to=1.0,
+            variable=self.file_position,
+            command=self.on_file_seek,
+        )
+        self.file_position_scale.bind('<ButtonPress-1>', self.on_file_position_pressed)
+        self.file_position_scale.bind('<ButtonRelease-1>', self.on_file_position_released)
+        self.file_position_scale.grid(column=0, row=0, sticky=tkinter.EW)
+        tkinter.ttk.Label(self.file_controls, textvariable=self.file_time, width=17).grid(
+            column=1, row=0, padx=(8, 0), sticky=tkinter.NSEW
+        )
+        tkinter.ttk.Checkbutton(
+            self.file_controls, text='Loop', variable=self.file_loop, command=self.on_file_loop_changed
+        ).grid(column=2, row=0, padx=(8, 0), sticky=tkinter.W)
+        self.file_controls.grid_columnconfigure(0, weight=1)
+        self.file_label.grid_remove()
+        self.file_controls.grid_remove()
 
         settings_panel.grid_columnconfigure(1, weight=1)
 
@@ -219,6 +319,13 @@ class View:
             self.lu_meter.create_rectangle((0, 9, 0, 16), fill="#b2a165", width=0, state=tkinter.HIDDEN),
             self.lu_meter.create_rectangle((0, 9, 0, 16), fill="#d98e86", width=0, state=tkinter.HIDDEN),
         ]
+        # What the canvas currently shows, so only the changes are sent to Tk.
+        self.lu_meter_drawn: typing.List[MeterItem] = [(None, 'normal') for _ in range(8)]
+        self.lu_meter_drawn += [(None, 'hidden') for _ in range(8)]
+        self.lu_meter_size = 0, 0
+        self.lu_meter_drawn_size: typing.Optional[typing.Tuple[int, int]] = None
+        self.lu_meter_visible = True
+        self.lu_meter.bind('<Configure>', self.on_lu_meter_configure)
         tkinter.ttk.Checkbutton(bottom_row, text='Mute', variable=self.muted, command=self.on_mute_changed).grid(
             column=2, row=0, padx=(4, 16), pady=(8, 16), sticky=tkinter.NSEW
         )
@@ -240,218 +347,147 @@ class View:
     def _round_bounding_box(self, x1: float, y1: float, x2: float, y2: float) -> typing.Tuple[int, int, int, int]:
         return round(x1), round(y1), round(x2), round(y2)
 
+    def on_lu_meter_configure(self, event: tkinter.Event) -> None:
+        self.lu_meter_size = event.width, event.height
+
+    def on_root_map_changed(self, event: tkinter.Event) -> None:
+        # Child widgets share the bindings of the window, only look at the window itself.
+        if event.widget is self.root:
+            self.lu_meter_visible = str(event.type) == str(tkinter.EventType.Map)
+
     def update_lumeter(self) -> None:
         if not self.running:
             return
-        width = self.lu_meter.winfo_width()
-        height = self.lu_meter.winfo_height()
+        width, height = self.lu_meter_size
         width_per_db = width / 70
         y_coords = math.ceil(height / 2 - 1), math.floor(height / 2 + 1)
-        self.lu_meter.config(width=width, height=height)
 
-        lufs = self.m.lu_meter.momentary_lufs()
+        # Empty until the model has loaded its DSP stack.
+        lufs = self.m.lu_meter.momentary_lufs() if self.m.lu_meter is not None else (-math.inf, -math.inf)
         loudness = lufs[0] + 73.010299956639812, lufs[1] + 73.010299956639812  # 70 + 10*log10(2)
 
-        self.lu_meter.coords(self.lu_meter_rects[0], self._round_bounding_box(0, 0, 38 * width_per_db, y_coords[0]))
-        self.lu_meter.coords(
-            self.lu_meter_rects[1], self._round_bounding_box(38 * width_per_db, 0, 56 * width_per_db, y_coords[0])
-        )
-        self.lu_meter.coords(
-            self.lu_meter_rects[2], self._round_bounding_box(56 * width_per_db, 0, 65 * width_per_db, y_coords[0])
-        )
-        self.lu_meter.coords(self.lu_meter_rects[3], self._round_bounding_box(65 * width_per_db, 0, width, y_coords[0]))
-        self.lu_meter.coords(
-            self.lu_meter_rects[4], self._round_bounding_box(0, y_coords[1], 38 * width_per_db, height)
-        )
-        self.lu_meter.coords(
-            self.lu_meter_rects[5], self._round_bounding_box(38 * width_per_db, y_coords[1], 56 * width_per_db, height)
-        )
-        self.lu_meter.coords(
-            self.lu_meter_rects[6], self._round_bounding_box(56 * width_per_db, y_coords[1], 65 * width_per_db, height)
-        )
-        self.lu_meter.coords(
-            self.lu_meter_rects[7], self._round_bounding_box(65 * width_per_db, y_coords[1], width, height)
-        )
-
-        if loudness[0] <= 0:
-            self.lu_meter.itemconfig(self.lu_meter_rects[8], state=tkinter.HIDDEN)
-            self.lu_meter.itemconfig(self.lu_meter_rects[9], state=tkinter.HIDDEN)
-            self.lu_meter.itemconfig(self.lu_meter_rects[10], state=tkinter.HIDDEN)
-            self.lu_meter.itemconfig(self.lu_meter_rects[11], state=tkinter.HIDDEN)
-        elif loudness[0] <= 38:
-            self.lu_meter.coords(
-                self.lu_meter_rects[8], self._round_bounding_box(0, 0, loudness[0] * width_per_db, y_coords[0])
-            )
-            self.lu_meter.itemconfig(self.lu_meter_rects[8], state=tkinter.NORMAL)
-            self.lu_meter.itemconfig(self.lu_meter_rects[9], state=tkinter.HIDDEN)
-            self.lu_meter.itemconfig(self.lu_meter_rects[10], state=tkinter.HIDDEN)
-            self.lu_meter.itemconfig(self.lu_meter_rects[11], state=tkinter.HIDDEN)
-        elif loudness[0] <= 56:
-            self.lu_meter.coords(
-                self.lu_meter_rects[8], self._round_bounding_box(0, 0, loudness[0] * width_per_db, y_coords[0])
-            )
-            self.lu_meter.coords(
-                self.lu_meter_rects[9],
-                self._round_bounding_box(38 * width_per_db, 0, loudness[0] * width_per_db, y_coords[0]),
-            )
-            self.lu_meter.itemconfig(self.lu_meter_rects[8], state=tkinter.NORMAL)
-            self.lu_meter.itemconfig(self.lu_meter_rects[9], state=tkinter.NORMAL)
-            self.lu_meter.itemconfig(self.lu_meter_rects[10], state=tkinter.HIDDEN)
-            self.lu_meter.itemconfig(self.lu_meter_rects[11], state=tkinter.HIDDEN)
-        elif loudness[0] <= 65:
-            self.lu_meter.coords(self.lu_meter_rects[8], self._round_bounding_box(0, 0, 38 * width_per_db, y_coords[0]))
-            self.lu_meter.coords(
-                self.lu_meter_rects[9], self._round_bounding_box(38 * width_per_db, 0, 56 * width_per_db, y_coords[0])
-            )
-            self.lu_meter.coords(
-                self.lu_meter_rects[10],
-                self._round_bounding_box(56 * width_per_db, 0, loudness[0] * width_per_db, y_coords[0]),
-            )
-            self.lu_meter.itemconfig(self.lu_meter_rects[8], state=tkinter.NORMAL)
-            self.lu_meter.itemconfig(self.lu_meter_rects[9], state=tkinter.NORMAL)
-            self.lu_meter.itemconfig(self.lu_meter_rects[10], state=tkinter.NORMAL)
-            self.lu_meter.itemconfig(self.lu_meter_rects[11], state=tkinter.HIDDEN)
-        elif loudness[0] <= 70:
-            self.lu_meter.coords(self.lu_meter_rects[8], self._round_bounding_box(0, 0, 38 * width_per_db, y_coords[0]))
-            self.lu_meter.coords(
-                self.lu_meter_rects[9], self._round_bounding_box(38 * width_per_db, 0, 56 * width_per_db, y_coords[0])
-            )
-            self.lu_meter.coords(
-                self.lu_meter_rects[10], self._round_bounding_box(56 * width_per_db, 0, 65 * width_per_db, y_coords[0])
-            )
-            self.lu_meter.coords(
-                self.lu_meter_rects[11],
-                self._round_bounding_box(65 * width_per_db, 0, loudness[0] * width_per_db, y_coords[0]),
-            )
-            self.lu_meter.itemconfig(self.lu_meter_rects[8], state=tkinter.NORMAL)
-            self.lu_meter.itemconfig(self.lu_meter_rects[9], state=tkinter.NORMAL)
-            self.lu_meter.itemconfig(self.lu_meter_rects[10], state=tkinter.NORMAL)
-            self.lu_meter.itemconfig(self.lu_meter_rects[11], state=tkinter.NORMAL)
-        else:
-            self.lu_meter.coords(self.lu_meter_rects[8], self._round_bounding_box(0, 0, 38 * width_per_db, y_coords[0]))
-            self.lu_meter.coords(
-                self.lu_meter_rects[9], self._round_bounding_box(38 * width_per_db, 0, 56 * width_per_db, y_coords[0])
-            )
-            self.lu_meter.coords(
-                self.lu_meter_rects[10], self._round_bounding_box(56 * width_per_db, 0, 65 * width_per_db, y_coords[0])
-            )
-            self.lu_meter.coords(
-                self.lu_meter_rects[11], self._round_bounding_box(65 * width_per_db, 0, width, y_coords[0])
-            )
-            self.lu_meter.itemconfig(self.lu_meter_rects[8], state=tkinter.NORMAL)
-            self.lu_meter.itemconfig(self.lu_meter_rects[9], state=tkinter.NORMAL)
-            self.lu_meter.itemconfig(self.lu_meter_rects[10], state=tkinter.NORMAL)
-            self.lu_meter.itemconfig(self.lu_meter_rects[11], state=tkinter.NORMAL)
-
-        if loudness[1] <= 0:
-            self.lu_meter.itemconfig(self.lu_meter_rects[12], state=tkinter.HIDDEN)
-            self.lu_meter.itemconfig(self.lu_meter_rects[13], state=tkinter.HIDDEN)
-            self.lu_meter.itemconfig(self.lu_meter_rects[14], state=tkinter.HIDDEN)
-            self.lu_meter.itemconfig(self.lu_meter_rects[15], state=tkinter.HIDDEN)
-        elif loudness[1] <= 38:
-            self.lu_meter.coords(
-                self.lu_meter_rects[12], self._round_bounding_box(0, y_coords[1], loudness[1] * width_per_db, height)
-            )
-            self.lu_meter.itemconfig(self.lu_meter_rects[12], state=tkinter.NORMAL)
-            self.lu_meter.itemconfig(self.lu_meter_rects[13], state=tkinter.HIDDEN)
-            self.lu_meter.itemconfig(self.lu_meter_rects[14], state=tkinter.HIDDEN)
-            self.lu_meter.itemconfig(self.lu_meter_rects[15], state=tkinter.HIDDEN)
-        elif loudness[1] <= 56:
-            self.lu_meter.coords(
-                self.lu_meter_rects[12], self._round_bounding_box(0, y_coords[1], 38 * width_per_db, height)
-            )
-            self.lu_meter.coords(
-                self.lu_meter_rects[13],
-                self._round_bounding_box(38 * width_per_db, y_coords[1], loudness[1] * width_per_db, height),
-            )
-            self.lu_meter.itemconfig(self.lu_meter_rects[12], state=tkinter.NORMAL)
-            self.lu_meter.itemconfig(self.lu_meter_rects[13], state=tkinter.NORMAL)
-            self.lu_meter.itemconfig(self.lu_meter_rects[14], state=tkinter.HIDDEN)
-            self.lu_meter.itemconfig(self.lu_meter_rects[15], state=tkinter.HIDDEN)
-        elif loudness[1] <= 65:
-            self.lu_meter.coords(
-                self.lu_meter_rects[12], self._round_bounding_box(0, y_coords[1], 38 * width_per_db, height)
+        # Rectangles 0-7 are the dim backgrounds, 8-15 the bright bars, in the order of lu_meter_rects.
+        # Everything is rounded to whole pixels first, so we can tell whether anything visibly changed.
+        rows = (0, y_coords[0]), (y_coords[1], height)
+        segments = self.lu_meter_segments
+        wanted: typing.List[MeterItem] = [
+            (
+                self._round_bounding_box(segments[i] * width_per_db, top, segments[i + 1] * width_per_db, bottom),
+                'normal',
             )
-            self.lu_meter.coords(
-                self.lu_meter_rects[13],
-                self._round_bounding_box(38 * width_per_db, y_coords[1], 56 * width_per_db, height),
-            )
-            self.lu_meter.coords(
-                self.lu_meter_rects[14],
-                self._round_bounding_box(56 * width_per_db, y_coords[1], loudness[1] * width_per_db, height),
-            )
-            self.lu_meter.itemconfig(self.lu_meter_rects[12], state=tkinter.NORMAL)
-            self.lu_meter.itemconfig(self.lu_meter_rects[13], state=tkinter.NORMAL)
-            self.lu_meter.itemconfig(self.lu_meter_rects[14], state=tkinter.NORMAL)
-            self.lu_meter.itemconfig(self.lu_meter_rects[15], state=tkinter.HIDDEN)
-        elif loudness[1] <= 70:
-            self.lu_meter.coords(
-                self.lu_meter_rects[12], self._round_bounding_box(0, y_coords[1], 38 * width_per_db, height)
-            )
-            self.lu_meter.coords(
-                self.lu_meter_rects[13],
-                self._round_bounding_box(38 * width_per_db, y_coords[1], 56 * width_per_db, height),
-            )
-            self.lu_meter.coords(
-                self.lu_meter_rects[14],
-                self._round_bounding_box(56 * width_per_db, y_coords[1], 65 * width_per_db, height),
-            )
-            self.lu_meter.coords(
-                self.lu_meter_rects[15],
-                self._round_bounding_box(65 * width_per_db, y_coords[1], loudness[1] * width_per_db, height),
-            )
-            self.lu_meter.itemconfig(self.lu_meter_rects[12], state=tkinter.NORMAL)
-            self.lu_meter.itemconfig(self.lu_meter_rects[13], state=tkinter.NORMAL)
-            self.lu_meter.itemconfig(self.lu_meter_rects[14], state=tkinter.NORMAL)
-            self.lu_meter.itemconfig(self.lu_meter_rects[15], state=tkinter.NORMAL)
-        else:
-            self.lu_meter.coords(
-                self.lu_meter_rects[12], self._round_bounding_box(0, y_coords[1], 38 * width_per_db, height)
-            )
-            self.lu_meter.coords(
-                self.lu_meter_rects[13],
-                self._round_bounding_box(38 * width_per_db, y_coords[1], 56 * width_per_db, height),
-            )
-            self.lu_meter.coords(
-                self.lu_meter_rects[14],
-                self._round_bounding_box(56 * width_per_db, y_coords[1], 65 * width_per_db, height),
-            )
-            self.lu_meter.coords(
-                self.lu_meter_rects[15], self._round_bounding_box(65 * width_per_db, y_coords[1], width, height)
-            )
-            self.lu_meter.itemconfig(self.lu_meter_rects[12], state=tkinter.NORMAL)
-            self.lu_meter.itemconfig(self.lu_meter_rects[13], state=tkinter.NORMAL)
-            self.lu_meter.itemconfig(self.lu_meter_rects[14], state=tkinter.NORMAL)
-            self.lu_meter.itemconfig(self.lu_meter_rects[15], state=tkinter.NORMAL)
+            for top, bottom in rows
+            for i in range(4)
+        ]
+        for channel, (top, bottom) in enumerate(rows):
+            for i in range(4):
+                if loudness[channel] <= segments[i]:
+                    wanted.append((None, 'hidden'))
+                else:
+                    right = min(loudness[channel], segments[i + 1]) * width_per_db
+                    wanted.append((self._round_bounding_box(segments[i] * width_per_db, top, right, bottom), 'normal'))
+
+        canvas_calls = 0
+        if self.lu_meter_drawn_size != self.lu_meter_size:
+            self.lu_meter.config(width=width, height=height)
+            self.lu_meter_drawn_size = self.lu_meter_size
+            canvas_calls += 1
+        for item, drawn, (bounding_box, state) in zip(self.lu_meter_rects, self.lu_meter_drawn, wanted):
+            if bounding_box is not None and bounding_box != drawn[0]:
+                self.lu_meter.coords(item, bounding_box)
+                canvas_calls += 1
+            if state != drawn[1]:
+                self.lu_meter.itemconfig(item, state=state)
+                canvas_calls += 1
+        if canvas_calls != 0:
+            self.lu_meter_drawn = [
+                (bounding_box if bounding_box is not None else drawn[0], state)
+                for drawn, (bounding_box, state) in zip(self.lu_meter_drawn, wanted)
+            ]
+            self.redraws += 1
+            self.canvas_calls += canvas_calls
 
     def login_status_updated(self) -> None:
         if not self.running:
             return
         self.login_status.set(self.m.get_login_status())
 
+    # Voice state and guild events can arrive by the hundreds in busy guilds.
+    # The notifications only mark the lists, which are refreshed at most once per tick in refresh_lists.
     def guilds_updated(self) -> None:
-        if not self.running:
-            return
-        self.guilds = self.m.list_guilds()
-        self.guilds_list.delete(0, tkinter.END)
-        for i in self.guilds:
-            self.guilds_list.insert(tkinter.END, i.name)
+        self.guilds_dirty = True
+        self.list_notifications += 1
 
     def channels_updated(self) -> None:
-        if not self.running:
-            return
-        self.channels = self.m.list_channels()
-        self.channels_list.delete(0, tkinter.END)
-        for i in self.channels:
-            self.channels_list.insert(tkinter.END, i.name)
+        self.channels_dirty = True
+        self.list_notifications += 1
 
     def joined_updated(self) -> None:
-        if not self.running:
+        self.joined_dirty = True
+        self.list_notifications += 1
+
+    def refresh_lists(self) -> None:
+        if self.guilds_dirty:
+            self.guilds_dirty = False
+            guilds = self.m.list_guilds()
+            self._update_listbox(self.guilds_list, self.guilds, guilds)
+            self.guilds = guilds
+        if self.channels_dirty:
+            self.channels_dirty = False
+            channels = self.m.list_channels()
+            self._update_listbox(self.channels_list, self.channels, channels)
+            self.channels = channels
+        if self.joined_dirty:
+            self.joined_dirty = False
+            joined = self.m.list_joined()
+            self._update_listbox(self.joined_list, self.joined, joined)
+            self.joined = joined
+
+    # Only inserts and deletes the rows that changed. Tk shifts the selection along with the rows,
+    # so whatever the user selected stays selected unless it is gone.
+    def _update_listbox(
+        self,
+        listbox: tkinter.Listbox,
+        old: typing.Sequence[typing.Union[discord.Guild, discord.VoiceChannel]],
+        new: typing.Sequence[typing.Union[discord.Guild, discord.VoiceChannel]],
+    ) -> None:
+        old_rows = [(i.id, i.name) for i in old]
+        new_rows = [(i.id, i.name) for i in new]
+        if old_rows == new_rows:
+            return
+        matcher = difflib.SequenceMatcher(None, old_rows, new_rows, autojunk=False)
+        # Back to front, so the indices of the operations still to apply stay valid.
+        for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+            if tag == 'equal':
+                continue
+            if i2 > i1:
+                listbox.delete(i1, i2 - 1)
+            if j2 > j1:
+                listbox.insert(i1, *(name for _, name in new_rows[j1:j2]))
+            self.list_row_changes += (i2 - i1) + (j2 - j1)
+        self.list_refreshes += 1
+
+    def update_file_controls(self) -> None:
+        file_position = self.m.file_position()
+        if file_position is None:
+            if self.file_shown is not None:
+                self.file_label.grid_remove()
+                self.file_controls.grid_remove()
+                self.file_shown = None
             return
-        self.joined = self.m.list_joined()
-        self.joined_list.delete(0, tkinter.END)
-        for i in self.joined:
-            self.joined_list.insert(tkinter.END, i.name)
+        position_s, duration_s = file_position
+        shown = duration_s, int(position_s * 10)
+        if shown == self.file_shown:
+            return
+        if self.file_shown is None:
+            self.file_label.grid()
+            self.file_controls.grid()
+            self.file_loop.set(self.m.file_loop)
+        if self.file_shown is None or self.file_shown[0] != duration_s:
+            self.file_position_scale.configure(to=max(0.1, duration_s))
+        if not self.file_position_dragged:
+            self.file_position.set(position_s)
+        self.file_time.set('{} / {}'.format(format_time(position_s), format_time(duration_s)))
+        self.file_shown = shown
 
     def device_updated(self) -> None:
         if not self.running:
@@ -469,7 +505,7 @@ class View:
         sound_input_devices = self.m.list_sound_input_devices(current_hostapi)
         self.device_combobox['values'] = tuple((i.name for i in sound_input_devices))
         current_device = self.device.get()
-        if current_device not in (i.name for i in sound_input_devices):
+        if self.m.sound_devices.lookup(current_hostapi, current_device) is None:
             current_device = ''
             for i in sound_input_devices:
                 if i.is_default:
@@ -515,7 +551,7 @@ class View:
         sound_input_devices = self.m.list_sound_input_devices(current_hostapi)
         self.device_combobox['values'] = tuple((i.name for i in sound_input_devices))
         current_device = self.device.get()
-        if current_device not in (i.name for i in sound_input_devices):
+        if self.m.sound_devices.lookup(current_hostapi, current_device) is None:
             current_device = ''
             for i in sound_input_devices:
                 if i.is_default:
@@ -523,6 +559,36 @@ class View:
             self.device.set(current_device)
         self.m.start_recording(current_hostapi, current_device)
 
+    def on_file_seek(self, value: str) -> None:
+        if not self.file_position_dragged:
+            self.m.seek_file(float(value))
+
+    def on_file_position_pressed(self, event: tkinter.Event) -> None:
+        self.file_position_dragged = True
+
+    def on_file_position_released(self, event: tkinter.Event) -> None:
+        self.file_position_dragged = False
+        self.m.seek_file(self.file_position.get())
+        # Redraw from the playback position on the next update even if it is still in the same tenth.
+        if self.file_shown is not None:
+            self.file_shown = self.file_shown[0], -1
+
+    def on_file_loop_changed(self) -> None:
+        self.m.set_file_loop(self.file_loop.get())
+
+    def on_rescan_pressed(self) -> None:
+        # Enumerating the devices can take a while, so it runs off the Tk thread, and the lists are refreshed
+        # once it is done. The model reopens the device meanwhile.
+        self.rescan_button.state(['disabled'])
+        future = asyncio.run_coroutine_threadsafe(self.m.rescan_sound_devices_async(), self.m.loop)
+        future.add_done_callback(lambda _: self.loop.call_soon_threadsafe(self.on_rescan_finished))
+
+    def on_rescan_finished(self) -> None:
+        if not self.running:
+            return
+        self.rescan_button.state(['!disabled'])
+        self.device_updated()
+
     def on_bitrate_changed(self, event: tkinter.Event) -> None:
         bitrate_str = self.bitrate.get()
         try:
@@ -536,15 +602,63 @@ class View:
         fec_enabled = self.fec_enabled.get()
         asyncio.run_coroutine_threadsafe(self.m.set_fec_enabled(fec_enabled), self.m.loop)
 
+    def on_dtx_changed(self) -> None:
+        dtx_enabled = self.dtx_enabled.get()
+        asyncio.run_coroutine_threadsafe(self.m.set_dtx_enabled(dtx_enabled), self.m.loop)
+
     def on_mute_changed(self) -> None:
         muted = self.muted.get()
         self.m.set_muted(muted)
 
-    async def run(self) -> None:
-        while self.running:
+    # Tk's own main loop drives the window, sleeping until there is input, something to redraw, or a timer.
+    # A Tk timer runs the asyncio loop of this thread in short slices, which handles the notifications posted
+    # by the model, and then updates the meter.
+    def run(self) -> None:
+        # Idle callbacks run after the pending redraws, so this is roughly when the window first shows up.
+        self.root.after_idle(startup.timeline.mark, 'window shown')
+        self.root.after(self.tick_ms, self.on_tick)
+        self.root.mainloop()
+
+    def on_tick(self) -> None:
+        if not self.running:
+            self.root.quit()
+            return
+        self.loop.call_soon(self.loop.stop)
+        self.loop.run_forever()
+        if not self.running:
+            self.root.quit()
+            return
+        self.refresh_lists()
+        self.update_file_controls()
+
+        self.ticks += 1
+        # Nobody sees the meter while the window is minimized.
+        if self.lu_meter_visible:
             self.update_lumeter()
-            self.root.update()
-            await asyncio.sleep(1 / 30)
+        if self.debug:
+            now = time.monotonic()
+            elapsed = now - self.statistics_start
+            if elapsed >= 5:
+                self.m.logger.info(
+                    'View: {:.1f} ticks/s, {:.1f} meter redraws/s, {:.1f} canvas calls/s.'.format(
+                        self.ticks / elapsed, self.redraws / elapsed, self.canvas_calls / elapsed
+                    )
+                )
+                self.m.logger.info(
+                    'View: {:.1f} list notifications/s, {:.1f} list refreshes/s, {:.1f} rows changed/s.'.format(
+                        self.list_notifications / elapsed,
+                        self.list_refreshes / elapsed,
+                        self.list_row_changes / elapsed,
+                    )
+                )
+                self.ticks = 0
+                self.redraws = 0
+                self.canvas_calls = 0
+                self.list_notifications = 0
+                self.list_refreshes = 0
+                self.list_row_changes = 0
+                self.statistics_start = now
+        self.root.after(self.tick_ms, self.on_tick)
 
     def stop(self) -> None:
         self.running = False
@@ -0,0 +1,778 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+# A stand-in for Discord's voice servers: a voice gateway websocket and a UDP endpoint on localhost. It decrypts
+# the RTP the bot sends and checks the stream the way a receiver would see it: sequence and timestamp continuity,
+# also across the gaps the voice gate leaves, packet spacing, how late each packet is, and speaking state messages.
+# The bot side is the real Model with real discord.VoiceClients, only the main gateway (which would announce the
+# voice server) and TLS are left out.
+#
+# Run with: python -m discord_mic_bot.voiceserver --guilds 1,10,50,100 --seconds 20
+
+import argparse
+import asyncio
+import functools
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import typing
+
+import aiohttp
+import aiohttp.web
+import discord
+import discord.gateway
+import discord.state
+import discord.voice_state
+import nacl.bindings
+import nacl.exceptions
+
+from . import benchmark, gate, model, oggopus, stats
+
+if typing.TYPE_CHECKING:
+    import discord.types.guild
+    import discord.types.voice
+
+# Voice gateway opcodes, see discord.gateway.DiscordVoiceWebSocket.
+IDENTIFY = 0
+SELECT_PROTOCOL = 1
+READY = 2
+HEARTBEAT = 3
+SESSION_DESCRIPTION = 4
+SPEAKING = 5
+HEARTBEAT_ACK = 6
+RESUME = 7
+HELLO = 8
+
+# Only the mode this server can decrypt is offered, discord.py picks the first one it supports.
+SUPPORTED_MODES = ('aead_xchacha20_poly1305_rtpsize',)
+
+RTP_HEADER = struct.Struct('>BBHII')
+
+
+class VoiceSession:
+    # One voice websocket connection and the RTP stream sent for it, with its checks.
+    __slots__ = [
+        'guild_id',
+        'ssrc',
+        'secret_key',
+        'connected',
+        'speaking',
+        'tail_allowance',
+        'last_nonce',
+        'last_sequence',
+        'last_timestamp',
+        'last_samples',
+        'last_arrival_ns',
+        'stream_samples',
+        'reference_ns',
+        'recorded',
+        'packets',
+        'payload_bytes',
+        'decrypt_failures',
+        'nonce_errors',
+        'lost_packets',
+        'sequence_errors',
+        'timestamp_errors',
+        'silence_gaps',
+        'gap_clock_errors',
+        'late_packets',
+        'speaking_messages',
+        'speaking_ssrc_mismatches',
+        'unannounced_packets',
+        'tail_packets',
+    ]
+
+    def __init__(self, guild_id: int, ssrc: int, record: bool) -> None:
+        self.guild_id = guild_id
+        self.ssrc = ssrc
+        self.secret_key: typing.Optional[bytes] = None
+        self.connected = True
+        # Speaking flags from the last SPEAKING message, None until the first one.
+        self.speaking: typing.Optional[int] = None
+        # After speaking stops, the gate still sends a few frames of silence.
+        self.tail_allowance = 0
+        self.last_nonce = -1
+        self.last_sequence: typing.Optional[int] = None
+        self.last_timestamp = 0
+        self.last_samples = 0
+        self.last_arrival_ns = 0
+        # Samples since the first packet by the RTP timestamps, and when that first sample would have arrived
+        # if every packet had been on time.
+        self.stream_samples = 0
+        self.reference_ns = 0
+        # (arrival, sequence, timestamp, Opus packet) of every packet, when recording.
+        self.recorded: typing.Optional[typing.List[typing.Tuple[int, int, int, bytes]]] = [] if record else None
+        self.reset()
+
+    def reset(self) -> None:
+        self.packets = 0
+        self.payload_bytes = 0
+        self.decrypt_failures = 0
+        self.nonce_errors = 0
+        self.lost_packets = 0
+        self.sequence_errors = 0
+        self.timestamp_errors = 0
+        self.silence_gaps = 0
+        self.gap_clock_errors = 0
+        self.late_packets = 0
+        self.speaking_messages = 0
+        self.speaking_ssrc_mismatches = 0
+        self.unannounced_packets = 0
+        self.tail_packets = 0
+
+    def speak(self, speaking: int, ssrc: typing.Any) -> None:
+        self.speaking_messages += 1
+        if ssrc != self.ssrc:
+            self.speaking_ssrc_mismatches += 1
+        if self.speaking is not None and self.speaking & 1 and not speaking & 1:
+            self.tail_allowance = gate.VoiceActivityGate.tail_frames
+        self.speaking = speaking
+
+    # Returns how late the packet is, in ns, or None if it is out of order.
+    def receive(
+        self, nonce: int, sequence: int, timestamp: int, opus_packet: bytes, arrival_ns: int
+    ) -> typing.Optional[typing.Tuple[int, int]]:
+        self.packets += 1
+        self.payload_bytes += len(opus_packet)
+        if self.recorded is not None:
+            self.recorded.append((arrival_ns, sequence, timestamp, opus_packet))
+        # The nonce is a counter, a repeated one would break the encryption.
+        if nonce <= self.last_nonce:
+            self.nonce_errors += 1
+        self.last_nonce = nonce
+        if self.speaking is None or not self.speaking & 1:
+            if self.tail_allowance > 0:
+                self.tail_allowance -= 1
+                self.tail_packets += 1
+            else:
+                self.unannounced_packets += 1
+        samples = oggopus.packet_samples(opus_packet)
+
+        spacing_ns = -1
+        if self.last_sequence is None:
+            self.reference_ns = arrival_ns
+        else:
+            sequence_delta = (sequence - self.last_sequence) & 0xFFFF
+            if sequence_delta == 0 or sequence_delta >= 0x8000:
+                # Repeated or older than the last one.
+                self.sequence_errors += 1
+                return None
+            self.lost_packets += sequence_delta - 1
+            timestamp_delta = (timestamp - self.last_timestamp) & 0xFFFFFFFF
+            elapsed_ns = arrival_ns - self.last_arrival_ns
+            last_samples = self.last_samples
+            if timestamp_delta == last_samples * sequence_delta:
+                if sequence_delta == 1:
+                    spacing_ns = elapsed_ns
+            elif last_samples != 0 and timestamp_delta > last_samples and timestamp_delta % last_samples == 0:
+                # The gate skipped some frames, the timestamp must have kept counting them.
+                self.silence_gaps += 1
+                if abs(elapsed_ns - timestamp_delta * 1000000000 // 48000) > max(
+                    40000000, 2 * last_samples * 1000000000 // 48000
+                ):
+                    self.gap_clock_errors += 1
+            else:
+                self.timestamp_errors += 1
+            self.stream_samples += timestamp_delta
+
+        self.last_sequence = sequence
+        self.last_timestamp = timestamp
+        self.last_samples = samples
+        self.last_arrival_ns = arrival_ns
+
+        # The earliest packet relative to its timestamp sets the schedule, the others are late by how far
+        # they are behind it. One frame late is a missed deadline.
+        due_ns = self.reference_ns + self.stream_samples * 1000000000 // 48000
+        if arrival_ns < due_ns:
+            self.reference_ns -= due_ns - arrival_ns
+            due_ns = arrival_ns
+        lateness_ns = arrival_ns - due_ns
+        if lateness_ns > samples * 1000000000 // 48000:
+            self.late_packets += 1
+        return lateness_ns, spacing_ns
+
+    def report(self) -> typing.Dict[str, float]:
+        return {
+            'packets': self.packets,
+            'payload_bytes': self.payload_bytes,
+            'decrypt_failures': self.decrypt_failures,
+            'nonce_errors': self.nonce_errors,
+            'lost_packets': self.lost_packets,
+            'sequence_errors': self.sequence_errors,
+            'timestamp_errors': self.timestamp_errors,
+            'silence_gaps': self.silence_gaps,
+            'gap_clock_errors': self.gap_clock_errors,
+            'late_packets': self.late_packets,
+            'speaking_messages': self.speaking_messages,
+            'speaking_ssrc_mismatches': self.speaking_ssrc_mismatches,
+            'unannounced_packets': self.unannounced_packets,
+            'tail_packets': self.tail_packets,
+        }
+
+
+# Counters that mean the stream is broken, not just slow.
+CORRECTNESS_COUNTERS = (
+    'decrypt_failures',
+    'nonce_errors',
+    'sequence_errors',
+    'timestamp_errors',
+    'gap_clock_errors',
+    'speaking_ssrc_mismatches',
+    'unannounced_packets',
+)
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server: 'VoiceServer') -> None:
+        self.server = server
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.server.udp_transport = typing.cast(asyncio.DatagramTransport, transport)
+
+    def datagram_received(self, data: bytes, addr: typing.Tuple[typing.Any, int]) -> None:
+        self.server.datagram_received(data, addr)
+
+
+class VoiceServer:
+    # Runs on its own thread and event loop, so it stays out of the bot's event loop.
+    __slots__ = [
+        'host',
+        'record',
+        'loop',
+        'thread',
+        'runner',
+        'ws_port',
+        'udp_port',
+        'udp_transport',
+        'tokens',
+        'sessions',
+        'next_ssrc',
+        'unknown_datagrams',
+        'lateness',
+        'spacing',
+        'report_cpu_ns',
+    ]
+
+    def __init__(self, host: str = '127.0.0.1', record: bool = False) -> None:
+        self.host = host
+        self.record = record
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='discord-mic-bot-voice-server', daemon=True)
+        self.runner: typing.Optional[aiohttp.web.AppRunner] = None
+        self.ws_port = 0
+        self.udp_port = 0
+        self.udp_transport: typing.Optional[asyncio.DatagramTransport] = None
+        # Voice tokens handed out by voice_server_update, and the guild each is for.
+        self.tokens: typing.Dict[str, int] = {}
+        self.sessions: typing.Dict[int, VoiceSession] = {}
+        self.next_ssrc = 1
+        self.unknown_datagrams = 0
+        self.lateness = stats.RollingLatency(1 << 17)
+        self.spacing = stats.RollingLatency(1 << 17)
+        self.report_cpu_ns = 0
+
+    def start(self) -> None:
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+
+    async def _start(self) -> None:
+        app = aiohttp.web.Application()
+        app.router.add_get('/', self._handle_websocket)
+        self.runner = aiohttp.web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind((self.host, 0))
+        self.ws_port = sock.getsockname()[1]
+        await aiohttp.web.SockSite(self.runner, sock).start()
+        await self.loop.create_datagram_endpoint(lambda: _DatagramProtocol(self), local_addr=(self.host, 0))
+        assert self.udp_transport is not None
+        self.udp_port = self.udp_transport.get_extra_info('sockname')[1]
+        self.report_cpu_ns = time.thread_time_ns()
+
+    def close(self) -> None:
+        asyncio.run_coroutine_threadsafe(self._close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def _close(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+        if self.udp_transport is not None:
+            self.udp_transport.close()
+
+    # What the main gateway would send in VOICE_SERVER_UPDATE. May be called from any thread.
+    def voice_server_update(self, guild_id: int) -> 'discord.types.voice.VoiceServerUpdate':
+        token = os.urandom(8).hex()
+        self.tokens[token] = guild_id
+        return {'token': token, 'guild_id': str(guild_id), 'endpoint': '{}:{}'.format(self.host, self.ws_port)}
+
+    async def _handle_websocket(self, request: aiohttp.web.Request) -> aiohttp.web.WebSocketResponse:
+        ws = aiohttp.web.WebSocketResponse()
+        await ws.prepare(request)
+        session: typing.Optional[VoiceSession] = None
+        sequence = 0
+
+        async def send(op: int, data: typing.Any) -> None:
+            nonlocal sequence
+            sequence += 1
+            await ws.send_json({'op': op, 'd': data, 'seq': sequence})
+
+        try:
+            await send(HELLO, {'heartbeat_interval': 13750.0})
+            async for message in ws:
+                # Binary frames are DAVE, which is never turned on here.
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                payload = typing.cast(typing.Dict[str, typing.Any], json.loads(message.data))
+                op = payload.get('op')
+                data = typing.cast(typing.Dict[str, typing.Any], payload.get('d') or {})
+                if op == IDENTIFY:
+                    guild_id = self.tokens.pop(data.get('token', ''), None)
+                    if guild_id is None or data.get('server_id') != str(guild_id):
+                        await ws.close(code=4004, message=b'Authentication failed.')
+                        break
+                    session = VoiceSession(guild_id, self.next_ssrc, self.record)
+                    self.next_ssrc += 1
+                    self.sessions[session.ssrc] = session
+                    await send(
+                        READY,
+                        {
+                            'ssrc': session.ssrc,
+                            'ip': self.host,
+                            'port': self.udp_port,
+                            'modes': list(SUPPORTED_MODES),
+                            'heartbeat_interval': 13750.0,
+                        },
+                    )
+                elif op == HEARTBEAT:
+                    await send(HEARTBEAT_ACK, {'t': data.get('t')})
+                elif op == RESUME:
+                    await ws.close(code=4006, message=b'Session no longer valid.')
+                    break
+                elif session is None:
+                    await ws.close(code=4003, message=b'Not authenticated.')
+                    break
+                elif op == SELECT_PROTOCOL:
+                    mode = typing.cast(typing.Dict[str, typing.Any], data.get('data') or {}).get('mode')
+                    if mode not in SUPPORTED_MODES:
+                        await ws.close(code=4016, message=b'Unknown encryption mode.')
+                        break
+                    session.secret_key = os.urandom(32)
+                    await send(
+                        SESSION_DESCRIPTION,
+                        {'mode': mode, 'secret_key': list(session.secret_key), 'dave_protocol_version': 0},
+                    )
+                elif op == SPEAKING:
+                    session.speak(int(data.get('speaking', 0)), data.get('ssrc'))
+        finally:
+            if session is not None:
+                session.connected = False
+        return ws
+
+    def datagram_received(self, data: bytes, addr: typing.Tuple[typing.Any, int]) -> None:
+        arrival_ns = time.monotonic_ns()
+        if len(data) == 74 and struct.unpack_from('>HH', data) == (1, 70):
+            # IP discovery: tell the bot the address and port its packets come from.
+            ssrc = struct.unpack_from('>I', data, 4)[0]
+            if ssrc not in self.sessions or self.udp_transport is None:
+                self.unknown_datagrams += 1
+                return
+            reply = bytearray(74)
+            struct.pack_into('>HHI', reply, 0, 2, 70, ssrc)
+            address = str(addr[0]).encode('ascii')
+            reply[8 : 8 + len(address)] = address
+            struct.pack_into('>H', reply, 72, addr[1])
+            self.udp_transport.sendto(bytes(reply), addr)
+            return
+
+        # 12 byte header, 16 byte tag and the 4 byte nonce, with at least one byte of payload.
+        if len(data) < 33 or data[0] >> 6 != 2:
+            self.unknown_datagrams += 1
+            return
+        first, _, sequence, timestamp, ssrc = RTP_HEADER.unpack_from(data)
+        session = self.sessions.get(ssrc)
+        if session is None or session.secret_key is None:
+            self.unknown_datagrams += 1
+            return
+        # With the rtpsize modes, the fixed header, the CSRCs and the extension header are authenticated but
+        # not encrypted, the extension body is encrypted together with the payload.
+        header_size = 12 + 4 * (first & 0x0F) + (4 if first & 0x10 else 0)
+        nonce = data[-4:]
+        try:
+            plaintext = nacl.bindings.crypto_aead_xchacha20poly1305_ietf_decrypt(
+                data[header_size:-4], data[:header_size], nonce + bytes(20), session.secret_key
+            )
+        except nacl.exceptions.CryptoError:
+            session.decrypt_failures += 1
+            return
+        if first & 0x10:
+            plaintext = plaintext[4 * struct.unpack_from('>H', data, header_size - 2)[0] :]
+        result = session.receive(int.from_bytes(nonce, 'big'), sequence, timestamp, plaintext, arrival_ns)
+        if result is not None:
+            lateness_ns, spacing_ns = result
+            self.lateness.add(lateness_ns)
+            if spacing_ns >= 0:
+                self.spacing.add(spacing_ns)
+
+    # Returns the checks of every stream since the last report, and starts over. May be called from any thread.
+    def take_report(self) -> typing.Dict[str, typing.Any]:
+        return asyncio.run_coroutine_threadsafe(self._take_report(), self.loop).result()
+
+    async def _take_report(self) -> typing.Dict[str, typing.Any]:
+        sessions = [session for session in self.sessions.values() if session.connected]
+        report: typing.Dict[str, typing.Any] = {'streams': len(sessions)}
+        report.update(VoiceSession(0, 0, False).report())
+        for session in sessions:
+            for key, value in session.report().items():
+                report[key] += value
+            session.reset()
+        for name, histogram in (('lateness', self.lateness), ('spacing', self.spacing)):
+            _, p50_ms, p99_ms, max_ms = histogram.percentiles()
+            report['{}_p50_ms'.format(name)] = p50_ms
+            report['{}_p99_ms'.format(name)] = p99_ms
+            report['{}_max_ms'.format(name)] = max_ms
+        self.lateness = stats.RollingLatency(len(self.lateness.samples))
+        self.spacing = stats.RollingLatency(len(self.spacing.samples))
+        report['unknown_datagrams'] = self.unknown_datagrams
+        self.unknown_datagrams = 0
+        # This thread's own CPU time, so it can be told apart from the bot's.
+        cpu_ns = time.thread_time_ns()
+        report['server_cpu_ns'] = cpu_ns - self.report_cpu_ns
+        self.report_cpu_ns = cpu_ns
+        return report
+
+
+# The private parts of discord.py the stand-in takes over or fills in for the main gateway, as written against
+# discord.py 2.7. A release may rename any of them, so they are checked before the load test starts.
+DISCORD_INTERNALS: typing.Tuple[typing.Tuple[typing.Any, str], ...] = (
+    (discord.Client, '_async_setup_hook'),
+    (discord.state.ConnectionState, '_add_guild'),
+    (discord.state.ConnectionState, '_add_voice_client'),
+    (discord.VoiceClient, 'create_connection_state'),
+    (discord.VoiceClient, '_get_voice_packet'),
+    (discord.voice_state.VoiceConnectionState, '_voice_connect'),
+    (discord.voice_state.VoiceConnectionState, '_voice_disconnect'),
+    (discord.voice_state.VoiceConnectionState, '_connect_websocket'),
+    (discord.voice_state.VoiceConnectionState, 'voice_state_update'),
+    (discord.voice_state.VoiceConnectionState, 'voice_server_update'),
+    (discord.voice_state.ConnectionFlowState, 'disconnected'),
+    (discord.voice_state.ConnectionFlowState, 'websocket_connected'),
+)
+
+
+# Returns the names of the discord.py internals the stand-in needs that the installed discord.py lacks.
+def missing_discord_internals() -> typing.List[str]:
+    return ['{}.{}'.format(owner.__qualname__, name) for owner, name in DISCORD_INTERNALS if not hasattr(owner, name)]
+
+
+class StandInConnectionState(discord.voice_state.VoiceConnectionState):
+    # Plays the main gateway's part in the handshake, and connects to the stand-in server over plain ws://.
+    def __init__(
+        self, voice_client: discord.VoiceClient, server: VoiceServer, http_session: aiohttp.ClientSession
+    ) -> None:
+        self.server = server
+        self.http_session = http_session
+        self.update_task: typing.Optional[asyncio.Task[None]] = None
+        super().__init__(voice_client)
+
+    async def _voice_connect(self, *, self_deaf: bool = False, self_mute: bool = False) -> None:
+        self._send_voice_updates(self.voice_client.channel.id, self_deaf, self_mute)
+
+    async def _voice_disconnect(self) -> None:
+        self.state = discord.voice_state.ConnectionFlowState.disconnected
+        self._expecting_disconnect = True
+        self._disconnected.clear()
+        self._send_voice_updates(None, False, False)
+
+    # Like the gateway events, the updates arrive a round trip later. discord.py relies on that: the connection
+    # only wakes up for state changes that happen while it waits.
+    def _send_voice_updates(self, channel_id: typing.Optional[int], self_deaf: bool, self_mute: bool) -> None:
+        self.update_task = asyncio.ensure_future(self._voice_updates(channel_id, self_deaf, self_mute))
+
+    async def _voice_updates(self, channel_id: typing.Optional[int], self_deaf: bool, self_mute: bool) -> None:
+        await asyncio.sleep(0.01)
+        guild_id = self.voice_client.guild.id
+        # channel_id is None when leaving, which the payload type does not allow for.
+        await self.voice_state_update(
+            typing.cast(
+                'discord.types.voice.GuildVoiceState',
+                {
+                    'guild_id': str(guild_id),
+                    'channel_id': str(channel_id) if channel_id is not None else None,
+                    'user_id': str(self.user.id),
+                    'session_id': os.urandom(16).hex(),
+                    'deaf': False,
+                    'mute': False,
+                    'self_deaf': self_deaf,
+                    'self_mute': self_mute,
+                    'self_video': False,
+                    'suppress': False,
+                },
+            )
+        )
+        if channel_id is not None:
+            await self.voice_server_update(self.server.voice_server_update(guild_id))
+
+    async def _connect_websocket(self, resume: bool) -> discord.gateway.DiscordVoiceWebSocket:
+        # The same as discord.py does, but without TLS.
+        seq_ack = self.ws.seq_ack if self.ws is not discord.utils.MISSING else -1
+        gateway = 'ws://{}/?v=8'.format(self.endpoint)
+        socket = await self.http_session.ws_connect(gateway, autoclose=False, max_msg_size=0)
+        ws = discord.gateway.DiscordVoiceWebSocket(socket, loop=self.voice_client.loop, hook=self.hook)
+        ws.gateway = gateway
+        ws.seq_ack = seq_ack
+        setattr(ws, '_connection', self)
+        setattr(ws, '_max_heartbeat_timeout', 60.0)
+        ws.thread_id = threading.get_ident()
+        if resume:
+            await ws.resume()
+        else:
+            await ws.identify()
+        self.state = discord.voice_state.ConnectionFlowState.websocket_connected
+        return ws
+
+
+class StandInVoiceClient(discord.VoiceClient):
+    def __init__(
+        self,
+        client: discord.Client,
+        channel: discord.abc.Connectable,
+        server: VoiceServer,
+        http_session: aiohttp.ClientSession,
+    ) -> None:
+        # Needed by create_connection_state, which the base class calls.
+        self.server = server
+        self.http_session = http_session
+        super().__init__(client, channel)
+
+    def create_connection_state(self) -> discord.voice_state.VoiceConnectionState:
+        return StandInConnectionState(self, self.server, self.http_session)
+
+
+class FrameFeeder:
+    # Writes the frames into the model in real time, looping over them, like a sound card would.
+    __slots__ = ['m', 'frames', 'stopped', 'thread', 'frames_written']
+
+    def __init__(self, m: model.Model, frames: typing.List[typing.Any]) -> None:
+        self.m = m
+        self.frames = [memoryview(frame).cast('B') for frame in frames]
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='discord-mic-bot-frame-feeder', daemon=True)
+        self.frames_written = 0
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self) -> None:
+        frame_ns = self.m.frame_ms * 1000000
+        next_ns = time.monotonic_ns()
+        index = 0
+        while not self.stopped.is_set():
+            next_ns += frame_ns
+            delay_ns = next_ns - time.monotonic_ns()
+            if delay_ns > 0 and self.stopped.wait(delay_ns / 1000000000):
+                break
+            now_ns = time.monotonic_ns()
+            self.m._write_frame(self.frames[index], now_ns, now_ns)  # pyright: ignore[reportPrivateUsage]
+            self.frames_written += 1
+            index = index + 1 if index + 1 != len(self.frames) else 0
+
+
+def _add_guild(state: typing.Any, guild_id: int) -> discord.Guild:
+    data: typing.Dict[str, typing.Any] = {
+        'id': str(guild_id),
+        'name': 'Stand-in guild {}'.format(guild_id),
+        'channels': [
+            {
+                'id': str(guild_id + 1),
+                'type': 2,
+                'name': 'Voice {}'.format(guild_id),
+                'position': 0,
+                'bitrate': 64000,
+                'user_limit': 0,
+                'permission_overwrites': [],
+            }
+        ],
+        'roles': [],
+        'members': [],
+        'voice_states': [],
+        'emojis': [],
+        'stickers': [],
+        'features': [],
+        'member_count': 1,
+    }
+    guild = discord.Guild(data=typing.cast('discord.types.guild.Guild', data), state=state)
+    state._add_guild(guild)
+    return guild
+
+
+async def _set_up(m: model.Model, server: VoiceServer) -> aiohttp.ClientSession:
+    # What logging in would have done, without talking to Discord.
+    await getattr(m.discord_client, '_async_setup_hook')()
+    state = getattr(m.discord_client, '_connection')
+    state.user = discord.ClientUser(
+        state=state,
+        data={'id': '1', 'username': 'discord-mic-bot', 'discriminator': '0', 'avatar': None, 'global_name': None},
+    )
+    # Every voice websocket holds a connection, so no limit, like discord.py's own session.
+    http_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+    m.voice_client_class = functools.partial(StandInVoiceClient, server=server, http_session=http_session)
+    return http_session
+
+
+async def _join_guilds(m: model.Model, first: int, last: int) -> None:
+    state = getattr(m.discord_client, '_connection')
+    guilds = [_add_guild(state, 1000 * (i + 1)) for i in range(first, last)]
+    await asyncio.gather(*(m.join_voice(guild.voice_channels[0]) for guild in guilds))
+
+
+def load_test(
+    steps: typing.Sequence[int],
+    seconds: float,
+    frame_ms: int,
+    realtime_pipeline: bool,
+    paced_send_buffer_frames: typing.Optional[int],
+    signal: str,
+) -> typing.Dict[str, typing.Any]:
+    server = VoiceServer()
+    server.start()
+    loop = asyncio.new_event_loop()
+    loop_thread = threading.Thread(target=loop.run_forever, name='discord-mic-bot-load-test-loop', daemon=True)
+    loop_thread.start()
+    m = model.Model(
+        '',
+        loop,
+        realtime_pipeline=realtime_pipeline,
+        paced_send_buffer_frames=paced_send_buffer_frames,
+        frame_ms=frame_ms,
+    )
+    m.logger.setLevel('WARNING')
+    feeder = FrameFeeder(m, benchmark.make_signal(signal, 10000 // frame_ms, m.frame_size))
+    http_session: typing.Optional[aiohttp.ClientSession] = None
+    results: typing.List[typing.Dict[str, typing.Any]] = []
+    try:
+        http_session = asyncio.run_coroutine_threadsafe(_set_up(m, server), loop).result()
+        m.dsp_loaded.result()
+        loop.call_soon_threadsafe(m._start_pipeline)  # pyright: ignore[reportPrivateUsage]
+        feeder.start()
+        joined = 0
+        for guilds in steps:
+            asyncio.run_coroutine_threadsafe(_join_guilds(m, joined, guilds), loop).result()
+            joined = max(joined, guilds)
+            # Let the new connections settle before measuring.
+            time.sleep(1)
+            server.take_report()
+            ring_overflows = m.ring_overflows
+            frames_written = feeder.frames_written
+            cpu_ns = time.process_time_ns()
+            start_ns = time.monotonic_ns()
+            time.sleep(seconds)
+            elapsed_ns = time.monotonic_ns() - start_ns
+            cpu_ns = time.process_time_ns() - cpu_ns
+            report = server.take_report()
+            server_cpu_ns = report.pop('server_cpu_ns')
+            result: typing.Dict[str, typing.Any] = {'guilds': guilds}
+            result.update(report)
+            result['frames'] = feeder.frames_written - frames_written
+            result['ring_overflows'] = m.ring_overflows - ring_overflows
+            result['late_fraction'] = report['late_packets'] / report['packets'] if report['packets'] != 0 else 0.0
+            # The stand-in server runs in the same process, its own CPU time is left out.
+            result['bot_cpu_percent'] = (cpu_ns - server_cpu_ns) * 100 / elapsed_ns
+            results.append(result)
+            print_step(result)
+    finally:
+        feeder.stop()
+        m.stop().result()
+        if http_session is not None:
+            asyncio.run_coroutine_threadsafe(http_session.close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        loop_thread.join()
+        loop.close()
+        server.close()
+
+    return {
+        'commit': benchmark._git_commit(),  # pyright: ignore[reportPrivateUsage]
+        'settings': {
+            'seconds': seconds,
+            'frame_ms': frame_ms,
+            'realtime_pipeline': realtime_pipeline,
+            'paced_send_buffer_frames': paced_send_buffer_frames,
+            'signal': signal,
+        },
+        'steps': results,
+    }
+
+
+def print_step(result: typing.Dict[str, typing.Any]) -> None:
+    print('{} guilds:'.format(result['guilds']))
+    for key, value in result.items():
+        if key != 'guilds':
+            print('  {:<28} {:12.2f}'.format(key, value))
+
+
+# A step keeps up when no frame is dropped or lost and at most 1% of the packets are a frame late.
+def keeps_up(result: typing.Dict[str, typing.Any]) -> bool:
+    return result['ring_overflows'] == 0 and result['lost_packets'] == 0 and result['late_fraction'] <= 0.01
+
+
+def main(argv: typing.Optional[typing.Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog='python -m discord_mic_bot.voiceserver',
+        description='Feed a stand-in Discord voice server from N guilds and check what it receives.',
+    )
+    parser.add_argument('--guilds', default='1', help='comma separated numbers of guilds, one step each')
+    parser.add_argument('--seconds', type=float, default=10.0, help='seconds to measure each step')
+    parser.add_argument('--frame-ms', type=int, default=20, choices=model.Model.frame_durations_ms)
+    parser.add_argument('--realtime-pipeline', action='store_true', help='encode and send on a dedicated thread')
+    parser.add_argument('--paced-send', type=int, metavar='FRAMES', help='pace the sends with this many frames')
+    parser.add_argument('--signal', default='music', choices=('sine', 'noise', 'silence', 'music'))
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    missing = missing_discord_internals()
+    if missing:
+        sys.exit(
+            'The stand-in voice server does not work with discord.py {}, it lacks: {}. It was written against '
+            'discord.py 2.7.'.format(discord.__version__, ', '.join(missing))
+        )
+
+    steps = sorted({max(1, int(guilds)) for guilds in args.guilds.split(',') if guilds.strip()})
+    results = load_test(steps, args.seconds, args.frame_ms, args.realtime_pipeline, args.paced_send, args.signal)
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+
+    passing = [result['guilds'] for result in results['steps'] if keeps_up(result)]
+    print('Kept up with {} guilds.'.format(max(passing)) if passing else 'Did not keep up with any step.')
+    broken = [key for result in results['steps'] for key in CORRECTNESS_COUNTERS if result[key] != 0]
+    if broken:
+        print('Stream errors: {}.'.format(', '.join(sorted(set(broken)))))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
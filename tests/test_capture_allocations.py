@@ -0,0 +1,128 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# The capture path must not allocate per frame: the PortAudio callback copies into a ring slot, the consumer
+# borrows the slot, encodes it and gives it back.
+
+import array
+import gc
+import logging
+import threading
+import tracemalloc
+import typing
+
+import pytest
+
+from discord_mic_bot import framering
+
+try:
+    from discord_mic_bot import model
+except OSError as exc:
+    # sounddevice raises OSError, not ImportError, when PortAudio is not installed.
+    pytest.skip('sounddevice is unusable: {}'.format(exc), allow_module_level=True)
+
+FRAME_SIZE = 960
+FRAMES = 1000
+WARM_UP_FRAMES = 300
+
+
+class FakeEncoder:
+    # Stands in for libopus: reads the whole frame and returns the same packet every time.
+    __slots__ = ['packet', 'frames']
+
+    def __init__(self) -> None:
+        self.packet = bytes(64)
+        self.frames = 0
+
+    def encode(self, buffer: 'array.array[float]') -> bytes:
+        assert len(buffer) == FRAME_SIZE * 2
+        self.frames += 1
+        return self.packet
+
+
+# Only the attributes _write_frame touches, without loading libopus or logging in.
+def make_model(ring: framering.FrameRing) -> model.Model:
+    m = model.Model.__new__(model.Model)
+    m.audio_ring = ring
+    m.realtime_pipeline = True
+    m.audio_ready_threading = threading.Event()
+    m.ring_overflows = 0
+    m.audio_warning_count = 0
+    m.logger = logging.getLogger('model')
+    return m
+
+
+def run_frames(m: model.Model, fake_encoder: FakeEncoder, block: typing.Any, frames: int) -> None:
+    ring = m.audio_ring
+    for i in range(frames):
+        m._write_frame(block, i, i)  # pyright: ignore[reportPrivateUsage]
+        buffer = ring.peek()
+        assert buffer is not None
+        ring.peek_stamps()
+        fake_encoder.encode(buffer)
+        ring.release()
+
+
+# Net allocated blocks from the package over the frames, after warming up.
+def net_blocks(run: typing.Callable[[int], None]) -> int:
+    tracemalloc.start()
+    try:
+        # Past the small int cache, so the ring indices are already traced heap objects.
+        run(WARM_UP_FRAMES)
+        gc.collect()
+        before = tracemalloc.take_snapshot()
+        run(FRAMES)
+        gc.collect()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    filters = [tracemalloc.Filter(True, '*/discord_mic_bot/*')]
+    statistics = after.filter_traces(filters).compare_to(before.filter_traces(filters), 'lineno')
+    return sum(statistic.count_diff for statistic in statistics)
+
+
+def test_frame_ring_allocates_nothing() -> None:
+    ring = framering.FrameRing(4, FRAME_SIZE * 2)
+    block = memoryview(array.array('f', bytes(FRAME_SIZE * 2 * 4))).cast('B')
+
+    def run(frames: int) -> None:
+        for i in range(frames):
+            assert ring.write(block, i, i)
+            buffer = ring.peek()
+            assert buffer is not None
+            ring.release()
+
+    assert net_blocks(run) == 0
+
+
+def test_write_frame_allocates_nothing() -> None:
+    m = make_model(framering.FrameRing(4, FRAME_SIZE * 2))
+    fake_encoder = FakeEncoder()
+    block = memoryview(array.array('f', bytes(FRAME_SIZE * 2 * 4))).cast('B')
+
+    assert net_blocks(lambda frames: run_frames(m, fake_encoder, block, frames)) == 0
+    assert fake_encoder.frames == FRAMES + WARM_UP_FRAMES
+    assert m.ring_overflows == 0
+    assert m.audio_ready_threading.is_set()
+
+
+def test_write_frame_counts_overflows() -> None:
+    m = make_model(framering.FrameRing(2, FRAME_SIZE * 2))
+    block = memoryview(array.array('f', bytes(FRAME_SIZE * 2 * 4))).cast('B')
+    for i in range(3):
+        m._write_frame(block, i, i)  # pyright: ignore[reportPrivateUsage]
+    assert len(m.audio_ring) == 2
+    assert m.ring_overflows == 1
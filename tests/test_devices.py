@@ -0,0 +1,138 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pathlib
+import typing
+
+import pytest
+
+try:
+    from discord_mic_bot import devices
+except OSError as exc:
+    # sounddevice raises OSError, not ImportError, when PortAudio is not installed.
+    pytest.skip('sounddevice is unusable: {}'.format(exc), allow_module_level=True)
+
+
+def test_restart_portaudio(monkeypatch: pytest.MonkeyPatch) -> None:
+    calls: typing.List[str] = []
+    monkeypatch.setattr(devices.sounddevice, '_terminate', lambda: calls.append('terminate'), raising=False)
+    monkeypatch.setattr(devices.sounddevice, '_initialize', lambda: calls.append('initialize'), raising=False)
+    assert devices._restart_portaudio()  # pyright: ignore[reportPrivateUsage]
+    assert calls == ['terminate', 'initialize']
+
+
+def test_restart_portaudio_initializes_after_failure(monkeypatch: pytest.MonkeyPatch) -> None:
+    calls: typing.List[str] = []
+
+    def terminate() -> None:
+        raise RuntimeError('PortAudio busy')
+
+    monkeypatch.setattr(devices.sounddevice, '_terminate', terminate, raising=False)
+    monkeypatch.setattr(devices.sounddevice, '_initialize', lambda: calls.append('initialize'), raising=False)
+    with pytest.raises(RuntimeError):
+        devices._restart_portaudio()  # pyright: ignore[reportPrivateUsage]
+    assert calls == ['initialize']
+
+
+def test_restart_portaudio_without_private_functions(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.delattr(devices.sounddevice, '_terminate', raising=False)
+    assert not devices._restart_portaudio()  # pyright: ignore[reportPrivateUsage]
+
+
+class FakePortAudio:
+    # What sounddevice.query_hostapis and query_devices return, changed by the test to plug devices in and out.
+    __slots__ = ['hostapis', 'devices']
+
+    def __init__(self) -> None:
+        self.hostapis: typing.List[typing.Dict[str, typing.Any]] = [
+            {'name': 'ALSA', 'default_input_device': 1},
+            {'name': 'JACK', 'default_input_device': -1},
+        ]
+        self.devices: typing.List[typing.Dict[str, typing.Any]] = [
+            device('Speakers', 0, inputs=0),
+            device('USB Mic', 0, 44100.0),
+            device('Line In', 0),
+            device('Line In', 0),
+            device('system', 1),
+            # A host API PortAudio did not list.
+            device('Ghost', 5),
+        ]
+
+    def install(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        monkeypatch.setattr(devices.sounddevice, 'query_hostapis', lambda: tuple(self.hostapis))
+        monkeypatch.setattr(devices.sounddevice, 'query_devices', lambda: list(self.devices))
+        monkeypatch.setattr(devices.sounddevice, '_terminate', lambda: None, raising=False)
+        monkeypatch.setattr(devices.sounddevice, '_initialize', lambda: None, raising=False)
+
+
+def device(name: str, hostapi: int, sample_rate: float = 48000.0, inputs: int = 2) -> typing.Dict[str, typing.Any]:
+    return {'name': name, 'hostapi': hostapi, 'max_input_channels': inputs, 'default_samplerate': sample_rate}
+
+
+@pytest.fixture
+def portaudio(monkeypatch: pytest.MonkeyPatch) -> FakePortAudio:
+    fake = FakePortAudio()
+    fake.install(monkeypatch)
+    return fake
+
+
+def test_lookup_by_hostapi_and_name(portaudio: FakePortAudio) -> None:
+    index = devices.DeviceIndex()
+    assert index.hostapis == ['ALSA', 'JACK']
+    assert [sound_device.name for sound_device in index.input_devices['ALSA']] == ['USB Mic', 'Line In', 'Line In']
+    usb_mic = index.lookup('ALSA', 'USB Mic')
+    assert usb_mic is not None
+    assert (usb_mic.index, usb_mic.is_default, usb_mic.sample_rate) == (1, True, 44100)
+    system = index.lookup('JACK', 'system')
+    assert system is not None and system.index == 4 and not system.is_default
+    # Output only, on another host API, or on a host API that is not listed.
+    assert index.lookup('ALSA', 'Speakers') is None
+    assert index.lookup('JACK', 'USB Mic') is None
+    assert index.lookup('ALSA', 'Ghost') is None
+
+
+def test_duplicate_names_keep_the_first(portaudio: FakePortAudio) -> None:
+    line_in = devices.DeviceIndex().lookup('ALSA', 'Line In')
+    assert line_in is not None and line_in.index == 2
+
+
+def test_rescan_sees_changed_devices(portaudio: FakePortAudio) -> None:
+    index = devices.DeviceIndex()
+    portaudio.devices = [device('Line In', 0), device('Headset', 0), device('system', 1)]
+    portaudio.hostapis[0]['default_input_device'] = 1
+    assert index.rescan()
+    assert index.lookup('ALSA', 'USB Mic') is None
+    line_in = index.lookup('ALSA', 'Line In')
+    headset = index.lookup('ALSA', 'Headset')
+    assert line_in is not None and line_in.index == 0 and not line_in.is_default
+    assert headset is not None and headset.index == 1 and headset.is_default
+    assert [sound_device.name for sound_device in index.input_devices['ALSA']] == ['Line In', 'Headset']
+
+
+def test_rescan_keeps_audio_files(portaudio: FakePortAudio, tmp_path: pathlib.Path) -> None:
+    (tmp_path / 'a.wav').write_bytes(b'')
+    (tmp_path / 'notes.txt').write_bytes(b'')
+    index = devices.DeviceIndex(str(tmp_path))
+    assert index.hostapis == ['ALSA', 'JACK', devices.FILES_HOSTAPI]
+    (tmp_path / 'b.opus').write_bytes(b'')
+    portaudio.devices = [device('USB Mic', 0)]
+    index.rescan()
+    assert index.hostapis == ['ALSA', 'JACK', devices.FILES_HOSTAPI]
+    assert [sound_device.name for sound_device in index.input_devices[devices.FILES_HOSTAPI]] == ['a.wav', 'b.opus']
+    wav = index.lookup(devices.FILES_HOSTAPI, 'a.wav')
+    assert wav is not None and wav.path == str(tmp_path / 'a.wav')
+    assert index.lookup(devices.FILES_HOSTAPI, 'notes.txt') is None
+    assert index.lookup('ALSA', 'USB Mic') is not None
@@ -0,0 +1,61 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import random
+
+from discord_mic_bot import drift
+
+
+# Blocks of 20 ms from a sound card running at rate, captured with up to 2 ms of scheduling jitter.
+def add_blocks(estimator: drift.DriftEstimator, rate: float, blocks: int, start_block: int = 0) -> None:
+    rng = random.Random(0)
+    for block in range(start_block, start_block + blocks):
+        capture_ns = int(block * 960 / rate * 1000000000) + rng.randrange(2000000)
+        estimator.add(960, capture_ns)
+
+
+def test_estimates_rate_after_ten_seconds() -> None:
+    estimator = drift.DriftEstimator(48000)
+    add_blocks(estimator, 48000 * (1 + 150e-6), 450)
+    assert not estimator.update()
+    assert estimator.ppm is None
+    add_blocks(estimator, 48000 * (1 + 150e-6), 50, 450)
+    assert estimator.update()
+    ppm = estimator.ppm
+    assert ppm is not None and abs(ppm - 150) < 20
+    # Not refitted until another second of blocks.
+    assert not estimator.update()
+    add_blocks(estimator, 48000 * (1 + 150e-6), 2500, 500)
+    assert estimator.update()
+    ppm = estimator.ppm
+    assert ppm is not None and abs(ppm - 150) < 2
+
+
+def test_reset_waits_for_new_blocks() -> None:
+    estimator = drift.DriftEstimator(48000)
+    add_blocks(estimator, 48000, 600)
+    estimator.reset()
+    add_blocks(estimator, 48000, 100, 600)
+    assert not estimator.update()
+    add_blocks(estimator, 48000, 400, 700)
+    assert estimator.update()
+
+
+def test_ignores_nonsense() -> None:
+    estimator = drift.DriftEstimator(48000)
+    add_blocks(estimator, 44100, 600)
+    assert not estimator.update()
+    assert estimator.rate is None
@@ -0,0 +1,33 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+
+from discord_mic_bot import dsp
+
+
+def test_stage_is_abstract() -> None:
+    with pytest.raises(TypeError):
+        dsp.Stage('nothing', 0.1)  # pyright: ignore[reportAbstractUsage]
+
+
+@pytest.mark.parametrize('frame_ms', [5, 20, 60])
+def test_budgets_follow_frame_duration(frame_ms: int) -> None:
+    gain = dsp.Gain(-6.0)
+    limiter = dsp.LookAheadLimiter()
+    dsp.DSPChain([gain, limiter], frame_ms)
+    assert gain.budget_ns == frame_ms * 1000000 // 20
+    assert limiter.budget_ns == frame_ms * 1000000 // 10
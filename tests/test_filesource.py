@@ -0,0 +1,52 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy
+
+from discord_mic_bot import filesource
+
+
+class RampFile(filesource.AudioFile):
+    # Each sample is its own position, so a block tells where it was read from.
+    __slots__ = []
+
+    def read(self, position: int, count: int) -> filesource.Float32Array:
+        samples = numpy.arange(position, min(self.frames, position + count), dtype=numpy.float32)
+        return numpy.stack((samples, samples), axis=1)
+
+
+def make_source() -> filesource.FileSource:
+    return filesource.FileSource(RampFile('ramp', 48000, 2, 48000 * 10), 20, lambda block, due_ns: None)
+
+
+def test_seek_moves_next_block() -> None:
+    source = make_source()
+    source._read_block()  # pyright: ignore[reportPrivateUsage]
+    source.seek(2.5)
+    assert source.position_s == 2.5
+    block = source._read_block()  # pyright: ignore[reportPrivateUsage]
+    assert block[0, 0] == 120000
+    assert source.position == 120960
+
+
+def test_seek_is_taken_once() -> None:
+    source = make_source()
+    source.seek(1.0)
+    assert source._take_seek() == 48000  # pyright: ignore[reportPrivateUsage]
+    # A seek asked for right after one was taken is kept for the next block.
+    source.seek(3.0)
+    assert source._take_seek() == 144000  # pyright: ignore[reportPrivateUsage]
+    assert source._take_seek() is None  # pyright: ignore[reportPrivateUsage]
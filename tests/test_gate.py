@@ -0,0 +1,65 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import array
+
+import pytest
+
+from discord_mic_bot import gate
+
+LOUD = array.array('f', [0.5] * 1920)
+QUIET = array.array('f', bytes(1920 * 4))
+
+
+# How many frames are sent after the last loud one, until the gate stops transmitting.
+def frames_after_sound(voice_gate: gate.VoiceActivityGate) -> int:
+    for _ in range(3):
+        voice_gate.process(LOUD)
+    frames = 0
+    while True:
+        voice_gate.process(QUIET)
+        if not voice_gate.transmitting:
+            return frames
+        frames += 1
+
+
+@pytest.mark.parametrize('hold_ms', [0.0, 20.0, 40.0, 100.0])
+def test_five_silent_frames_with_short_hold(hold_ms: float) -> None:
+    # The quiet frames held before the gate closes count towards the five frames of silence.
+    assert frames_after_sound(gate.VoiceActivityGate(hold_ms=hold_ms)) == 5
+
+
+def test_long_hold_is_not_extended() -> None:
+    assert frames_after_sound(gate.VoiceActivityGate(hold_ms=200.0)) == 10
+
+
+def test_views_are_reused() -> None:
+    voice_gate = gate.VoiceActivityGate(hold_ms=0.0)
+    buffer = array.array('f', LOUD)
+    assert voice_gate.process(buffer)
+    view = voice_gate.views[id(buffer)][1]
+    # Like a ring slot written again in place, the same view sees the new samples.
+    buffer[:] = QUIET
+    assert not voice_gate.process(buffer)
+    assert voice_gate.views[id(buffer)][1] is view
+
+
+def test_views_are_bounded() -> None:
+    voice_gate = gate.VoiceActivityGate()
+    buffers = [array.array('f', QUIET) for _ in range(voice_gate.max_views * 2)]
+    for buffer in buffers:
+        voice_gate.process(buffer)
+    assert len(voice_gate.views) <= voice_gate.max_views
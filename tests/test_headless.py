@@ -0,0 +1,117 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import concurrent.futures
+import logging
+import typing
+
+import discord
+import pytest
+
+from discord_mic_bot import headless
+
+
+class FakeModel:
+    __slots__ = ['loop', 'stop_calls']
+
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+        self.stop_calls = 0
+
+    def stop(self) -> concurrent.futures.Future[None]:
+        self.stop_calls += 1
+        raise RuntimeError('Event loop is closed')
+
+
+# A model thread that has already ended on its own, e.g. after a login failure.
+class EndedModelThread:
+    __slots__ = ['init_finished', 'joined']
+
+    def __init__(self, m: FakeModel) -> None:
+        self.init_finished: concurrent.futures.Future[typing.Any] = concurrent.futures.Future()
+        self.init_finished.set_result(m)
+        self.joined = False
+
+    def start(self) -> None:
+        pass
+
+    def is_alive(self) -> bool:
+        return False
+
+    def join(self) -> None:
+        self.joined = True
+
+
+async def configure_nothing(m: typing.Any, config: headless.HeadlessConfig) -> None:
+    pass
+
+
+def test_main_does_not_stop_an_ended_model(monkeypatch: pytest.MonkeyPatch) -> None:
+    loop = asyncio.new_event_loop()
+    m = FakeModel(loop)
+    model_thread = EndedModelThread(m)
+    monkeypatch.setattr(headless, 'model_thread_from_environment', lambda: model_thread)
+    monkeypatch.setattr(headless, 'configure', configure_nothing)
+    try:
+        headless.main([])
+    finally:
+        # Runs the configuration the ended model never got to.
+        loop.run_until_complete(asyncio.sleep(0))
+        loop.close()
+    assert m.stop_calls == 0
+    assert model_thread.joined
+
+
+class ConfigModel:
+    # Enough of a Model for configure with no encoder options, and no sound device to record from.
+    __slots__ = ['discord_client', 'logged_in', 'logger', 'metrics_port']
+
+    def __init__(self) -> None:
+        self.discord_client = discord.Client(intents=discord.Intents.none())
+        self.logged_in = asyncio.Event()
+        self.logger = logging.getLogger('test_headless')
+        self.metrics_port = 9100
+
+    def list_sound_hostapis(self) -> typing.List[str]:
+        return []
+
+
+def test_configure_waits_for_login() -> None:
+    async def start_up() -> None:
+        m = ConfigModel()
+        task = asyncio.ensure_future(headless.configure(typing.cast(typing.Any, m), headless.HeadlessConfig()))
+        # Model.run starting the metrics server: configure has nothing to await before the Discord client.
+        for _ in range(10):
+            await asyncio.sleep(0)
+        assert not task.done()
+        # What login() and then the READY event do.
+        await getattr(m.discord_client, '_async_setup_hook')()
+        m.logged_in.set()
+        getattr(m.discord_client, '_ready').set()
+        await asyncio.wait_for(task, 1.0)
+
+    asyncio.run(start_up())
+
+
+def test_channel_profiles_only_keep_the_keys_set() -> None:
+    config = headless.HeadlessConfig()
+    headless.load_config_file(
+        config, {'bitrate': 96, 'channels': {'123': {'fec': True}, '456': {'bitrate': 32, 'dtx': True}}}
+    )
+    # Unset keys follow the default profile once it is configured, e.g. the bitrate of 96 Kbps.
+    assert config.channel_profiles == {123: {'fec_enabled': True}, 456: {'bitrate_kbps': 32, 'dtx_enabled': True}}
+    assert config.bitrate_kbps == 96
@@ -0,0 +1,240 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import array
+import asyncio
+import math
+import threading
+import typing
+
+import numpy
+import numpy.typing
+import pytest
+import scipy.signal
+
+from discord_mic_bot import lumeter
+
+Float32Array: typing.TypeAlias = numpy.typing.NDArray[numpy.float32]
+Float64Array: typing.TypeAlias = numpy.typing.NDArray[numpy.float64]
+
+
+class ReferenceLUMeter:
+    # The momentary meter as it was before the circular buffer, kept as a reference:
+    # every push shifts the whole 400ms window left by one frame, and every read averages all of it.
+    # Its filters start from silence, like LUMeter's.
+    __slots__ = ['buffer', 'zl', 'zr', 'lock']
+    coeff_b = lumeter.LUMeter.coeff_b
+    coeff_a = lumeter.LUMeter.coeff_a
+
+    def __init__(self) -> None:
+        self.buffer: Float32Array = numpy.zeros((2, 19200), dtype=numpy.float32)
+        self.zl: Float64Array = numpy.zeros(4, dtype=numpy.float64)
+        self.zr = self.zl.copy()
+        self.lock = threading.Lock()
+
+    def push(self, buffer: 'array.array[float]') -> None:
+        yl, yr = self.k_weight(buffer)
+        frame_size = len(buffer) // 2
+        with self.lock:
+            self.buffer[:, :-frame_size] = self.buffer[:, frame_size:]
+            numpy.square(yl, out=self.buffer[0, -frame_size:])
+            numpy.square(yr, out=self.buffer[1, -frame_size:])
+
+    # Converts the frame element by element, then filters each channel on its own.
+    def k_weight(self, buffer: 'array.array[float]') -> typing.Tuple[Float64Array, Float64Array]:
+        x: Float64Array = numpy.array(buffer).reshape((2, -1), order='F')
+        numpy.nan_to_num(x, copy=False)
+        if not numpy.all(numpy.isfinite(self.zl)):
+            self.zl = numpy.zeros(4, dtype=numpy.float64)
+        if not numpy.all(numpy.isfinite(self.zr)):
+            self.zr = numpy.zeros(4, dtype=numpy.float64)
+        yl, self.zl = typing.cast(
+            tuple[Float64Array, Float64Array], scipy.signal.lfilter(self.coeff_b, self.coeff_a, x[0], zi=self.zl)
+        )
+        yr, self.zr = typing.cast(
+            tuple[Float64Array, Float64Array], scipy.signal.lfilter(self.coeff_b, self.coeff_a, x[1], zi=self.zr)
+        )
+        return yl, yr
+
+    def momentary_lufs(self) -> typing.Tuple[float, float]:
+        with self.lock:
+            mean = numpy.mean(self.buffer, axis=1, dtype=numpy.float64)
+        with numpy.errstate(divide='ignore'):
+            lufs = numpy.log10(mean) * 10.0 - 0.691
+        return lufs[0], lufs[1]
+
+
+@pytest.fixture
+def meter() -> typing.Iterator[lumeter.LUMeter]:
+    loop = asyncio.new_event_loop()
+    lu_meter = lumeter.LUMeter(loop)
+    yield lu_meter
+    lu_meter.close()
+    loop.close()
+
+
+# Interleaved stereo frames at 48kHz.
+def frames_of(x: Float64Array, frame_size: int) -> typing.List['array.array[float]']:
+    samples = x.astype(numpy.float32)
+    return [
+        array.array('f', samples[start : start + frame_size].tobytes())
+        for start in range(0, samples.shape[0] - frame_size + 1, frame_size)
+    ]
+
+
+# A different signal on each side: a tone with a slow tremolo on the left, noise bursts on the right.
+def stereo_signal(seconds: float) -> Float64Array:
+    rng = numpy.random.default_rng(0)
+    t = numpy.arange(int(seconds * 48000)) / 48000
+    left = 0.3 * numpy.sin(2 * math.pi * 440 * t) * (1 + 0.5 * numpy.sin(2 * math.pi * 0.7 * t))
+    right = 0.1 * rng.standard_normal((t.shape[0],)) * numpy.where(t % 1 < 0.6, 1.0, 0.0)
+    return numpy.stack((left, right), axis=1)
+
+
+def push(lu_meter: lumeter.LUMeter, buffer: 'array.array[float]') -> None:
+    lu_meter.submit(buffer).result()
+
+
+@pytest.mark.parametrize('frame_size', [960, 480, 1000])
+def test_momentary_matches_reference(meter: lumeter.LUMeter, frame_size: int) -> None:
+    reference = ReferenceLUMeter()
+    for index, buffer in enumerate(frames_of(stereo_signal(3.0), frame_size)):
+        push(meter, buffer)
+        reference.push(buffer)
+        # Once the window is full, both see exactly the same 400ms.
+        if (index + 1) * frame_size < lumeter.LUMeter.window_size:
+            continue
+        for actual, expected in zip(meter.momentary_lufs(), reference.momentary_lufs()):
+            assert actual == pytest.approx(expected, abs=0.01)
+
+
+def test_momentary_silence(meter: lumeter.LUMeter) -> None:
+    for buffer in frames_of(numpy.zeros((48000, 2)), 960):
+        push(meter, buffer)
+    assert meter.momentary_lufs() == (-math.inf, -math.inf)
+
+
+def test_momentary_recovers_from_nan(meter: lumeter.LUMeter) -> None:
+    frames = frames_of(stereo_signal(2.0), 960)
+    frames[10][7] = math.nan
+    reference = ReferenceLUMeter()
+    for buffer in frames[20:]:
+        reference.push(buffer)
+    for buffer in frames:
+        push(meter, buffer)
+    for actual, expected in zip(meter.momentary_lufs(), reference.momentary_lufs()):
+        assert actual == pytest.approx(expected, abs=0.01)
+
+
+# EBU Tech 3341 and 3342 reference signals: a 1kHz sine on both channels, with its peak level in dBFS,
+# measures the same in LUFS.
+def sine(dbfs: float, seconds: float, frequency: float = 1000.0, phase_degrees: float = 0.0) -> Float64Array:
+    t = numpy.arange(round(seconds * 48000)) / 48000
+    x = 10 ** (dbfs / 20) * numpy.sin(2 * math.pi * frequency * t + math.radians(phase_degrees))
+    return numpy.stack((x, x), axis=1)
+
+
+def measure(lu_meter: lumeter.LUMeter, *parts: Float64Array) -> None:
+    for buffer in frames_of(numpy.concatenate(parts), 960):
+        push(lu_meter, buffer)
+
+
+# momentary_lufs is per channel, EBU R 128 sums the channels.
+def momentary_lufs(lu_meter: lumeter.LUMeter) -> float:
+    return 10 * math.log10(sum(10 ** ((lufs + 0.691) / 10) for lufs in lu_meter.momentary_lufs())) - 0.691
+
+
+@pytest.mark.parametrize('dbfs', [-23.0, -33.0])
+def test_ebu_3341_steady_sine(meter: lumeter.LUMeter, dbfs: float) -> None:
+    measure(meter, sine(dbfs, 20.0))
+    assert momentary_lufs(meter) == pytest.approx(dbfs, abs=0.1)
+    assert meter.short_term_lufs() == pytest.approx(dbfs, abs=0.1)
+    assert meter.integrated_lufs() == pytest.approx(dbfs, abs=0.1)
+
+
+@pytest.mark.parametrize(
+    'levels',
+    [
+        [(-36.0, 10.0), (-23.0, 60.0), (-36.0, 10.0)],
+        [(-72.0, 10.0), (-36.0, 10.0), (-23.0, 60.0), (-36.0, 10.0), (-72.0, 10.0)],
+        [(-26.0, 20.0), (-20.0, 20.1), (-26.0, 20.0)],
+    ],
+)
+def test_ebu_3341_gated_integrated(meter: lumeter.LUMeter, levels: typing.List[typing.Tuple[float, float]]) -> None:
+    measure(meter, *(sine(dbfs, seconds) for dbfs, seconds in levels))
+    assert meter.integrated_lufs() == pytest.approx(-23.0, abs=0.1)
+
+
+@pytest.mark.parametrize(
+    ('first_dbfs', 'second_dbfs', 'expected_lu'), [(-20.0, -30.0, 10.0), (-20.0, -15.0, 5.0), (-40.0, -20.0, 20.0)]
+)
+def test_ebu_3342_loudness_range(
+    meter: lumeter.LUMeter, first_dbfs: float, second_dbfs: float, expected_lu: float
+) -> None:
+    measure(meter, sine(first_dbfs, 20.0), sine(second_dbfs, 20.0))
+    assert meter.loudness_range_lu() == pytest.approx(expected_lu, abs=1.0)
+
+
+# A -6 dBFS sine at a quarter of the sample rate, whose samples miss the peaks by up to 3 dB depending on the phase.
+@pytest.mark.parametrize('phase_degrees', [0.0, 45.0, 60.0, 67.5, 88.2])
+def test_ebu_3341_true_peak(meter: lumeter.LUMeter, phase_degrees: float) -> None:
+    measure(meter, sine(-6.0, 3.0, 12000.0, phase_degrees))
+    assert -6.4 <= meter.true_peak_dbtp() <= -5.8
+
+
+# A single full-scale sample: its interpolated neighbours are all lower, the true peak is still at least 0 dBTP.
+@pytest.mark.parametrize('sign', [1.0, -1.0])
+def test_true_peak_of_impulse(meter: lumeter.LUMeter, sign: float) -> None:
+    x = numpy.zeros((9600, 2))
+    x[4801, 0] = sign
+    measure(meter, x)
+    assert meter.true_peak_dbtp() >= 0.0
+
+
+def test_reset_statistics(meter: lumeter.LUMeter) -> None:
+    # Followed by silence, so no gating block after the reset overlaps the louder part.
+    measure(meter, sine(-20.0, 5.0), numpy.zeros((24000, 2)))
+    meter.reset_statistics()
+    assert meter.integrated_lufs() == -math.inf
+    assert meter.loudness_range_lu() == 0.0
+    assert meter.true_peak_dbtp() == -math.inf
+    measure(meter, sine(-30.0, 20.0))
+    assert meter.integrated_lufs() == pytest.approx(-30.0, abs=0.1)
+
+
+# A read only takes the running sums, it does not go over the 400ms window. How long it takes is measured by
+# python -m discord_mic_bot.benchmark, as lu_meter_read_cpu_us.
+def test_momentary_read_uses_running_sums(meter: lumeter.LUMeter) -> None:
+    for buffer in frames_of(stereo_signal(1.0), 960):
+        push(meter, buffer)
+    numpy.testing.assert_allclose(meter.sums, meter.buffer.sum(axis=0), rtol=1e-6)
+    expected = meter.momentary_lufs()
+    with meter.lock:
+        meter.buffer[:] = 0.0
+    assert meter.momentary_lufs() == expected
+
+
+# Filtering a zero-copy view of both channels at once gives what filtering a converted copy of each channel gave,
+# frame after frame. How long it takes is measured by python -m discord_mic_bot.benchmark, as
+# k_weighting_cpu_us_per_frame.
+def test_k_weighting_matches_reference(meter: lumeter.LUMeter) -> None:
+    reference = ReferenceLUMeter()
+    for buffer in frames_of(stereo_signal(1.0), 960):
+        x: Float32Array = numpy.frombuffer(buffer, dtype=numpy.float32).reshape((-1, 2))
+        y = meter._k_weight(x)  # pyright: ignore[reportPrivateUsage]
+        yl, yr = reference.k_weight(buffer)
+        numpy.testing.assert_allclose(y[:, 0], yl, rtol=1e-9, atol=1e-12)
+        numpy.testing.assert_allclose(y[:, 1], yr, rtol=1e-9, atol=1e-12)
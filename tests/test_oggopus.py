@@ -0,0 +1,88 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pathlib
+import struct
+import typing
+
+import pytest
+
+from discord_mic_bot import oggopus
+
+SERIAL = 0x1234
+
+
+def page(header_type: int, granule: int, sequence: int, lacing: bytes, body: bytes) -> bytes:
+    # The CRC is not checked when reading.
+    return struct.pack('<4sBBqIIIB', b'OggS', 0, header_type, granule, SERIAL, sequence, 0, len(lacing)) + lacing + body
+
+
+# 20 ms CELT packets, told apart by their second byte. Every third one is longer than a lacing value, so packets
+# keep crossing page boundaries.
+def make_packets(count: int) -> typing.List[bytes]:
+    return [bytes((0xF8, i)) + bytes(298 if i % 3 == 0 else 98) for i in range(count)]
+
+
+# An Ogg Opus file of the packets, with at most segments_per_page lacing values per page.
+def write_file(path: pathlib.Path, packets: typing.List[bytes], pre_skip: int, segments_per_page: int) -> None:
+    head = b'OpusHead' + struct.pack('<BBHIhB', 1, 2, pre_skip, 48000, 0, 0)
+    pages = [page(2, 0, 0, bytes((len(head),)), head), page(0, 0, 1, b'\x08', b'OpusTags')]
+    segments: typing.List[typing.Tuple[int, bytes, int]] = []
+    for index, packet in enumerate(packets):
+        sizes = [255] * (len(packet) // 255) + [len(packet) % 255]
+        position = 0
+        for size in sizes:
+            # The packet index when this lacing value finishes the packet, else -1.
+            segments.append((size, packet[position : position + size], index if size < 255 else -1))
+            position += size
+    continued = False
+    for start in range(0, len(segments), segments_per_page):
+        chunk = segments[start : start + segments_per_page]
+        finished = [index for _, _, index in chunk if index >= 0]
+        granule = (finished[-1] + 1) * 960 if finished else -1
+        last = start + segments_per_page >= len(segments)
+        header_type = (1 if continued else 0) | (4 if last else 0)
+        pages.append(
+            page(
+                header_type,
+                granule,
+                len(pages),
+                bytes(size for size, _, _ in chunk),
+                b''.join(data for _, data, _ in chunk),
+            )
+        )
+        continued = chunk[-1][2] < 0
+    path.write_bytes(b''.join(pages))
+
+
+@pytest.mark.parametrize('segments_per_page', [3, 4, 7])
+@pytest.mark.parametrize('pre_skip', [0, 312])
+def test_seek_starts_at_packet_boundary(tmp_path: pathlib.Path, segments_per_page: int, pre_skip: int) -> None:
+    packets = make_packets(40)
+    path = tmp_path / 'test.opus'
+    write_file(path, packets, pre_skip, segments_per_page)
+    ogg_file = oggopus.OggOpusFile(str(path))
+    try:
+        assert ogg_file.frames == 40 * 960 - pre_skip
+        for position in range(0, ogg_file.frames, 240):
+            offset, skip, start = ogg_file.seek_offset(position)
+            assert start <= position
+            # The first packet read is the one that starts at start, whatever page it began on.
+            index = (start + pre_skip) // 960
+            assert (start + pre_skip) % 960 == 0
+            assert list(ogg_file.packets(offset, skip)) == packets[index:]
+    finally:
+        ogg_file.close()
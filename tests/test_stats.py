@@ -0,0 +1,42 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+
+from discord_mic_bot import stats
+
+
+def rolling_latency(latencies_ms: range, window: int) -> stats.RollingLatency:
+    histogram = stats.RollingLatency(window)
+    for latency_ms in latencies_ms:
+        histogram.add(latency_ms * 1000000)
+    return histogram
+
+
+def test_percentiles_of_full_window() -> None:
+    # 0 to 99 ms: 99% of the latencies are at or below 98 ms, only the max is 99 ms.
+    assert rolling_latency(range(100), 100).percentiles() == (100, 49.0, 98.0, 99.0)
+
+
+@pytest.mark.parametrize(('count', 'p99_ms'), [(1, 0.0), (2, 1.0), (50, 49.0), (101, 99.0), (200, 197.0)])
+def test_p99_nearest_rank(count: int, p99_ms: float) -> None:
+    assert rolling_latency(range(count), 1000).percentiles()[2] == p99_ms
+
+
+def test_percentiles_of_last_window() -> None:
+    histogram = rolling_latency(range(250), 100)
+    assert histogram.percentiles() == (100, 199.0, 248.0, 249.0)
+    assert histogram.count == 250
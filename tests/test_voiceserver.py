@@ -0,0 +1,35 @@
+# discord-mic-bot -- Discord bot to connect to your microphone
+# Copyright (C) 2020  Star Brilliant
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import discord
+import pytest
+
+try:
+    from discord_mic_bot import voiceserver
+except OSError as exc:
+    # sounddevice raises OSError, not ImportError, when PortAudio is not installed.
+    pytest.skip('sounddevice is unusable: {}'.format(exc), allow_module_level=True)
+
+
+def test_installed_discord_py_has_internals() -> None:
+    assert voiceserver.missing_discord_internals() == []
+
+
+def test_missing_internal_stops_load_test(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.delattr(discord.Client, '_async_setup_hook')
+    assert voiceserver.missing_discord_internals() == ['Client._async_setup_hook']
+    with pytest.raises(SystemExit, match='Client._async_setup_hook'):
+        voiceserver.main(['--guilds', '1'])